@@ -0,0 +1 @@
+"""Benchmarks for mozvpn, run e.g. via `python -m benchmarks.bench_interface`."""
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Benchmark: cold start of the server catalog from locations.csv vs. its binary snapshot.
+
+Each measurement runs in a fresh interpreter (after importing mozvpn),
+loads the catalog and reads all display strings, as the GUI does on startup.
+Also measures ranking all servers by distance, as 'mozvpn up --nearest' does.
+
+Usage: python -m benchmarks.bench_catalog [-n NUMBER] [-r REPEAT]
+"""
+import os
+import sys
+import argparse
+import timeit
+import tempfile
+import subprocess
+
+from mozvpn import catalog, snapshot
+
+MEASURE = '''
+import time, sys
+from mozvpn.catalog import ServerCatalog
+start = time.perf_counter()
+server_catalog = ServerCatalog.load(sys.argv[1])
+items = [(server['display'], server['interface']) for server in server_catalog.servers]
+print(time.perf_counter() - start)
+'''
+
+
+def cold_start(csv_path, repeat):
+    """Return best duration of loading the catalog in a new interpreter."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return min(
+        float(subprocess.run([sys.executable, '-c', MEASURE, csv_path], env=env,
+                             capture_output=True, check=True, text=True).stdout)
+        for _ in range(repeat)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=2000, help='number of servers')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='measurements per path')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'locations.csv')
+        with open(csv_path, 'w') as fp:
+            fp.write('interface,ip,country,region,city,loc\n')
+            for no in range(args.number):
+                fp.write(f'xx{no}-wireguard,10.0.{no // 256 % 256}.{no % 256},C{no % 50},Region {no % 200},City {no % 400},'
+                         f'"{no % 160 - 80}.5,{no * 7 % 360 - 180}.5"\n')
+
+        csv_time = cold_start(csv_path, args.repeat)
+        catalog.ServerCatalog.load(csv_path).write_snapshot(csv_path)
+        snapshot_time = cold_start(csv_path, args.repeat)
+        size = os.path.getsize(snapshot.snapshot_path(csv_path))
+        server_catalog = catalog.ServerCatalog.load(csv_path)
+        nearest_time = min(timeit.repeat(lambda: server_catalog.nearest(50.11, 8.68, k=catalog.NEAREST_CANDIDATES),
+                                         number=100, repeat=args.repeat)) / 100
+
+    print(f'{args.number} servers, snapshot size {size / 1024:.0f} KiB')
+    print(f'csv:      {csv_time * 1000:8.2f} ms')
+    print(f'snapshot: {snapshot_time * 1000:8.2f} ms')
+    print(f'nearest:  {nearest_time * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
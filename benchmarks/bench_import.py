@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Import-time regression benchmark for the mozvpn command line.
+
+Runs 'mozvpn <command> --help' with 'python -X importtime' for the commands
+called most often, sums the import time of all modules loaded beyond the
+bare interpreter, and fails if a command exceeds its budget or imports one
+of the heavy modules only some commands need (Qt, requests).
+
+Usage: python -m benchmarks.bench_import [-r REPEAT] [--budget MS]
+"""
+import sys
+import argparse
+import subprocess
+
+COMMANDS = ('status', 'up', 'down', 'ip')
+# Modules which must not be loaded by the commands above:
+FORBIDDEN = ('PyQt6', 'requests', 'urllib3')
+DEFAULT_BUDGET = 80  # ms
+
+
+def import_times(args):
+    """Return {module: self time in us} of all modules imported by running python with args."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(self_us)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per command, the fastest one counts')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help='maximum import time per command in ms')
+    args = parser.parse_args()
+
+    baseline = import_times(['-c', 'pass'])
+    failed = False
+    for command in COMMANDS:
+        best = None
+        for _ in range(args.repeat):
+            times = import_times(['-m', 'mozvpn.cli', command, '--help'])
+            total = sum(us for module, us in times.items() if module not in baseline) / 1000
+            best = total if best is None else min(best, total)
+        heavy = sorted({module.split('.')[0] for module in times} & set(FORBIDDEN))
+        status = 'ok'
+        if best > args.budget or heavy:
+            status = 'FAILED' + (f' (imports {", ".join(heavy)})' if heavy else '')
+            failed = True
+        print(f'mozvpn {command:<8} {best:8.1f} ms  {status}')
+    if failed:
+        sys.exit(f'import budget of {args.budget:g} ms exceeded')
+
+
+if __name__ == '__main__':
+    main()
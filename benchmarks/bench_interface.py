@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""Micro-benchmark: wireguard interface detection via sysfs vs. 'wg show interfaces'.
+
+Usage: python -m benchmarks.bench_interface [-n NUMBER]
+"""
+import sys
+import timeit
+import argparse
+
+from mozvpn import wireguard
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=200, help='calls per measured path')
+    args = parser.parse_args()
+
+    if wireguard.sysfs_interfaces() is None:
+        sys.exit('sysfs not available, nothing to compare')
+    paths = {
+        'sysfs': wireguard.sysfs_interfaces,
+        'wg show interfaces': lambda: wireguard.run_command(wireguard.WIREGUARD_SHOW_INTERFACES_CMD),
+    }
+    for name, fn in paths.items():
+        try:
+            fn()
+        except wireguard.CommandError as exc:
+            print(f'{name:<20} skipped: {exc}')
+            continue
+        best = min(timeit.repeat(fn, number=args.number, repeat=5)) / args.number
+        print(f'{name:<20} {best * 1e6:10.1f} us/call')
+
+
+if __name__ == '__main__':
+    main()
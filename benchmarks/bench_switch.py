@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Benchmark: connection downtime of 'mozvpn switch' vs. disconnect + connect.
+
+While switching servers, a probe thread opens TCP connections to a host
+through the tunnel every few milliseconds; the downtime is the longest gap
+between two successful probes. Requires an active VPN connection and the
+sudo rules installed by 'mozvpn setup'.
+
+Usage: python -m benchmarks.bench_switch SERVER [--host HOST] [--port PORT]
+"""
+import sys
+import time
+import socket
+import argparse
+import threading
+
+from mozvpn import wireguard
+
+
+def probe(host, port, interval, stop, successes):
+    """Record the times of successful TCP connections until 'stop' is set."""
+    while not stop.is_set():
+        try:
+            socket.create_connection((host, port), timeout=interval * 10).close()
+            successes.append(time.monotonic())
+        except OSError:
+            pass
+        time.sleep(interval)
+
+
+def measure(fn, args):
+    """Run fn while probing, return (runtime, downtime) in seconds."""
+    stop = threading.Event()
+    successes = []
+    thread = threading.Thread(target=probe, args=(args.host, args.port, args.interval, stop, successes))
+    thread.start()
+    time.sleep(args.settle)
+    start = time.monotonic()
+    fn()
+    runtime = time.monotonic() - start
+    time.sleep(args.settle)
+    stop.set()
+    thread.join()
+    gaps = [later - earlier for earlier, later in zip(successes, successes[1:])]
+    return runtime, max(gaps, default=float('inf'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('server', help='server to switch to and back from, e.g. nl2-wireguard')
+    parser.add_argument('--host', default='1.1.1.1', help='host probed through the tunnel')
+    parser.add_argument('--port', type=int, default=443)
+    parser.add_argument('--interval', type=float, default=0.01, help='seconds between probes')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds probed before and after switching')
+    args = parser.parse_args()
+
+    original = wireguard.active_server()
+    if not original:
+        sys.exit('not connected')
+
+    def switch():
+        print(f'switch method: {wireguard.switch(args.server)}')
+
+    def reconnect():
+        wireguard.disconnect(wireguard.interface())
+        wireguard.connect(original)
+
+    for name, fn in [('mozvpn switch', switch), ('down + up', reconnect)]:
+        runtime, downtime = measure(fn, args)
+        print(f'{name:<15} runtime {runtime * 1000:8.1f} ms   downtime {downtime * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
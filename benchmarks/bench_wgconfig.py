@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Benchmark: discover and parse a directory of wireguard config files.
+
+Usage: python -m benchmarks.bench_wgconfig [-n NUMBER]
+"""
+import time
+import argparse
+import tempfile
+
+from mozvpn import wgconfig
+
+CONFIG = '''[Interface]
+PrivateKey = 8GboYh0YF3q/hJhoPFoL3HM/ObgOuC8YI6UXWsgWL2M=
+Address = 10.66.127.32/32,fc00:bbbb:bbbb:bb01::3:7f1f/128
+DNS = 10.64.0.1
+
+[Peer]
+PublicKey = 7ncQXMKpxdDMa7VZpEFWivpYpsFNcYd5JSpNkWnLhGQ=
+AllowedIPs = 0.0.0.0/0,::0/0
+Endpoint = 185.213.{hi}.{lo}:51820
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=10000, help='number of config files')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for no in range(args.number):
+            with open(f'{tmp_dir}/de{no}-wireguard.conf', 'w') as fp:
+                fp.write(CONFIG.format(hi=no // 256 % 256, lo=no % 256))
+
+        start = time.perf_counter()
+        configs = wgconfig.read_configs([tmp_dir])
+        duration = time.perf_counter() - start
+
+    assert len(configs) == args.number
+    print(f'{len(configs)} configs parsed in {duration * 1000:.1f} ms '
+          f'({duration / len(configs) * 1e6:.1f} us/config)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Benchmark of VPN servers: connect time, handshake time, latency and throughput.
+
+Each server is connected in turn (for several rounds, so servers are compared
+under the same conditions) and measured:
+
+    connect     seconds until 'wg-quick up' finished, i.e. the interface is up
+    handshake   seconds from starting to connect until the first handshake
+    latency     seconds per TCP connect to the target host (one sample per ping)
+    throughput  bytes per second downloading the target URL
+
+Results are summarized per server by percentiles, for writing them as JSON
+or CSV and tracking them over time.
+"""
+import csv
+import json
+import time
+import socket
+import logging
+import urllib.parse
+from typing import Callable, Dict, Iterable, List, TextIO
+
+from mozvpn import defaults, monitor, wireguard
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = defaults.BENCH_URL
+DEFAULT_PINGS = defaults.BENCH_PINGS
+DEFAULT_ROUNDS = defaults.BENCH_ROUNDS
+PERCENTILES = (50, 95, 99)
+METRICS = ('connect', 'handshake', 'latency', 'throughput')
+# Seconds to wait for the first handshake, and between checking for it:
+HANDSHAKE_TIMEOUT = 10
+HANDSHAKE_POLL_INTERVAL = 0.05
+# Seconds to wait for the target to answer:
+TARGET_TIMEOUT = 10
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Return percentile of values, interpolating linearly between the closest ranks."""
+    values = sorted(values)
+    pos = (len(values) - 1) * pct / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def summarize(values: List[float]) -> Dict:
+    """Return number of values and their percentiles, e.g. {'n': 10, 'p50': 0.1, 'p95': 0.2, 'p99': 0.3}."""
+    summary = {'n': len(values)}
+    for pct in PERCENTILES:
+        summary[f'p{pct}'] = percentile(values, pct) if values else None
+    return summary
+
+
+def target_address(url: str):
+    """Return (host, port) of URL."""
+    parts = urllib.parse.urlsplit(url)
+    return parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+def tcp_latencies(host: str, port: int, count: int = DEFAULT_PINGS) -> List[float]:
+    """Return durations of count TCP connects to host, in seconds; failed connects are left out."""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            socket.create_connection((host, port), timeout=TARGET_TIMEOUT).close()
+        except OSError as exc:
+            logger.warning('Connecting to %s:%d failed: %s', host, port, exc)
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def download_throughput(url: str) -> float:
+    """Download URL via a new connection, return bytes per second.
+
+    Raises:
+        OSError if the download failed.
+    """
+    # Only imported when used, like requests in httpclient:
+    import urllib.request
+
+    start = time.perf_counter()
+    size = 0
+    with urllib.request.urlopen(url, timeout=TARGET_TIMEOUT) as response:
+        while True:
+            chunk = response.read(65536)
+            if not chunk:
+                break
+            size += len(chunk)
+    return size / (time.perf_counter() - start)
+
+
+def time_to_handshake(iface: str, trigger: Callable[[], None], start: float,
+                      timeout: float = HANDSHAKE_TIMEOUT) -> float:
+    """Return seconds from 'start' (a time.perf_counter() value) until the first
+    handshake of the interface's peer, or None if there was none within timeout.
+
+    Wireguard only does a handshake when sending, so trigger() is called to
+    send a packet through the tunnel before each check.
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        trigger()
+        stats = monitor.read_peer_stats(iface)
+        if stats and stats.latest_handshake:
+            return time.perf_counter() - start
+        time.sleep(HANDSHAKE_POLL_INTERVAL)
+    return None
+
+
+def bench_server(server: str, url: str = DEFAULT_URL, pings: int = DEFAULT_PINGS, backend=wireguard) -> Dict:
+    """Connect to server, measure it, and disconnect again.
+
+    Args:
+        server: interface name of the server
+        url: target to measure latency and throughput against
+        pings: number of latency samples
+        backend: module wireguard or a daemon client, see daemon.backend()
+    Returns:
+        {'server': ..., 'connect': seconds, 'handshake': seconds, 'latency': [seconds, ...],
+         'throughput': bytes per second}; failed measurements are None.
+    """
+    host, port = target_address(url)
+    # Resolve the target before connecting, so DNS lookups are not measured:
+    ip = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)[0][4][0]
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    sample = {'server': server}
+    start = time.perf_counter()
+    backend.connect(server)
+    try:
+        sample['connect'] = time.perf_counter() - start
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sample['handshake'] = time_to_handshake(
+                wireguard.interface(), lambda: sock.sendto(b'mozvpn', (ip, port)), start
+            )
+        sample['latency'] = tcp_latencies(ip, port, pings)
+        try:
+            sample['throughput'] = download_throughput(url)
+        except OSError as exc:
+            logger.warning('Downloading %s via %s failed: %s', url, server, exc)
+            sample['throughput'] = None
+    finally:
+        backend.disconnect(server)
+    return sample
+
+
+def run(servers: Iterable[str], url: str = DEFAULT_URL, rounds: int = DEFAULT_ROUNDS,
+        pings: int = DEFAULT_PINGS, backend=wireguard) -> List[Dict]:
+    """Benchmark servers, one after the other, for several rounds.
+
+    Returns:
+        samples as returned by bench_server(), with key 'round' added.
+    """
+    samples = []
+    for round_no in range(1, rounds + 1):
+        for server in servers:
+            logger.info('Round %d: benchmarking %s', round_no, server)
+            samples.append(dict(bench_server(server, url=url, pings=pings, backend=backend), round=round_no))
+    return samples
+
+
+def summarize_samples(samples: List[Dict]) -> Dict[str, Dict[str, Dict]]:
+    """Return summary of each metric per server, see summarize().
+
+    Returns:
+        {'de4-wireguard': {'connect': {'n': 3, 'p50': 0.8, ...}, 'latency': {...}, ...}, ...}
+    """
+    values = {}
+    for sample in samples:
+        server_values = values.setdefault(sample['server'], {metric: [] for metric in METRICS})
+        for metric in METRICS:
+            value = sample.get(metric)
+            if isinstance(value, list):
+                server_values[metric].extend(value)
+            elif value is not None:
+                server_values[metric].append(value)
+    return {server: {metric: summarize(metric_values) for metric, metric_values in server_values.items()}
+            for server, server_values in values.items()}
+
+
+def write_json(fp: TextIO, samples: List[Dict]):
+    """Write summary and samples as JSON."""
+    json.dump({'time': time.time(), 'summary': summarize_samples(samples), 'samples': samples}, fp, indent=2)
+    fp.write('\n')
+
+
+def write_csv(fp: TextIO, samples: List[Dict]):
+    """Write summary as CSV, one row per server and metric."""
+    fieldnames = ['server', 'metric', 'n'] + [f'p{pct}' for pct in PERCENTILES]
+    writer = csv.DictWriter(fp, fieldnames)
+    writer.writeheader()
+    for server, metrics in summarize_samples(samples).items():
+        for metric, summary in metrics.items():
+            writer.writerow(dict(summary, server=server, metric=metric))
@@ -0,0 +1,224 @@
+"""Catalog of VPN servers, indexed by their geographic location."""
+import csv
+import math
+import heapq
+import random
+import difflib
+import logging
+import unicodedata
+from array import array
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from mozvpn import defaults, latency, snapshot, wireguard
+
+logger = logging.getLogger(__name__)
+
+LOCATION_FIELDS = ('country', 'region', 'city')
+INDEX_FIELDS = ('interface',) + LOCATION_FIELDS
+# Policies for choosing one out of several servers matching a location:
+RANK_POLICIES = defaults.RANK_POLICIES
+# Minimum similarity (0..1) for an approximately spelled location to match:
+FUZZY_CUTOFF = 0.75
+# Mean earth radius in km, for great-circle distances:
+EARTH_RADIUS = 6371.0
+# Number of nearest servers choose() picks from, if coordinates are given:
+NEAREST_CANDIDATES = 5
+
+
+def normalize(name: str) -> str:
+    """Normalize location name for case and accent insensitive comparison.
+
+    Example: 'Zürich ' -> 'zurich'
+    """
+    decomposed = unicodedata.normalize('NFKD', name.strip())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def display_name(server: Dict) -> str:
+    """Return text describing the server's location, e.g. 'DE - Hesse - Frankfurt (de4)'."""
+    # Split an interface name like 'de4-wireguard' and only show the 'de4'-part:
+    iface = server['interface'].split('-')[0]
+    return '{country} - {region} - {city} ({iface})'.format(iface=iface, **server)
+
+
+def parse_coordinates(text: str) -> Optional[Tuple[float, float]]:
+    """Return (latitude, longitude) of text like '50.1155,8.6842' (as in ipinfo's 'loc'),
+    or None if text is empty or malformed."""
+    try:
+        lat, lon = (float(value) for value in text.split(','))
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def unit_vector(lat: float, lon: float) -> Tuple[float, float, float]:
+    """Return location given in degrees as vector on the unit sphere."""
+    lat, lon = math.radians(lat), math.radians(lon)
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+
+class ServerCatalog:
+    """VPN servers with prebuilt indexes for interface, country, region and city.
+
+    Each index maps a (normalized) name to the positions of all servers with
+    that name, so resolving a location is a dictionary lookup.
+    """
+
+    def __init__(self, servers: Sequence, indexes: Dict[str, Mapping] = None, vectors: Sequence[float] = None):
+        """
+        Args:
+            servers: server records, containing keys interface, ip, country,
+                region, city, loc and display.
+            indexes: prebuilt indexes (e.g. from a snapshot), built from
+                servers if not given.
+            vectors: prebuilt unit vectors (e.g. from a snapshot), see unit_vectors().
+        """
+        self.servers = servers
+        self._vectors = vectors
+        if indexes is None:
+            indexes = {field: {} for field in INDEX_FIELDS}
+            for pos, server in enumerate(servers):
+                indexes['interface'].setdefault(server['interface'], []).append(pos)
+                for field in LOCATION_FIELDS:
+                    if server.get(field):
+                        indexes[field].setdefault(normalize(server[field]), []).append(pos)
+        self.indexes = indexes
+
+    def __len__(self):
+        return len(self.servers)
+
+    @classmethod
+    def load(cls, path: str = None) -> 'ServerCatalog':
+        """Create catalog from geolocation csv file, as written by 'mozvpn geolocate'.
+
+        If an up-to-date snapshot of the csv file exists, the catalog is
+        memory mapped from it instead of parsing the csv file.
+
+        Args:
+            path: csv file, defaults to wireguard.WIREGUARD_LOCATIONS_FILE
+        """
+        path = path or wireguard.WIREGUARD_LOCATIONS_FILE
+        try:
+            snap = snapshot.Snapshot(path)
+        except snapshot.SnapshotError as exc:
+            logger.debug('Reading %s, snapshot not usable: %s', path, exc)
+        else:
+            return cls(snap.servers, snap.indexes, snap.vectors)
+        with open(path, newline='') as fp:
+            return cls.from_records(csv.DictReader(fp))
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict]) -> 'ServerCatalog':
+        """Create catalog from location records, as written to locations.csv."""
+        servers = []
+        for record in records:
+            server = {field: record.get(field) or '' for field in snapshot.FIELDS}
+            server['display'] = display_name(server)
+            servers.append(server)
+        return cls(servers)
+
+    def write_snapshot(self, csv_path: str):
+        """Write snapshot of this catalog for the csv file it was read from."""
+        snapshot.write_snapshot(self.servers, self.indexes, self.unit_vectors(), csv_path)
+
+    def server(self, interface: str) -> Optional[Dict]:
+        """Return server record of given interface, or None if unknown."""
+        positions = self.indexes['interface'].get(interface)
+        return self.servers[positions[0]] if positions else None
+
+    def _positions(self, field: str, name: str) -> List[int]:
+        """Return positions of servers at location, tolerating approximate spellings."""
+        index = self.indexes[field]
+        key = normalize(name)
+        if key not in index:
+            close_matches = difflib.get_close_matches(key, index.keys(), n=1, cutoff=FUZZY_CUTOFF)
+            if not close_matches:
+                return []
+            logger.info('Using %s "%s" for "%s"', field, close_matches[0], name)
+            key = close_matches[0]
+        return index[key]
+
+    def _find_positions(self, country: str = None, region: str = None, city: str = None) -> Optional[List[int]]:
+        """Return sorted positions of servers matching the location, None if no location is given."""
+        positions = None
+        for field, name in zip(LOCATION_FIELDS, (country, region, city)):
+            if name:
+                matches = self._positions(field, name)
+                positions = set(matches) if positions is None else positions.intersection(matches)
+        return None if positions is None else sorted(positions)
+
+    def find(self, country: str = None, region: str = None, city: str = None) -> List[Dict]:
+        """Return all servers matching the given location, in catalog order.
+
+        Names are compared case and accent insensitively; if a name is not
+        known, the closest spelling known to the catalog is used instead.
+        """
+        positions = self._find_positions(country=country, region=region, city=city)
+        return [self.servers[pos] for pos in positions or []]
+
+    def unit_vectors(self) -> Sequence[float]:
+        """Return locations of all servers as vectors on the unit sphere,
+        i.e. x, y, z per server, NaN if its location is unknown."""
+        if self._vectors is None:
+            vectors = array('d')
+            unknown = (math.nan,) * 3
+            for server in self.servers:
+                coordinates = parse_coordinates(server.get('loc') or '')
+                vectors.extend(unit_vector(*coordinates) if coordinates else unknown)
+            self._vectors = vectors
+        return self._vectors
+
+    def nearest(self, lat: float, lon: float, k: int = 1, positions: Iterable[int] = None) -> List[Tuple[Dict, float]]:
+        """Return the k servers nearest to a location, nearest first.
+
+        The great-circle distance grows as the dot product of the unit vectors
+        of two locations shrinks, so the servers are ranked by one pass of
+        dot products over the precomputed unit vectors; only the k nearest
+        ones get their distance computed.
+
+        Args:
+            lat, lon: location in degrees
+            k: number of servers
+            positions: only consider these servers, defaults to all servers
+        Returns:
+            [(server record, distance in km), ...]; servers with unknown location are left out.
+        """
+        qx, qy, qz = unit_vector(lat, lon)
+        vectors = self.unit_vectors()
+        dots = [x * qx + y * qy + z * qz for x, y, z in zip(vectors[0::3], vectors[1::3], vectors[2::3])]
+        if positions is None:
+            positions = range(len(dots))
+        # NaN (unknown location) is the only value not equal to itself:
+        located = (pos for pos in positions if dots[pos] == dots[pos])
+        return [(self.servers[pos], EARTH_RADIUS * math.acos(max(-1.0, min(1.0, dots[pos]))))
+                for pos in heapq.nlargest(k, located, key=dots.__getitem__)]
+
+    def choose(self, country: str = None, region: str = None, city: str = None,
+               policy: str = 'first', near: Sequence[float] = None) -> Optional[Dict]:
+        """Return one server matching the given location, chosen by ranking policy.
+
+        Args:
+            country, region, city: location, see find()
+            policy: one of RANK_POLICIES
+            near: (latitude, longitude); if given, the NEAREST_CANDIDATES servers
+                nearest to it (and matching the location) are candidates, nearest first.
+        Returns:
+            server record, or None if no server matches.
+        """
+        if near:
+            positions = self._find_positions(country=country, region=region, city=city)
+            candidates = [server for server, _ in self.nearest(*near, k=NEAREST_CANDIDATES, positions=positions)]
+        else:
+            candidates = self.find(country=country, region=region, city=city)
+        if not candidates:
+            return None
+        if policy == 'random':
+            return random.choice(candidates)
+        if policy == 'fastest':
+            ranked = latency.rank_servers([server for server in candidates if server['ip']])
+            if ranked:
+                return self.server(ranked[0]['interface'])
+            logger.warning('No server responded to latency probes, using the first one')
+        return candidates[0]
@@ -1,11 +1,20 @@
-"""Console script for mozvpn."""
+"""Console script for mozvpn.
+
+Commands like 'mozvpn status' are called very often (e.g. by status bars),
+so only modules needed by all commands are imported here. All others, like
+the Qt GUI, the daemon client or the geolocation machinery, are imported by
+the commands using them; the option defaults come from module defaults. See
+benchmarks/bench_import.py.
+"""
 import os
 import sys
 import csv
+import time
 import click
+import getpass
 import logging
 
-from mozvpn import mozvpn, mozvpn_gui, wireguard
+from mozvpn import defaults, metrics, wireguard
 
 logger = logging.getLogger('mozvpn')
 logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
@@ -13,41 +22,181 @@ logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
+@click.option('--metrics', 'metrics_path', type=click.Path(dir_okay=False), envvar='MOZVPN_METRICS',
+              help='On exit, write timings and outcomes of commands and HTTP requests to this file, as JSON '
+                   'if it ends with ".json", otherwise in Prometheus textfile format. Defaults to $MOZVPN_METRICS.')
 @click.group(context_settings=CONTEXT_SETTINGS)
-def main():
-    ...
+@click.pass_context
+def main(ctx, metrics_path):
+    if metrics_path:
+        ctx.call_on_close(lambda: _write_metrics(metrics_path))
+
+
+def _write_metrics(path):
+    """Write metrics of this process to path, see metrics.Registry.write()."""
+    try:
+        metrics.write(path)
+    except OSError as exc:
+        print(f'Error: cannot write metrics: {exc}', file=sys.stderr)
+
+
+def _positive(ctx, param, value):
+    """Reject values <= 0 (click.FloatRange only excludes its bounds since Click 8)."""
+    if value <= 0:
+        raise click.BadParameter(f'{value} is not greater than 0.')
+    return value
+
+
+def _resolve_location(backend, country, region, city, policy, near=None):
+    """Return interface of a server at the given location, or exit with an error."""
+    from mozvpn import catalog
+
+    try:
+        if backend is wireguard:
+            server = catalog.ServerCatalog.load().choose(country=country, region=region, city=city, policy=policy, near=near)
+        else:
+            # The daemon keeps the catalog loaded:
+            server = backend.choose(country=country, region=region, city=city, policy=policy, near=near)
+    except OSError as exc:
+        print(f'Error: cannot read server locations: {exc}\nDid you run "mozvpn setup"?', file=sys.stderr)
+        sys.exit(1)
+    if not server:
+        print('Error: no server found at this location', file=sys.stderr)
+        sys.exit(1)
+    return server['interface']
+
+
+def _nearest_coordinates(backend, nearest: str):
+    """Return (latitude, longitude) given as 'LAT,LON', or located via the
+    external IP address for 'auto', or exit with an error."""
+    from mozvpn import catalog
+
+    if nearest != 'auto':
+        coordinates = catalog.parse_coordinates(nearest)
+        if not coordinates:
+            print('Error: --nearest requires coordinates like "50.11,8.68" or "auto"', file=sys.stderr)
+            sys.exit(2)
+        return coordinates
+    try:
+        info = backend.external_ip()
+    except OSError as exc:
+        print(f'Error: cannot determine your location: {exc}', file=sys.stderr)
+        sys.exit(1)
+    # ipinfo.io answers with 'loc', Mullvad with 'latitude' and 'longitude':
+    coordinates = catalog.parse_coordinates(info.get('loc') or f'{info.get("latitude")},{info.get("longitude")}')
+    if not coordinates:
+        print('Error: cannot determine your location from your ip address', file=sys.stderr)
+        sys.exit(1)
+    return coordinates
 
 
 @click.option('-c', '--city')
 @click.option('-C', '--country')
 @click.option('-r', '--region')
-@click.argument('conf_or_interface')
+@click.option('-n', '--nearest', metavar='LAT,LON|auto',
+              help='Choose among the servers nearest to these coordinates, or to the location of '
+                   'your ip address ("auto").')
+@click.option('-p', '--pick', type=click.Choice(defaults.RANK_POLICIES), default='first', show_default=True,
+              help='How to choose among several servers at the given location.')
+@click.argument('conf_or_interface', required=False)
 @main.command()
-def up(city, country, region, conf_or_interface):
-    """Setup connection to VPN server location or interface."""
-    #
-    # TODO: Allow to connect by city/country/region
-    #
-    iface = wireguard.interface()
-    if iface:
-        print(f'Error: already connected to {iface}')
-    elif conf_or_interface:
-        wireguard.connect(conf_or_interface)
-        print(f'Connected to: {conf_or_interface}')
+def up(city, country, region, nearest, pick, conf_or_interface):
+    """Setup connection to VPN server location or interface.
+
+    Instead of a config file or interface a location can be given by
+    city, country (code) and/or region, e.g. 'mozvpn up -C de -c berlin',
+    or by coordinates, e.g. 'mozvpn up --nearest auto'.
+    """
+    from mozvpn import daemon
+
+    if not (conf_or_interface or city or country or region or nearest):
+        print('Error: either a config file, interface or location is required', file=sys.stderr)
+        sys.exit(2)
+    backend = daemon.backend()
+    try:
+        iface = backend.active_server()
+        if iface:
+            print(f'Error: already connected to {iface}')
+            return
+        if not conf_or_interface:
+            near = _nearest_coordinates(backend, nearest) if nearest else None
+            conf_or_interface = _resolve_location(backend, country, region, city, pick, near=near)
+        backend.connect(conf_or_interface)
+    except (OSError, daemon.DaemonError) as exc:
+        print(f'Error: cannot connect: {exc}', file=sys.stderr)
+        sys.exit(1)
+    print(f'Connected to: {conf_or_interface}')
 
 
 @click.option('-c', '--city')
 @click.option('-C', '--country')
 @click.option('-r', '--region')
-@click.argument('conf_or_interface')
+@click.argument('conf_or_interface', required=False)
 @main.command()
 def down(city, country, region, conf_or_interface):
-    """Shutdown currently active VPN server connection."""
-    if not wireguard.interface():
+    """Shutdown currently active VPN server connection.
+
+    Without arguments the active connection is shut down. If a location is
+    given, the connection is only shut down if its server is at that location.
+    """
+    from mozvpn import catalog, daemon
+
+    backend = daemon.backend()
+    try:
+        iface = backend.active_server()
+    except (OSError, daemon.DaemonError) as exc:
+        print(f'Error: cannot determine connection: {exc}', file=sys.stderr)
+        sys.exit(1)
+    if not iface:
         print('Error: not connected')
-    elif conf_or_interface:
-        wireguard.disconnect(conf_or_interface)
-        print(f'Disconnected from: {conf_or_interface}')
+        return
+    if not conf_or_interface:
+        if city or country or region:
+            try:
+                server_catalog = catalog.ServerCatalog.load()
+            except OSError as exc:
+                print(f'Error: cannot read server locations: {exc}', file=sys.stderr)
+                sys.exit(1)
+            matching = server_catalog.find(country=country, region=region, city=city)
+            if iface not in {server['interface'] for server in matching}:
+                print(f'Error: connected to {iface}, which is not at this location')
+                return
+        conf_or_interface = iface
+    try:
+        backend.disconnect(conf_or_interface)
+    except (OSError, daemon.DaemonError) as exc:
+        print(f'Error: cannot disconnect: {exc}', file=sys.stderr)
+        sys.exit(1)
+    print(f'Disconnected from: {conf_or_interface}')
+
+
+@click.argument('interface')
+@main.command()
+def switch(interface):
+    """Switch the active VPN connection to another server.
+
+    The running wireguard interface is kept and only its peer is replaced,
+    so routes and DNS settings stay in place. If the servers differ in more
+    than their peer, the connection is shut down and set up again.
+    """
+    from mozvpn import daemon
+
+    backend = daemon.backend()
+    try:
+        iface = backend.active_server()
+        if not iface:
+            print('Error: not connected')
+            return
+        if iface == interface:
+            print(f'Already connected to: {interface}')
+            return
+        start = time.monotonic()
+        method = backend.switch(interface)
+    except (OSError, daemon.DaemonError) as exc:
+        print(f'Error: cannot switch: {exc}', file=sys.stderr)
+        sys.exit(1)
+    duration = (time.monotonic() - start) * 1000
+    print(f'Switched to: {interface} ({"peer replaced" if method == "peer" else "reconnected"} in {duration:.0f} ms)')
 
 
 @click.option('--ip', is_flag=True)
@@ -58,22 +207,176 @@ def status(ip):
     Args:
         ip: If True, the externally visible IP address will also be returned.
     """
+    from mozvpn import daemon
+
     try:
-        print(wireguard.status(ip=ip))
-    except RuntimeError as exc:
+        print(daemon.backend().status(ip=ip))
+    except (RuntimeError, OSError) as exc:
         print(str(exc), file=sys.stderr)
         sys.exit(1)
 
 
+@click.option('--refresh', is_flag=True, default=False,
+              help='Look up the address again, even if it is cached for the active connection.')
+@main.command()
+def ip(refresh):
+    """Show externally visible ip address.
+
+    The address is cached until the connection changes, and looked up
+    via several providers at once, taking the fastest answer.
+    """
+    from mozvpn import daemon
+
+    try:
+        print(daemon.backend().external_ip(refresh=refresh)['ip'])
+    except OSError as exc:
+        print(f'Error: cannot determine ip address: {exc}', file=sys.stderr)
+        sys.exit(1)
+
+
+@click.option('-t', '--timeout', default=defaults.LATENCY_TIMEOUT, show_default=True,
+              help='Seconds to wait for probe answers.')
+@click.option('-n', '--top', default=10, show_default=True,
+              help='Number of servers to list. A value of 0 lists all responding servers.')
+@click.option('-p', '--port', type=int,
+              help='Probe this UDP port instead of sending ICMP echo requests.')
+@click.option('--connect', is_flag=True, default=False,
+              help='Connect to the fastest server.')
 @main.command()
-def ip():
-    """Show externally visible ip address."""
-    print(wireguard.ipinfo()['ip'])
+def fastest(timeout, top, port, connect):
+    """Find VPN servers with the lowest latency.
+
+    All configured server endpoints are probed in parallel and listed by
+    their round-trip time, fastest first.
+    """
+    from mozvpn import daemon, latency, wgconfig
+
+    try:
+        servers = latency.configured_endpoints()
+    except (OSError, wgconfig.ConfigError) as exc:
+        print(f'Error: cannot read server configurations: {exc}', file=sys.stderr)
+        sys.exit(1)
+    ranked = latency.rank_servers(servers, timeout=timeout, port=port)
+    if not ranked:
+        print('Error: no server responded', file=sys.stderr)
+        sys.exit(1)
+    for server in ranked[:top or None]:
+        print(f'{server["interface"]:<20} {server["latency"] * 1000:8.1f} ms')
+    if connect:
+        backend = daemon.backend()
+        iface = backend.active_server()
+        if iface:
+            print(f'Error: already connected to {iface}')
+        else:
+            backend.connect(ranked[0]['interface'])
+            print(f'Connected to: {ranked[0]["interface"]}')
+
+
+@click.option('--failover', type=click.Choice(defaults.FAILOVER_POLICIES), default='country', show_default=True,
+              help='Fail over to the next server of the same country, or to the fastest server.')
+@click.option('--handshake-timeout', default=defaults.HANDSHAKE_TIMEOUT, show_default=True,
+              help='Seconds without handshake while sending, before failing over.')
+@click.option('--rx-stall-timeout', default=defaults.RX_STALL_TIMEOUT, show_default=True,
+              help='Seconds without receiving anything while sending, before failing over.')
+@click.option('-i', '--interval', default=defaults.MONITOR_INTERVAL, show_default=True,
+              help='Seconds between checks.')
+@click.option('--cooldown', default=defaults.COOLDOWN, show_default=True,
+              help='Seconds to wait after a failover before checking the new server.')
+@main.command(name='monitor')
+def monitor_(failover, handshake_timeout, rx_stall_timeout, interval, cooldown):
+    """Monitor the VPN connection and fail over to another server if it degrades.
+
+    The connection is degraded if data is sent, but the server does not answer
+    (no handshake, or nothing received) within the given timeouts.
+    """
+    from mozvpn import daemon, monitor
+
+    logger.setLevel(logging.INFO)
+    tracker = monitor.HealthTracker(handshake_timeout=handshake_timeout, rx_stall_timeout=rx_stall_timeout)
+    health_monitor = monitor.Monitor(daemon.backend(), policy=failover, tracker=tracker,
+                                     interval=interval, cooldown=cooldown)
+    try:
+        health_monitor.run()
+    except KeyboardInterrupt:
+        pass
+
+
+@click.option('-i', '--interval', type=float, default=defaults.STATS_INTERVAL, show_default=True, callback=_positive,
+              help='Seconds between samples.')
+@click.option('-w', '--window', type=float, default=defaults.STATS_WINDOW, show_default=True, callback=_positive,
+              help='Seconds covered by the moving averages.')
+@click.option('-n', '--count', default=0,
+              help='Number of lines to print. A value of 0 prints until interrupted.')
+@main.command(name='stats')
+def stats_(interval, window, count):
+    """Show throughput of the active VPN connection.
+
+    Every interval the current and average (over the window) receive and
+    send rates are printed, followed by the total bytes transferred.
+    """
+    from mozvpn import stats
+
+    sampler = stats.Sampler(capacity=max(stats.DEFAULT_CAPACITY, int(window / interval) + 2), window=window)
+    printed = 0
+    try:
+        while True:
+            if not sampler.sample():
+                print('Error: not connected', file=sys.stderr)
+                sys.exit(1)
+            rates = sampler.rates()
+            if rates:
+                print(f'{rates["interface"]}  '
+                      f'rx {stats.format_rate(rates["rx_rate"]):>10} (avg {stats.format_rate(rates["rx_avg"]):>10})  '
+                      f'tx {stats.format_rate(rates["tx_rate"]):>10} (avg {stats.format_rate(rates["tx_avg"]):>10})  '
+                      f'total rx {stats.format_bytes(rates["rx_bytes"])}, tx {stats.format_bytes(rates["tx_bytes"])}')
+                printed += 1
+                if printed == count:
+                    break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+@click.argument('servers', nargs=-1, required=True)
+@click.option('-u', '--url', default=defaults.BENCH_URL, show_default=True,
+              help='Target downloaded for measuring throughput; latency is measured against its host.')
+@click.option('-r', '--rounds', default=defaults.BENCH_ROUNDS, show_default=True,
+              help='Number of times each server is connected.')
+@click.option('-p', '--pings', default=defaults.BENCH_PINGS, show_default=True,
+              help='Number of latency samples per server and round.')
+@click.option('-f', '--format', 'output_format', type=click.Choice(['json', 'csv']), default='json', show_default=True)
+@click.option('-o', '--output', type=click.File('w'), default='-')
+@main.command(name='bench')
+def bench_(servers, url, rounds, pings, output_format, output):
+    """Benchmark connect time, handshake time, latency and throughput of servers.
+
+    The servers are connected one after the other, so no VPN connection may
+    be active. Percentiles per server are written as JSON (with all samples)
+    or CSV.
+    """
+    from mozvpn import bench, daemon
+
+    backend = daemon.backend()
+    iface = backend.active_server()
+    if iface:
+        print(f'Error: already connected to {iface}', file=sys.stderr)
+        sys.exit(1)
+    try:
+        samples = bench.run(servers, url=url, rounds=rounds, pings=pings, backend=backend)
+    except (OSError, ValueError, wireguard.CommandError) as exc:
+        print(f'Error: benchmark failed: {getattr(exc, "msg", exc)}', file=sys.stderr)
+        sys.exit(1)
+    if output_format == 'json':
+        bench.write_json(output, samples)
+    else:
+        bench.write_csv(output, samples)
 
 
 @main.command()
 def gui():
     """Start graphical user interface for mozvpn."""
+    from mozvpn import mozvpn_gui
+
     try:
         mozvpn_gui.gui()
     except wireguard.ControlledExit:
@@ -81,19 +384,98 @@ def gui():
 
 
 @click.argument('config_paths', nargs=-1)
-@click.option('-o', '--output', type=click.File('w'), default='-')
+@click.option('-o', '--output', type=click.Path(dir_okay=False, allow_dash=True), default='-')
+@click.option('-u', '--update', is_flag=True, default=False,
+              help='Reuse the locations in the existing output file, only look up new servers '
+                   'and those whose endpoint changed.')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=defaults.JOBS, show_default=True,
+              help='Number of concurrent geolocation lookups.')
+@click.option('--refresh', is_flag=True, default=False,
+              help='Look up all locations again, ignoring the local geolocation cache.')
+@click.option('--offline', is_flag=True, default=False,
+              help='Determine locations from a local IP-range database instead of ipinfo.io.')
+@click.option('--ip-db', type=click.Path(dir_okay=False),
+              help='IP-range database used with --offline.  [default: ~/.local/share/mozvpn/ip-ranges.csv]')
+@click.option('-b', '--batch-size', default=0,
+              help='Look up this many addresses per request via the ipinfo.io batch API. '
+                   'A value of 0 disables batch requests.')
+@click.option('--token', envvar='IPINFO_TOKEN',
+              help='ipinfo.io access token, e.g. for batch requests. Defaults to $IPINFO_TOKEN.')
 @main.command()
-def geolocate(config_paths, output):
+def geolocate(config_paths, output, update, jobs, refresh, offline, ip_db, batch_size, token):
     """Determine geographic location for server configurations.
 
     Write the csv-formatted vpn geo-information to output file, or to stdout,
     if 'output' was not provided or is a dash ('-').
+    Locations are cached locally, so known servers are not looked up again.
+    With --update the output file is replaced atomically once all locations
+    are known, otherwise rows are written as soon as they are resolved.
+    """
+    from mozvpn import catalog, mozvpn, relays
+    from mozvpn.geocache import GeoCache
+    from mozvpn.ipdb import IPRangeDatabase
+
+    if update and output == '-':
+        print('Error: --update requires an output file (-o)', file=sys.stderr)
+        sys.exit(1)
+    # With --refresh all locations are looked up again anyway:
+    known = relays.read_locations(output) if update and not refresh else None
+    if offline:
+        try:
+            ip_range_db = IPRangeDatabase(ip_db)
+        except RuntimeError as exc:
+            print(str(exc), file=sys.stderr)
+            sys.exit(1)
+        cache = None
+        vpn_configs = mozvpn.iter_vpn_server_locations(config_paths, jobs=1, locate=ip_range_db.locate, known=known)
+    else:
+        cache = GeoCache()
+        vpn_configs = mozvpn.iter_vpn_server_locations(
+            config_paths, jobs=jobs, cache=cache, refresh=refresh, batch_size=batch_size, token=token, known=known
+        )
+    if update:
+        # Merge into a file next to the output file and rename it when done, so readers never see a partial file:
+        tmp_path = os.path.join(os.path.dirname(os.path.abspath(output)), f'.{os.path.basename(output)}.tmp')
+        fp = open(tmp_path, 'w', newline='')
+    else:
+        tmp_path = None
+        fp = click.open_file(output, 'w')
+    try:
+        # stdout is kept open by click:
+        with fp:
+            writer = csv.DictWriter(fp, mozvpn.LOCATIONS_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            # Write rows as soon as they are resolved, so progress is visible and
+            # an interrupted run keeps the rows written so far:
+            for vpn_config in vpn_configs:
+                writer.writerow(vpn_config)
+                fp.flush()
+    except BaseException:
+        if tmp_path:
+            os.unlink(tmp_path)
+        raise
+    else:
+        if tmp_path:
+            os.replace(tmp_path, output)
+    finally:
+        if cache is not None and cache.modified:
+            cache.save()
+    if output != '-':
+        # Write binary snapshot of the server catalog next to the csv file, for fast loading:
+        with open(output, newline='') as fp:
+            catalog.ServerCatalog.from_records(csv.DictReader(fp)).write_snapshot(output)
+
+
+def _login_user() -> str:
+    """Return name of the logged in user.
+
+    os.getlogin() fails for processes without a controlling terminal (e.g.
+    cron jobs or CI runners), then the user is derived from the environment.
     """
-    vpn_configs = mozvpn.find_vpn_server_locations(config_paths)
-    fieldnames = ['interface', 'ip', 'country', 'region', 'city']
-    writer = csv.DictWriter(output, fieldnames, extrasaction='ignore')
-    writer.writeheader()
-    writer.writerows(vpn_configs)
+    try:
+        return os.getlogin()
+    except OSError:
+        return getpass.getuser()
 
 
 @click.option('--verbose', '-v', is_flag=True, default=False)
@@ -101,12 +483,15 @@ def geolocate(config_paths, output):
               help='Limit the number of servers saved. A value of 0 disables this limit.')
 @click.option('--dry-run', '-m', is_flag=True, default=False,
               help='Print all commands to the shell without executing them.')
-@click.option('--user', '-u', default=os.getlogin())
+@click.option('--user', '-u', help='User owning the configuration.  [default: the logged in user]')
+@click.option('--incremental', '-i', is_flag=True, default=False,
+              help='Only geolocate and install relays which are new or changed since the last setup.')
 @main.command()
-def setup(user, dry_run, verbose, limit):
+def setup(user, dry_run, verbose, limit, incremental):
     """Setup the configuration necessary to run MozillaVPN"""
     try:
-        wireguard.setup_wireguard_configuration(user, verbose, dry_run, limit)
+        user = user or _login_user()
+        wireguard.setup_wireguard_configuration(user, verbose, dry_run, limit, incremental=incremental)
     except RuntimeError as exc:
         print(str(exc), file=sys.stderr)
         sys.exit(1)
@@ -118,11 +503,38 @@ def setup(user, dry_run, verbose, limit):
 def xmozvpn():
     """Start graphical user interface for mozvpn."""
     # This is an alternative for 'mozvpn gui' above.
+    from mozvpn import mozvpn_gui
+
     try:
         mozvpn_gui.gui()
     except wireguard.ControlledExit:
         sys.exit(1)
 
 
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False),
+              help='Control socket.  [default: $XDG_RUNTIME_DIR/mozvpn-UID/mozvpnd.sock]')
+# Not $MOZVPN_METRICS, since every mozvpn run would overwrite the daemon's file with the metrics of one command:
+@click.option('--metrics', 'metrics_path', type=click.Path(dir_okay=False), envvar='MOZVPND_METRICS',
+              help='Write timings and outcomes of commands and HTTP requests to this file periodically, as JSON '
+                   'if it ends with ".json", otherwise in Prometheus textfile format. Defaults to $MOZVPND_METRICS.')
+@click.option('--verbose', '-v', is_flag=True, default=False)
+@click.command(context_settings=CONTEXT_SETTINGS)
+def mozvpnd(socket_path, metrics_path, verbose):
+    """Run the mozvpn daemon.
+
+    While it is running, mozvpn and the GUI control the VPN through it, which
+    keeps the connection state, the server catalog and HTTP connections.
+    """
+    from mozvpn import daemon
+
+    if verbose:
+        logger.setLevel(logging.INFO)
+    try:
+        daemon.serve(socket_path, metrics_path=metrics_path)
+    except daemon.DaemonError as exc:
+        print(f'Error: {exc}', file=sys.stderr)
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
@@ -0,0 +1,414 @@
+"""Optional mozvpn daemon, controlled via a Unix socket.
+
+The daemon (started via 'mozvpnd') keeps the state of the VPN connection,
+the server catalog and the HTTP session in memory. The CLI and the GUI use
+it when it is running, so they neither start 'sudo'/'wg' processes to find
+out the state nor disagree about it. The cached connection state is
+invalidated by the kernel's link notifications, see netwatch.LinkMonitor.
+
+Protocol: every request is a line of JSON, e.g.
+
+    {"command": "switch", "args": {"server": "nl2-wireguard"}}
+
+answered by a line of JSON containing either the result or the error:
+
+    {"result": "peer"}
+    {"error": "Not connected", "type": "WireguardError"}
+"""
+import os
+import sys
+import json
+import time
+import select
+import signal
+import socket
+import logging
+import pathlib
+import threading
+import socketserver
+from typing import Dict, Optional
+
+from mozvpn import metrics, wireguard
+from mozvpn.netwatch import LinkMonitor
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the daemon's answer when checking whether it is running:
+PING_TIMEOUT = 1.0
+# Seconds to wait for the answer to queries, i.e. commands not changing the
+# connection, more than their slowest step (looking up the external IP address) takes:
+CALL_TIMEOUT = wireguard.IP_LOOKUP_TIMEOUT + 15
+# Seconds for which backend() remembers whether the daemon is running:
+BACKEND_CACHE_TTL = 10
+# Seconds between writing metrics, if enabled (node_exporter's textfile collector reads them on every scrape):
+METRICS_INTERVAL = 15
+# Commands accepted by the daemon, i.e. the methods of Daemon callable by clients:
+COMMANDS = ('ping', 'interface', 'active_server', 'status', 'ipinfo', 'external_ip', 'choose', 'connect', 'disconnect', 'switch', 'cancel')
+# Exceptions passed on to clients, which are raised again there (subclasses first):
+ERRORS = {exc.__name__: exc for exc in (
+    wireguard.WireguardError, wireguard.CommandCancelled, wireguard.CommandError, OSError, RuntimeError
+)}
+
+
+class DaemonError(Exception):
+    """Raised when the daemon cannot be started, or failed to process a request."""
+
+
+def socket_path() -> pathlib.Path:
+    """Return path of the daemon's control socket."""
+    return wireguard.runtime_dir() / 'mozvpnd.sock'
+
+
+class Daemon:
+    """VPN connection state and the operations on it, shared by all clients.
+
+    Requests are handled concurrently, so status queries are answered while
+    a connection is set up. Commands changing the connection run one after
+    the other.
+    """
+
+    def __init__(self):
+        self.cancel_event = threading.Event()
+        self._command_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._generation = 0
+        self._server = None
+        self._server_cached = False
+        self._catalog = None
+        self._catalog_mtime = None
+        try:
+            self.link_monitor = LinkMonitor()
+        except OSError as exc:
+            logger.info('Link notifications not available (%s), connection state is not cached.', exc)
+            self.link_monitor = None
+        else:
+            threading.Thread(target=self._watch_links, daemon=True).start()
+
+    def _watch_links(self):
+        link_monitor = self.link_monitor
+        while True:
+            select.select([link_monitor], [], [])
+            try:
+                changed = link_monitor.changed()
+            except OSError as exc:
+                logger.warning('Link notifications failed (%s), connection state is not cached any more.', exc)
+                # Without link notifications active_server() asks wireguard every time:
+                with self._state_lock:
+                    self.link_monitor = None
+                self.invalidate()
+                link_monitor.close()
+                return
+            if changed:
+                self.invalidate()
+
+    def invalidate(self):
+        """Forget the cached connection state."""
+        with self._state_lock:
+            self._generation += 1
+            self._server_cached = False
+
+    def handle(self, request: Dict) -> Dict:
+        """Process a request, return the response."""
+        try:
+            command = request['command']
+            if command not in COMMANDS:
+                raise DaemonError(f'Unknown command "{command}"')
+            return {'result': getattr(self, command)(**request.get('args', {}))}
+        except tuple(ERRORS.values()) as exc:
+            exc_type = next(name for name, exc_class in ERRORS.items() if isinstance(exc, exc_class))
+            return {'error': str(exc), 'type': exc_type, 'cmd': getattr(exc, 'cmd', None)}
+        except Exception as exc:
+            logger.exception('Processing request %s failed', request)
+            return {'error': str(exc), 'type': DaemonError.__name__}
+
+    def ping(self) -> bool:
+        """Tell clients that the daemon is running."""
+        return True
+
+    def interface(self) -> Optional[str]:
+        """See wireguard.interface()."""
+        return wireguard.interface()
+
+    def active_server(self) -> Optional[str]:
+        """See wireguard.active_server()."""
+        with self._state_lock:
+            if self._server_cached:
+                return self._server
+            generation = self._generation
+        server = wireguard.active_server()
+        with self._state_lock:
+            # Without link notifications changes made by other programs would go unnoticed:
+            if generation == self._generation and self.link_monitor is not None:
+                self._server = server
+                self._server_cached = True
+        return server
+
+    def status(self, ip: bool = False) -> str:
+        """See wireguard.status()."""
+        server = self.active_server()
+        return wireguard.status_text(server, self.external_ip()['ip'] if server and ip else None)
+
+    def ipinfo(self) -> Dict:
+        """See wireguard.ipinfo()."""
+        return wireguard.ipinfo()
+
+    def external_ip(self, refresh: bool = False) -> Dict:
+        """See wireguard.external_ip()."""
+        return wireguard.external_ip(refresh=refresh)
+
+    def choose(self, **location) -> Optional[Dict]:
+        """Choose server at location from the server catalog, see catalog.ServerCatalog.choose()."""
+        from mozvpn import catalog
+
+        mtime = os.stat(wireguard.WIREGUARD_LOCATIONS_FILE).st_mtime_ns
+        if self._catalog is None or mtime != self._catalog_mtime:
+            self._catalog = catalog.ServerCatalog.load()
+            self._catalog_mtime = mtime
+        server = self._catalog.choose(**location)
+        return dict(server) if server else None
+
+    def _change_connection(self, change, *args):
+        with self._command_lock:
+            self.cancel_event.clear()
+            try:
+                return change(*args, cancel=self.cancel_event)
+            finally:
+                self.invalidate()
+
+    def connect(self, conf_or_if: str):
+        """See wireguard.connect()."""
+        self._change_connection(wireguard.connect, conf_or_if)
+
+    def disconnect(self, conf_or_if: str):
+        """See wireguard.disconnect()."""
+        self._change_connection(wireguard.disconnect, conf_or_if)
+
+    def switch(self, server: str) -> str:
+        """See wireguard.switch()."""
+        return self._change_connection(wireguard.switch, server)
+
+    def cancel(self):
+        """Cancel the running connect, disconnect or switch command."""
+        self.cancel_event.set()
+
+    def close(self):
+        if self.link_monitor is not None:
+            self.link_monitor.close()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as exc:
+                response = {'error': f'Invalid request: {exc}', 'type': DaemonError.__name__}
+            else:
+                response = self.server.daemon.handle(request)
+            self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(path=None) -> socketserver.BaseServer:
+    """Create daemon listening on the control socket; serve_forever() runs it.
+
+    Raises:
+        DaemonError if another daemon is already listening on the socket, or
+        the runtime directory is not private to the user.
+    """
+    try:
+        path = pathlib.Path(path or socket_path())
+    except OSError as exc:
+        raise DaemonError(exc) from exc
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if Client(path).running():
+        raise DaemonError(f'mozvpnd is already running ({path})')
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    # Only the user may connect to the socket:
+    umask = os.umask(0o077)
+    try:
+        server = _Server(str(path), _RequestHandler)
+    finally:
+        os.umask(umask)
+    server.daemon = Daemon()
+    return server
+
+
+def _write_metrics(path, stop: threading.Event, interval: float = METRICS_INTERVAL):
+    """Write metrics to path every interval seconds until stop is set, and once more then."""
+    while True:
+        stopped = stop.wait(interval)
+        try:
+            metrics.write(path)
+        except OSError as exc:
+            logger.warning('Cannot write metrics to %s: %s', path, exc)
+        if stopped:
+            return
+
+
+def serve(path=None, metrics_path=None):
+    """Run daemon until it is terminated.
+
+    Args:
+        path: control socket, defaults to socket_path()
+        metrics_path: if given, metrics are written to this file periodically, see module metrics.
+    """
+    server = make_server(path)
+    # Clean up on 'kill' as well:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info('mozvpnd listening on %s', server.server_address)
+    stop_metrics = threading.Event()
+    if metrics_path:
+        metrics_thread = threading.Thread(target=_write_metrics, args=(metrics_path, stop_metrics), daemon=True)
+        metrics_thread.start()
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        server.daemon.close()
+        os.unlink(server.server_address)
+        if metrics_path:
+            stop_metrics.set()
+            metrics_thread.join()
+
+
+class Client:
+    """Connection to the daemon, offering the same functions as module wireguard.
+
+    Errors reported by the daemon are raised as the original exceptions, e.g.
+    wireguard.CommandError.
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or socket_path())
+
+    def _call(self, command: str, args: Dict = None, cancel: threading.Event = None, timeout: float = CALL_TIMEOUT):
+        """Send command to the daemon and return its result.
+
+        Without cancel event the answer is awaited at most timeout seconds
+        (raising socket.timeout), or without limit if timeout is None;
+        otherwise until it arrives or the daemon confirms the cancellation.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            try:
+                sock.connect(self.path)
+            except ConnectionRefusedError:
+                # The daemon is gone, let backend() check again:
+                _forget_backend()
+                raise
+            sock.sendall(json.dumps({'command': command, 'args': args or {}}).encode('utf8') + b'\n')
+            if cancel is not None:
+                sock.settimeout(wireguard.CANCEL_CHECK_INTERVAL)
+            data = b''
+            cancelled = False
+            while not data.endswith(b'\n'):
+                try:
+                    chunk = sock.recv(65536)
+                except socket.timeout:
+                    if cancel is None:
+                        raise
+                    if cancel.is_set() and not cancelled:
+                        self._call('cancel')
+                        cancelled = True
+                    continue
+                if not chunk:
+                    raise DaemonError('mozvpnd closed the connection')
+                data += chunk
+        response = json.loads(data)
+        if 'error' in response:
+            exc_class = ERRORS.get(response['type'], DaemonError)
+            if issubclass(exc_class, wireguard.CommandError):
+                raise exc_class(response['error'], response['cmd'])
+            raise exc_class(response['error'])
+        return response['result']
+
+    def running(self) -> bool:
+        """Return True if the daemon is listening on the socket."""
+        try:
+            return self._call('ping', timeout=PING_TIMEOUT)
+        except (OSError, ValueError, DaemonError):
+            return False
+
+    def interface(self) -> Optional[str]:
+        return self._call('interface')
+
+    def active_server(self) -> Optional[str]:
+        return self._call('active_server')
+
+    def status(self, ip: bool = False) -> str:
+        return self._call('status', {'ip': ip})
+
+    def ipinfo(self) -> Dict:
+        return self._call('ipinfo')
+
+    def external_ip(self, refresh: bool = False) -> Dict:
+        return self._call('external_ip', {'refresh': refresh})
+
+    def choose(self, country: str = None, region: str = None, city: str = None,
+               policy: str = 'first', near=None) -> Optional[Dict]:
+        return self._call('choose', {'country': country, 'region': region, 'city': city, 'policy': policy, 'near': near})
+
+    def connect(self, conf_or_if: str, cancel: threading.Event = None):
+        if os.path.isfile(conf_or_if):
+            # The daemon may run in another working directory:
+            conf_or_if = os.path.abspath(conf_or_if)
+        # Changing the connection may take long, e.g. while waiting for another client's change:
+        self._call('connect', {'conf_or_if': conf_or_if}, cancel=cancel, timeout=None)
+
+    def disconnect(self, conf_or_if: str, cancel: threading.Event = None):
+        if os.path.isfile(conf_or_if):
+            conf_or_if = os.path.abspath(conf_or_if)
+        self._call('disconnect', {'conf_or_if': conf_or_if}, cancel=cancel, timeout=None)
+
+    def switch(self, server: str, cancel: threading.Event = None) -> str:
+        return self._call('switch', {'server': server}, cancel=cancel, timeout=None)
+
+
+_backend_lock = threading.Lock()
+# Last result of backend(): (time of check, socket path and identity, backend)
+_backend_cache = None
+
+
+def _forget_backend():
+    global _backend_cache
+    with _backend_lock:
+        _backend_cache = None
+
+
+def backend():
+    """Return a client of the daemon if it is running, otherwise module wireguard,
+    for controlling the VPN connection directly.
+
+    The result is remembered for BACKEND_CACHE_TTL seconds, unless the socket
+    is removed or replaced, so frequent callers like the GUI do not ping the
+    daemon every time.
+    """
+    global _backend_cache
+    try:
+        client = Client()
+    except OSError as exc:
+        # Do not trust a socket in a runtime directory other users may access:
+        logger.warning('Not using mozvpnd: %s', exc)
+        return wireguard
+    try:
+        stat_result = os.stat(client.path)
+    except OSError:
+        return wireguard
+    key = (client.path, stat_result.st_dev, stat_result.st_ino)
+    with _backend_lock:
+        if _backend_cache and _backend_cache[1] == key and time.monotonic() - _backend_cache[0] < BACKEND_CACHE_TTL:
+            return _backend_cache[2]
+    result = client if client.running() else wireguard
+    with _backend_lock:
+        _backend_cache = (time.monotonic(), key, result)
+    return result
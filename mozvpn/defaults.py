@@ -0,0 +1,42 @@
+"""Defaults and choices of the command line options.
+
+The CLI declares its options with these values when it is loaded, before it
+knows which command runs, so they live in this module without imports; the
+modules implementing the commands are only imported by the commands using
+them, see benchmarks/bench_import.py.
+"""
+
+# Policies for choosing among several servers at a location, see catalog.ServerCatalog.choose():
+#   first: first server in catalog order (i.e. lowest server number)
+#   random: random server, to spread the load
+#   fastest: server with the lowest measured latency
+RANK_POLICIES = ('first', 'random', 'fastest')
+
+# Seconds to wait for answers to latency probes:
+LATENCY_TIMEOUT = 1.0
+
+# Number of concurrent requests of bulk lookups (e.g. geolocation):
+JOBS = 8
+
+# Connection health monitor, see monitor.Monitor.
+# Seconds without handshake while sending; wireguard renews its session keys
+# every 2 minutes and rejects keys older than 3 minutes:
+HANDSHAKE_TIMEOUT = 180
+# Seconds without receiving anything while sending:
+RX_STALL_TIMEOUT = 30
+# Seconds between checks:
+MONITOR_INTERVAL = 5
+# Seconds to wait after a failover before the new server is judged:
+COOLDOWN = 60
+FAILOVER_POLICIES = ('country', 'fastest')
+
+# Traffic statistics, see stats.Sampler.
+# Seconds between samples:
+STATS_INTERVAL = 1.0
+# Seconds covered by the moving average:
+STATS_WINDOW = 10.0
+
+# Server benchmarks, see bench.run():
+BENCH_URL = 'https://speed.cloudflare.com/__down?bytes=10000000'
+BENCH_PINGS = 10
+BENCH_ROUNDS = 3
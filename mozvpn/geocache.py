@@ -0,0 +1,100 @@
+"""Persistent on-disk cache for geolocation lookups of VPN server endpoints."""
+import os
+import json
+import time
+import logging
+import pathlib
+import tempfile
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Endpoint IPs of VPN servers hardly ever move, so cached locations stay
+# valid for a long time:
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def default_cache_path() -> pathlib.Path:
+    """Return path of the geolocation cache file, following the XDG conventions."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(cache_home) / 'mozvpn' / 'geolocation.json'
+
+
+class GeoCache:
+    """Location records keyed by IP address, persisted as JSON file.
+
+    Entries expire after 'ttl' seconds. When more than 'max_entries' records
+    are stored, the oldest ones are evicted on saving.
+    All methods are thread safe.
+    """
+
+    def __init__(self, path: pathlib.Path = None, ttl: float = DEFAULT_TTL,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = pathlib.Path(path) if path else default_cache_path()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.modified = False
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Load cache entries from disk, silently starting empty on any problem."""
+        try:
+            with open(self.path) as fp:
+                entries = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.warning('Ignoring unreadable geolocation cache %s: %s', self.path, exc)
+            return
+        if not isinstance(entries, dict):
+            logger.warning('Ignoring geolocation cache %s: not a JSON object', self.path)
+            return
+        with self._lock:
+            self._entries = {ip: entry for ip, entry in entries.items()
+                             if isinstance(entry, dict) and 'time' in entry and 'data' in entry}
+
+    def get(self, ip: str) -> Optional[Dict]:
+        """Return cached location of IP address, or None if unknown or expired."""
+        with self._lock:
+            entry = self._entries.get(ip)
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return dict(entry['data'])
+
+    def put(self, ip: str, data: Dict):
+        """Store location of IP address."""
+        with self._lock:
+            self._entries[ip] = {'time': time.time(), 'data': data}
+            self.modified = True
+
+    def save(self):
+        """Write cache to disk, after evicting expired and surplus entries.
+
+        The file is replaced atomically, so concurrent readers never see a
+        partially written cache.
+        """
+        now = time.time()
+        with self._lock:
+            entries = sorted(
+                ((ip, entry) for ip, entry in self._entries.items() if now - entry['time'] <= self.ttl),
+                key=lambda item: item[1]['time'], reverse=True
+            )
+            self._entries = dict(entries[:self.max_entries])
+            content = json.dumps(self._entries)
+            self.modified = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.path.parent, prefix='.geolocation')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(content)
+            os.replace(tmp_name, self.path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
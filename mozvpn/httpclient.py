@@ -0,0 +1,126 @@
+"""Shared HTTP client for all web API lookups (ipinfo.io, mullvad).
+
+All requests go through one requests.Session, so connections to the same
+host are kept alive and reused, e.g. while geolocating hundreds of endpoints.
+Every request has explicit connect and read timeouts, and failed connections
+or server errors are retried with exponential backoff plus random jitter.
+
+requests (and urllib3) are only imported when the session is first used,
+since importing them takes longer than most mozvpn commands need to run.
+"""
+import time
+import random
+import logging
+import threading
+from typing import TYPE_CHECKING
+
+from mozvpn import defaults, metrics
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
+
+# Timeouts in seconds for establishing a connection and waiting for data:
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+RETRIES = 3
+# Retry delays grow as BACKOFF_FACTOR * 2**(retry - 1), plus up to BACKOFF_JITTER seconds:
+BACKOFF_FACTOR = 0.3
+BACKOFF_JITTER = 0.3
+# Status 429 (rate limit) is not retried here, see mozvpn.RateLimitBackoff:
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+# Number of concurrent requests of bulk lookups (e.g. geolocation), see mozvpn.DEFAULT_JOBS:
+DEFAULT_JOBS = defaults.JOBS
+# Connections kept per host, should not be lower than the number of threads
+# sending requests concurrently:
+POOL_MAXSIZE = 2 * DEFAULT_JOBS
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _jittered_retry_class():
+    """Return retry policy class adding random jitter to the exponential
+    backoff delays, so concurrent clients do not retry in lockstep."""
+    from urllib3.util.retry import Retry
+
+    class JitteredRetry(Retry):
+        def get_backoff_time(self):
+            backoff = super().get_backoff_time()
+            return backoff + random.uniform(0, BACKOFF_JITTER) if backoff else backoff
+
+    return JitteredRetry
+
+
+def session() -> 'requests.Session':
+    """Return the shared HTTP session, creating it on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            retry_class = _jittered_retry_class()
+            retry = retry_class(
+                total=RETRIES, connect=RETRIES, read=RETRIES, status=RETRIES,
+                backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUS_CODES,
+                # Lookups are read-only, so batch lookups via POST can be retried as well:
+                allowed_methods=retry_class.DEFAULT_ALLOWED_METHODS | {'POST'},
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _request(method: str, url: str, **kwargs) -> 'requests.Response':
+    """Send request via the shared session, recording its duration and status in module metrics."""
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    http_session = session()
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        response = http_session.request(method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        metrics.record_http(method, url, time.perf_counter() - start, status)
+
+
+def get(url: str, **kwargs) -> 'requests.Response':
+    """Send GET request via the shared session, see requests.get().
+
+    Raises:
+        requests.RequestException (a subclass of OSError) if the request failed.
+    """
+    return _request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> 'requests.Response':
+    """Send POST request via the shared session, see requests.post().
+
+    Raises:
+        requests.RequestException (a subclass of OSError) if the request failed.
+    """
+    return _request('POST', url, **kwargs)
+
+
+def connection_stats() -> dict:
+    """Return number of connections opened and requests sent by the shared session.
+
+    Returns:
+        {'connections': 2, 'requests': 120}
+    """
+    stats = {'connections': 0, 'requests': 0}
+    if _session is None:
+        return stats
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['connections'] += pool.num_connections
+            stats['requests'] += pool.num_requests
+    return stats
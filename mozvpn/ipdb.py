@@ -0,0 +1,108 @@
+"""Offline geolocation of IP addresses from a local IP-range database.
+
+The database is a csv file with a header line, containing (at least) the
+columns 'start' and 'end' with the first and last IP address of a range.
+All other columns (e.g. country, region, city) make up the location record
+of the range:
+
+    start,end,country,region,city
+    1.0.0.0,1.0.0.255,AU,Queensland,South Brisbane
+    2a00:1450::,2a00:1450:ffff:ffff:ffff:ffff:ffff:ffff,IE,Leinster,Dublin
+
+Ranges must not overlap, since each address has to belong to one range.
+"""
+import os
+import csv
+import bisect
+import logging
+import pathlib
+import ipaddress
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+def default_db_path() -> pathlib.Path:
+    """Return default path of the IP-range database, following the XDG conventions."""
+    data_home = os.environ.get('XDG_DATA_HOME') or pathlib.Path.home() / '.local' / 'share'
+    return pathlib.Path(data_home) / 'mozvpn' / 'ip-ranges.csv'
+
+
+class IPRangeDatabase:
+    """Sorted, bisect-indexed table of IP ranges and their locations.
+
+    IPv4 and IPv6 ranges are kept in separate tables, each holding the range
+    boundaries as integers in ascending order, so a lookup is a single binary
+    search.
+    """
+
+    def __init__(self, path: pathlib.Path = None):
+        self.path = pathlib.Path(path) if path else default_db_path()
+        # Per IP version: sorted range starts, range ends, location records
+        self._tables = {4: ([], [], []), 6: ([], [], [])}
+        self.load()
+
+    def __len__(self):
+        return sum(len(starts) for starts, _, _ in self._tables.values())
+
+    def load(self):
+        """Read the database file and build the lookup tables.
+
+        Raises:
+            RuntimeError if the database file cannot be read, lacks the columns
+            'start' or 'end', or contains overlapping ranges.
+        """
+        try:
+            fp = open(self.path, newline='')
+        except OSError as exc:
+            raise RuntimeError(f'Cannot read IP-range database "{self.path}": {exc.strerror}') from exc
+        ranges = {4: [], 6: []}
+        with fp:
+            reader = csv.DictReader(fp)
+            missing = [column for column in ('start', 'end') if column not in (reader.fieldnames or [])]
+            if missing:
+                raise RuntimeError(f'IP-range database "{self.path}" lacks column(s): {", ".join(missing)}')
+            for line_no, row in enumerate(reader, start=2):
+                try:
+                    start = ipaddress.ip_address(row.pop('start').strip())
+                    end = ipaddress.ip_address(row.pop('end').strip())
+                except (AttributeError, ValueError):
+                    logger.warning('Skipping invalid IP range in %s, line %d', self.path, line_no)
+                    continue
+                if start.version != end.version or start > end:
+                    logger.warning('Skipping invalid IP range in %s, line %d', self.path, line_no)
+                    continue
+                ranges[start.version].append((int(start), int(end), line_no, row))
+
+        for version, version_ranges in ranges.items():
+            version_ranges.sort(key=lambda item: item[0])
+            # A lookup only checks the range starting last before an address,
+            # so it would miss addresses of a range overlapped by a later one:
+            for previous, current in zip(version_ranges, version_ranges[1:]):
+                if current[0] <= previous[1]:
+                    raise RuntimeError(f'IP-range database "{self.path}": range in line {current[2]} '
+                                       f'overlaps range in line {previous[2]}')
+            starts, ends, records = self._tables[version]
+            starts[:] = [item[0] for item in version_ranges]
+            ends[:] = [item[1] for item in version_ranges]
+            records[:] = [item[3] for item in version_ranges]
+
+    def locate(self, ip: str) -> Dict:
+        """Determine location of IP address.
+
+        Args:
+            ip: IP address
+        Returns:
+            dict containing the field ip and, if the address is covered by the
+            database, the location fields (like country, region, city) of its range.
+        """
+        address = ipaddress.ip_address(ip)
+        starts, ends, records = self._tables[address.version]
+        value = int(address)
+        idx = bisect.bisect_right(starts, value) - 1
+        location = {'ip': ip}
+        if idx >= 0 and value <= ends[idx]:
+            location.update(records[idx])
+        else:
+            logger.warning('IP address %s not found in IP-range database %s', ip, self.path)
+        return location
@@ -0,0 +1,179 @@
+"""Concurrent latency probing of wireguard VPN server endpoints.
+
+Wireguard silently drops packets which are not authenticated with the peer's
+keys, so probing the wireguard port itself never gets an answer. Instead the
+servers are sent ICMP echo requests ('ping'), via the unprivileged ICMP
+sockets of Linux. If these are not permitted (see sysctl
+net.ipv4.ping_group_range), a UDP datagram is sent to a port where nothing
+listens, answered by the host with ICMP 'port unreachable'.
+"""
+import csv
+import time
+import socket
+import struct
+import logging
+import pathlib
+import selectors
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mozvpn import defaults, wgconfig, wireguard
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = defaults.LATENCY_TIMEOUT
+DEFAULT_WIREGUARD_PORT = wgconfig.DEFAULT_PORT
+# Upper bound of sockets open at the same time, to stay clear of the
+# process' file descriptor limit:
+MAX_SOCKETS = 512
+# Content of the probe datagrams (or of the echo requests):
+PROBE_PAYLOAD = b'mozvpn latency probe'
+# UDP port probed if ICMP echo requests cannot be sent, on which nothing should
+# be listening (the first port used by traceroute):
+CLOSED_PORT = 33434
+ICMP_PROTOCOLS = {socket.AF_INET: socket.IPPROTO_ICMP, socket.AF_INET6: socket.IPPROTO_ICMPV6}
+ICMP_ECHO_REQUEST = {socket.AF_INET: 8, socket.AF_INET6: 128}
+# Type, code, checksum, identifier and sequence number; the kernel fills in checksum and identifier:
+ICMP_HEADER = struct.Struct('!BBHHH')
+
+# (host, UDP port), or (host, None) for an ICMP echo request:
+Endpoint = Tuple[str, Optional[int]]
+
+
+def configured_endpoints(wg_etc_dir: str = wireguard.WIREGUARD_ETC_DIR) -> List[Dict]:
+    """Collect the server endpoints of all wireguard configurations.
+
+    The config files are only readable by root after 'mozvpn setup', so if they
+    cannot be read the endpoint IPs are taken from locations.csv instead
+    (assuming the default wireguard port).
+
+    Args:
+        wg_etc_dir: directory containing the wireguard configuration files.
+    Returns:
+        list of dictionaries with keys interface, ip, port.
+    """
+    try:
+        endpoints = [
+            {'interface': server.interface, 'ip': server.endpoint_host, 'port': server.endpoint_port}
+            for server in wgconfig.read_configs([wg_etc_dir]) if server.endpoint_host
+        ]
+    except PermissionError:
+        logger.info('Wireguard configs not readable, using endpoints from locations file')
+        locations_file = pathlib.Path(wg_etc_dir) / pathlib.Path(wireguard.WIREGUARD_LOCATIONS_FILE).name
+        with open(locations_file, newline='') as fp:
+            endpoints = [
+                {'interface': loc['interface'], 'ip': loc['ip'], 'port': DEFAULT_WIREGUARD_PORT}
+                for loc in csv.DictReader(fp) if loc['ip']
+            ]
+    return endpoints
+
+
+def probe_latencies(endpoints: Iterable[Endpoint], timeout: float = DEFAULT_TIMEOUT,
+                    payload: bytes = PROBE_PAYLOAD, max_sockets: int = MAX_SOCKETS) -> Dict[Endpoint, Optional[float]]:
+    """Measure round-trip times to endpoints, all probes running in parallel.
+
+    One datagram is sent to every endpoint at once, then all sockets are
+    watched until the deadline. Any answer counts as a response, including an
+    ICMP 'port unreachable' error: it proves that the host is up and took a
+    full round trip to arrive.
+
+    Args:
+        endpoints: (host, port) tuples; hosts without port are sent an ICMP
+            echo request, or if that is not permitted a UDP datagram to CLOSED_PORT.
+        timeout: seconds to wait for answers; the total duration does not exceed
+            it unless more than max_sockets endpoints are probed.
+        payload: content of the probe datagrams.
+        max_sockets: number of endpoints probed at the same time.
+    Returns:
+        dict mapping each endpoint to its round-trip time in seconds, or to None
+        if no answer arrived before the deadline.
+    """
+    endpoints = list(dict.fromkeys(endpoints))
+    results = {}
+    for offset in range(0, len(endpoints), max_sockets):
+        results.update(_probe_batch(endpoints[offset:offset + max_sockets], timeout, payload))
+    return results
+
+
+def _probe_batch(endpoints: List[Endpoint], timeout: float, payload: bytes) -> Dict[Endpoint, Optional[float]]:
+    """Probe endpoints in parallel, see probe_latencies()."""
+    results = dict.fromkeys(endpoints)
+    sent_at = {}
+    with selectors.DefaultSelector() as selector:
+        try:
+            for endpoint in endpoints:
+                try:
+                    sock = _send_probe(*endpoint, payload)
+                except OSError as exc:
+                    logger.debug('Probing %s:%s failed: %s', *endpoint, exc)
+                    continue
+                sent_at[endpoint] = time.monotonic()
+                selector.register(sock, selectors.EVENT_READ, endpoint)
+
+            deadline = time.monotonic() + timeout
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in selector.select(remaining):
+                    endpoint = key.data
+                    latency = time.monotonic() - sent_at[endpoint]
+                    try:
+                        key.fileobj.recv(2048)
+                    except BlockingIOError:
+                        continue
+                    except ConnectionRefusedError:
+                        pass
+                    except OSError as exc:
+                        logger.debug('Probing %s:%s failed: %s', *endpoint, exc)
+                        latency = None
+                    results[endpoint] = latency
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+    return results
+
+
+def _send_probe(host: str, port: Optional[int], payload: bytes) -> socket.socket:
+    """Send probe to host, return the non-blocking socket receiving the answer."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    if port is None:
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM, ICMP_PROTOCOLS[family])
+        except PermissionError:
+            port = CLOSED_PORT
+        else:
+            payload = ICMP_HEADER.pack(ICMP_ECHO_REQUEST[family], 0, 0, 0, 1) + payload
+    if port is not None:
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        # A connected UDP socket reports ICMP errors on recv(), an ICMP socket only receives its echo replies:
+        sock.connect((host, port or 0))
+        sock.send(payload)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def rank_servers(servers: List[Dict], timeout: float = DEFAULT_TIMEOUT, port: int = None) -> List[Dict]:
+    """Probe servers and sort them by latency.
+
+    Args:
+        servers: dictionaries with (at least) key ip, e.g. as returned by
+            configured_endpoints().
+        timeout: seconds to wait for answers.
+        port: if given, probe this UDP port instead of sending ICMP echo requests.
+    Returns:
+        copies of the responding servers, fastest first, with the round-trip
+        time in seconds added as key 'latency'.
+    """
+    def endpoint(server):
+        return server['ip'], port
+
+    latencies = probe_latencies((endpoint(server) for server in servers), timeout=timeout)
+    ranked = [dict(server, latency=latencies[endpoint(server)])
+              for server in servers if latencies[endpoint(server)] is not None]
+    return sorted(ranked, key=lambda server: server['latency'])
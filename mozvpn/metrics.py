@@ -0,0 +1,200 @@
+"""In-process metrics of external commands and HTTP requests.
+
+Every command run via wireguard.run_command() and every request sent via
+httpclient is recorded in a registry: its wall time in a histogram, and its
+outcome in a counter. The registry can be written in the Prometheus textfile
+format (for node_exporter's textfile collector) or as JSON, e.g. via
+'mozvpn --metrics FILE' or 'mozvpnd --metrics FILE'.
+
+Recording only takes a lock and a few dictionary updates, so it is cheap
+enough to be done for every call.
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import pathlib
+import tempfile
+import threading
+import urllib.parse
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+COMMAND_DURATION = 'mozvpn_command_duration_seconds'
+COMMANDS_TOTAL = 'mozvpn_commands_total'
+HTTP_REQUEST_DURATION = 'mozvpn_http_request_duration_seconds'
+HTTP_REQUESTS_TOTAL = 'mozvpn_http_requests_total'
+# Type and help text of every metric:
+METRICS = {
+    COMMAND_DURATION: ('histogram', 'Wall time of external commands in seconds.'),
+    COMMANDS_TOTAL: ('counter', 'External commands run, by exit status, "timeout", "cancelled" or "error".'),
+    HTTP_REQUEST_DURATION: ('histogram', 'Wall time of HTTP requests in seconds, including retries.'),
+    HTTP_REQUESTS_TOTAL: ('counter', 'HTTP requests sent, by response status or "error".'),
+}
+# Upper bounds of the histogram buckets in seconds, from 'wg show' to 'mozwire':
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Programs whose first argument is a subcommand, recorded as label 'subcommand':
+SUBCOMMAND_PROGRAMS = ('wg', 'wg-quick', 'mozwire', 'ip', 'mozvpn-helper')
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """Thread-safe collection of counters and histograms, identified by metric
+    name and labels."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        # [count per bucket (not cumulative) ..., count above all buckets, sum]:
+        self._histograms: Dict[Tuple[str, Labels], list] = {}
+
+    def inc(self, name: str, labels: Dict[str, str], value: float = 1):
+        """Increase counter by value."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: Dict[str, str], value: float):
+        """Add value to histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[pos] += 1
+            histogram[-1] += value
+
+    def clear(self):
+        """Remove all recorded values."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def collect(self) -> Dict[str, Dict]:
+        """Return all metrics, histogram buckets are cumulative like in Prometheus.
+
+        Returns:
+            {'mozvpn_commands_total': {'type': 'counter', 'help': ..., 'samples': [
+                {'labels': {'command': 'wg-quick', 'subcommand': 'up', 'status': '0'}, 'value': 2}]},
+             'mozvpn_command_duration_seconds': {'type': 'histogram', 'help': ..., 'samples': [
+                {'labels': {...}, 'count': 2, 'sum': 1.9, 'buckets': {'0.005': 0, ..., '+Inf': 2}}]},
+             ...}
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+        result = {}
+        for (name, labels), value in counters:
+            result.setdefault(name, _metric(name))['samples'].append({'labels': dict(labels), 'value': value})
+        for (name, labels), values in histograms:
+            buckets = {}
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), values[:-1]):
+                count += bucket_count
+                buckets['+Inf' if bound == float('inf') else f'{bound:g}'] = count
+            result.setdefault(name, _metric(name))['samples'].append(
+                {'labels': dict(labels), 'count': count, 'sum': values[-1], 'buckets': buckets}
+            )
+        return result
+
+    def prometheus(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+            for sample in metric['samples']:
+                labels = sample['labels']
+                if metric['type'] == 'histogram':
+                    for bound, count in sample['buckets'].items():
+                        lines.append(f'{name}_bucket{_format_labels(dict(labels, le=bound))} {count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {sample["sum"]:.6f}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {sample["count"]}')
+                else:
+                    # Not ':g', which rounds counts above 999999 to 6 digits:
+                    lines.append(f'{name}{_format_labels(labels)} {sample["value"]}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write(self, path):
+        """Write metrics to path, as JSON if it ends with '.json', otherwise in
+        Prometheus textfile format.
+
+        The file is replaced atomically, so node_exporter never reads a partial
+        file, even if several processes write it.
+        """
+        path = pathlib.Path(path)
+        if path.suffix == '.json':
+            content = json.dumps({'time': time.time(), 'metrics': self.collect()}, indent=2) + '\n'
+        else:
+            content = self.prometheus()
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(content)
+            # Readable by the collector, like a file created by open():
+            os.chmod(tmp_name, 0o644)
+            os.replace(tmp_name, path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+
+def _metric(name: str) -> Dict:
+    metric_type, help_text = METRICS.get(name, ('untyped', ''))
+    return {'type': metric_type, 'help': help_text, 'samples': []}
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+# Registry of this process, recording all commands and requests:
+REGISTRY = Registry()
+
+
+def command_labels(cmd: str) -> Dict[str, str]:
+    """Return labels identifying a command by program (and subcommand), without its arguments.
+
+    Examples:
+        'sudo -n wg-quick up de4-wireguard' -> {'command': 'wg-quick', 'subcommand': 'up'}
+        'mozvpn geolocate /tmp/x -o /tmp/x/locations.csv' -> {'command': 'mozvpn'}
+    """
+    words = cmd.split()
+    if words and words[0] == 'sudo':
+        words.pop(0)
+        while words and words[0].startswith('-'):
+            words.pop(0)
+    if not words:
+        return {'command': ''}
+    program = os.path.basename(words[0])
+    labels = {'command': program}
+    if program in SUBCOMMAND_PROGRAMS and len(words) > 1 and not words[1].startswith('-'):
+        labels['subcommand'] = words[1]
+    return labels
+
+
+def record_command(cmd: str, seconds: float, status: str):
+    """Record wall time and outcome of an external command."""
+    labels = command_labels(cmd)
+    REGISTRY.observe(COMMAND_DURATION, labels, seconds)
+    REGISTRY.inc(COMMANDS_TOTAL, dict(labels, status=status))
+
+
+def record_http(method: str, url: str, seconds: float, status: str):
+    """Record wall time and outcome of an HTTP request."""
+    labels = {'method': method, 'host': urllib.parse.urlsplit(url).hostname or ''}
+    REGISTRY.observe(HTTP_REQUEST_DURATION, labels, seconds)
+    REGISTRY.inc(HTTP_REQUESTS_TOTAL, dict(labels, status=status))
+
+
+def write(path):
+    """Write metrics of this process to path, see Registry.write()."""
+    REGISTRY.write(path)
@@ -0,0 +1,216 @@
+"""Health monitor for the active VPN connection, failing over to another server.
+
+The peer statistics are taken from 'wg show INTERFACE dump' (via the
+helper, see module wghelper, which leaves out the keys), which prints a tab
+separated line for the interface, followed by a line per peer:
+
+    public-key  preshared-key  endpoint  allowed-ips  latest-handshake  transfer-rx  transfer-tx  persistent-keepalive
+
+A connection is considered degraded if data is sent, but the peer does not
+answer: either the latest handshake is too old, or nothing was received for
+too long. Idle connections are never degraded, since wireguard only does
+handshakes while sending.
+"""
+import time
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from mozvpn import catalog, daemon, defaults, latency, wghelper, wireguard
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HANDSHAKE_TIMEOUT = defaults.HANDSHAKE_TIMEOUT
+DEFAULT_RX_STALL_TIMEOUT = defaults.RX_STALL_TIMEOUT
+DEFAULT_INTERVAL = defaults.MONITOR_INTERVAL
+DEFAULT_COOLDOWN = defaults.COOLDOWN
+# Seconds a server is not used as failover target after it failed:
+FAILED_SERVER_TIMEOUT = 600
+FAILOVER_POLICIES = defaults.FAILOVER_POLICIES
+
+
+@dataclass
+class PeerStats:
+    """Statistics of a wireguard peer, as shown by 'wg show INTERFACE dump'."""
+    __slots__ = ('public_key', 'endpoint', 'latest_handshake', 'rx', 'tx')
+    public_key: str
+    endpoint: str
+    # Seconds since the epoch, 0 if there was no handshake yet:
+    latest_handshake: int
+    # Bytes received and sent:
+    rx: int
+    tx: int
+
+
+def parse_dump(text: str) -> List[PeerStats]:
+    """Return statistics of all peers from the output of 'wg show INTERFACE dump'.
+
+    Raises:
+        ValueError if the output is malformed.
+    """
+    peers = []
+    # The first line describes the interface itself:
+    for line in text.splitlines()[1:]:
+        fields = line.split('\t')
+        if len(fields) != 8:
+            raise ValueError(f'Unexpected line in wg dump: "{line}"')
+        public_key, _, endpoint, _, latest_handshake, rx, tx, _ = fields
+        peers.append(PeerStats(public_key, endpoint, int(latest_handshake), int(rx), int(tx)))
+    return peers
+
+
+def read_peer_stats(iface: str) -> Optional[PeerStats]:
+    """Return statistics of the (only) peer of interface, or None if it has no peer.
+
+    Raises:
+        CommandError if 'wg show' failed, ValueError if its output is malformed.
+    """
+    peers = parse_dump(wireguard.run_command(wireguard.WIREGUARD_SHOW_DUMP_CMD.format(helper=wghelper.HELPER_PATH, iface=iface)))
+    return peers[0] if peers else None
+
+
+class HealthTracker:
+    """Judge the health of a connection from successive peer statistics."""
+
+    def __init__(self, handshake_timeout: float = DEFAULT_HANDSHAKE_TIMEOUT,
+                 rx_stall_timeout: float = DEFAULT_RX_STALL_TIMEOUT):
+        self.handshake_timeout = handshake_timeout
+        self.rx_stall_timeout = rx_stall_timeout
+        self.reset()
+
+    def reset(self):
+        """Forget previous statistics, e.g. after switching the server."""
+        self._last = None
+        self._last_time = None
+        self._started = None
+        self._stalled_since = None
+
+    def update(self, stats: PeerStats, now: float) -> Optional[str]:
+        """Add statistics sampled at 'now' (seconds since the epoch).
+
+        Returns:
+            reason why the connection is degraded, or None if it is healthy.
+        """
+        last, last_time = self._last, self._last_time
+        self._last, self._last_time = stats, now
+        if last is None or stats.public_key != last.public_key:
+            self._started = now
+            self._stalled_since = None
+            return None
+        if stats.tx == last.tx:
+            # Idle, nothing to judge:
+            self._stalled_since = None
+            return None
+        handshake_age = now - (stats.latest_handshake or self._started)
+        if handshake_age > self.handshake_timeout:
+            return f'no handshake for {handshake_age:.0f}s'
+        if stats.rx != last.rx:
+            self._stalled_since = None
+            return None
+        if self._stalled_since is None:
+            self._stalled_since = last_time
+        stalled = now - self._stalled_since
+        if stalled > self.rx_stall_timeout:
+            return f'nothing received for {stalled:.0f}s'
+        return None
+
+
+class Monitor:
+    """Check the active connection regularly, and switch to another server
+    if it is degraded.
+
+    Args:
+        backend: module wireguard or a daemon client, see daemon.backend().
+        policy: how failover servers are chosen, one of FAILOVER_POLICIES:
+            'country' takes the next server of the same country in catalog
+            order, 'fastest' the server with the lowest latency in any country.
+        tracker: health criteria.
+        interval: seconds between checks.
+        cooldown: seconds to wait after a failover before judging the new server.
+        clock: function returning the current time in seconds since the epoch.
+    """
+
+    def __init__(self, backend=wireguard, policy: str = 'country', tracker: HealthTracker = None,
+                 interval: float = DEFAULT_INTERVAL, cooldown: float = DEFAULT_COOLDOWN,
+                 clock: Callable[[], float] = time.time):
+        self.backend = backend
+        self.policy = policy
+        self.tracker = tracker or HealthTracker()
+        self.interval = interval
+        self.cooldown = cooldown
+        self.clock = clock
+        # Servers failed recently, with the time of failure:
+        self.failed = {}
+        self._cooldown_until = 0
+
+    def check(self) -> Optional[str]:
+        """Check the connection once, and fail over if it is degraded.
+
+        Returns:
+            the server failed over to, or None.
+        """
+        now = self.clock()
+        if now < self._cooldown_until:
+            return None
+        iface = self.backend.interface()
+        stats = read_peer_stats(iface) if iface else None
+        if stats is None:
+            self.tracker.reset()
+            return None
+        reason = self.tracker.update(stats, now)
+        if not reason:
+            return None
+        server = self.backend.active_server()
+        logger.warning('Connection to %s is degraded: %s', server, reason)
+        self.failed[server] = now
+        for candidate in self.candidates(server):
+            try:
+                self.backend.switch(candidate)
+            except wireguard.CommandError as exc:
+                logger.error('Failover to %s failed: %s', candidate, exc)
+                self.failed[candidate] = now
+                continue
+            logger.warning('Failed over to %s', candidate)
+            self.tracker.reset()
+            self._cooldown_until = now + self.cooldown
+            return candidate
+        logger.error('No server left to fail over to')
+        return None
+
+    def candidates(self, server: str) -> List[str]:
+        """Return servers to fail over to from server, best first."""
+        now = self.clock()
+        recently_failed = {name for name, failed_at in self.failed.items() if now - failed_at < FAILED_SERVER_TIMEOUT}
+        recently_failed.add(server)
+        server_catalog = catalog.ServerCatalog.load()
+        record = server_catalog.server(server)
+        if self.policy == 'country' and record and record['country']:
+            servers = server_catalog.find(country=record['country'])
+            # Continue after the failed server in catalog order:
+            interfaces = [s['interface'] for s in servers]
+            pos = interfaces.index(server)
+            servers = servers[pos + 1:] + servers[:pos]
+        else:
+            servers = list(server_catalog.servers)
+        servers = [s for s in servers if s['interface'] not in recently_failed]
+        if self.policy == 'fastest':
+            servers = self._rank(servers)
+        return [s['interface'] for s in servers]
+
+    @staticmethod
+    def _rank(servers: List[Dict]) -> List[Dict]:
+        ranked = latency.rank_servers([server for server in servers if server['ip']])
+        if not ranked:
+            # Probes are sent through the degraded tunnel as well, so they may all fail:
+            logger.warning('No server responded to latency probes, using catalog order')
+            return servers
+        return ranked
+
+    def run(self):
+        """Check the connection every 'interval' seconds, until interrupted."""
+        while True:
+            try:
+                self.check()
+            except (wireguard.CommandError, daemon.DaemonError, OSError, ValueError) as exc:
+                logger.error('Checking connection failed: %s', exc)
+            time.sleep(self.interval)
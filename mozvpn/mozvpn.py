@@ -1,72 +1,352 @@
 """Main module."""
 import re
+import time
+import socket
 import pathlib
 import logging
-from typing import List, Dict
+import threading
+from typing import Callable, Iterable, Iterator, List, Dict, Optional
 from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+from mozvpn import httpclient, wgconfig
+from mozvpn.geocache import GeoCache
 
 logger = logging.getLogger(__name__)
 
-ENDPOINT_RE = re.compile(r'Endpoint\s*=\s*(?P<ip>\d+\.\d+\.\d+\.\d+)')
 IPINFO_URL = 'https://ipinfo.io'
+IPINFO_BATCH_URL = 'https://ipinfo.io/batch'
 
+# Number of concurrent geolocation lookups (defined by httpclient, so the CLI needs not import this module):
+DEFAULT_JOBS = httpclient.DEFAULT_JOBS
+# Number of IP addresses looked up per batch request (ipinfo.io accepts up to 1000):
+DEFAULT_BATCH_SIZE = 100
+# HTTP status code returned by ipinfo.io when the rate limit was exceeded:
+HTTP_TOO_MANY_REQUESTS = 429
+# Columns of locations.csv:
+LOCATIONS_FIELDS = ['interface', 'ip', 'country', 'region', 'city', 'loc']
 
-def determine_ip_location(ip: str) -> Dict:
+
+class RateLimitBackoff:
+    """Backoff state shared by all threads querying the same API.
+
+    Whenever the API answers with 'too many requests' the delay is doubled
+    (up to max_delay) and all threads pause until it has passed. Every
+    successful request halves the delay again, so throughput recovers as soon
+    as the API accepts requests again.
+    """
+
+    def __init__(self, initial_delay: float = 0.5, max_delay: float = 30.0, max_retries: int = 6):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.delay = 0.0
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the currently active backoff period is over."""
+        with self._lock:
+            pause = self._resume_at - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+
+    def throttled(self, retry_after: str = None):
+        """Register a rate limited response and extend the backoff period.
+
+        Args:
+            retry_after: value of the 'Retry-After' header, if sent by the server.
+        """
+        with self._lock:
+            self.delay = min(max(self.delay * 2, self.initial_delay), self.max_delay)
+            delay = self.delay
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(float(retry_after), self.max_delay))
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        logger.info('Rate limit reached, backing off for %.1fs', delay)
+
+    def succeeded(self):
+        """Register a successful response and shrink the backoff delay."""
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.initial_delay else 0.0
+
+
+def _send_with_backoff(send: Callable, backoff: RateLimitBackoff):
+    """Send request, repeating it as long as the API reports exceeding its rate limit.
+
+    Args:
+        send: function sending the request and returning the response.
+        backoff: shared backoff state.
+    Returns:
+        the first response which was not rate limited.
+    Raises:
+        requests.HTTPError if the request was still rate limited after all retries.
+    """
+    for _ in range(backoff.max_retries + 1):
+        backoff.wait()
+        req = send()
+        if req.status_code != HTTP_TOO_MANY_REQUESTS:
+            backoff.succeeded()
+            return req
+        backoff.throttled(req.headers.get('Retry-After'))
+    req.raise_for_status()
+
+
+def determine_ip_location(ip: str, backoff: RateLimitBackoff = None,
+                          cache: GeoCache = None, refresh: bool = False) -> Dict:
     """Determine location of IP address.
 
     Args:
         ip: IP address
+        backoff: shared backoff state, used to retry requests which were
+            rejected because of the API's rate limit.
+        cache: if given, known locations are taken from it and new ones are
+            added to it.
+        refresh: if True, ignore cached locations and query the API again.
     Returns:
         dict containing (among others) fields country, region, city
     """
-    req = requests.get(f'{IPINFO_URL}/{ip}')
-    return req.json()
+    if cache is not None and not refresh:
+        location = cache.get(ip)
+        if location is not None:
+            return location
+    req = _send_with_backoff(lambda: httpclient.get(f'{IPINFO_URL}/{ip}'), backoff or RateLimitBackoff())
+    location = req.json()
+    if cache is not None and 'error' not in location:
+        cache.put(ip, location)
+    return location
 
 
-def find_vpn_server_locations(wg_config_files: List[str]):
-    """Find geographic locations of wireguard VPN server endpoints.
+def determine_ip_locations_batched(ips: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE,
+                                   token: str = None, jobs: int = DEFAULT_JOBS,
+                                   cache: GeoCache = None, refresh: bool = False) -> Dict[str, Dict]:
+    """Determine locations of many IP addresses with few requests, via ipinfo.io's batch API.
+
+    IP addresses are sent in chunks of batch_size; up to 'jobs' chunks are
+    requested concurrently. Addresses missing in an answer (partial results,
+    per-address errors, or a failed batch request) are looked up one by one.
 
     Args:
-        wg_config_files: list of wireguard config files/directories
+        ips: IP addresses, duplicates are only resolved once.
+        batch_size: number of IP addresses per request.
+        token: ipinfo.io access token.
+        jobs: maximum number of requests running at the same time.
+        cache: if given, known locations are taken from it and new ones are
+            added to it.
+        refresh: if True, ignore cached locations and query the API again.
     Returns:
-        list of dictionaries containing configuration/location data.
+        dict mapping each IP address to its location.
     """
-    wg_configs = []
-    # Loop over all config files, or, if a directory was found, read out all
-    # configuration files from the given directory:
-    for conf_path in wg_config_files:
-        p_conf_path = pathlib.Path(conf_path)
-        if p_conf_path.is_dir():
-            # Find all wireguard config files in given directory:
-            wg_configs.extend(
-                {'path': gp} for gp in p_conf_path.glob('*.conf')
-            )
+    locations = {}
+    missing = []
+    for ip in dict.fromkeys(ips):
+        location = cache.get(ip) if cache is not None and not refresh else None
+        if location is None:
+            missing.append(ip)
         else:
-            # The file itself is assumed to be a wireguard config file:
-            wg_configs.append({'path': p_conf_path})
+            locations[ip] = location
 
-    # Regex to split interface name like 'de12-wirecard' into ('de', 12, 'wirecard')
-    # for being able to properly sort list of wireguard configurations by name:
-    wg_pat = re.compile(r'(\w+)(\d+)-(.+)')
+    backoff = RateLimitBackoff()
+    params = {'token': token} if token else None
 
-    # Extract IP addresses of server endpoints from wireguard config files
-    # and determine their geographic location:
-    for wg_config in wg_configs:
-        # Extract the interface part of the config file name, e.g. 'de10-wireguard'
+    def resolve_batch(batch):
+        try:
+            req = _send_with_backoff(lambda: httpclient.post(IPINFO_BATCH_URL, params=params, json=batch), backoff)
+        except OSError as exc:
+            logger.warning('Batch request for %d addresses failed: %s', len(batch), exc)
+            return {}
+        if req.status_code != 200:
+            logger.warning('Batch request for %d addresses failed with status %d', len(batch), req.status_code)
+            return {}
+        answer = req.json()
+        return {ip: answer[ip] for ip in batch
+                if isinstance(answer.get(ip), dict) and 'error' not in answer[ip]}
+
+    batches = [missing[pos:pos + batch_size] for pos in range(0, len(missing), max(1, batch_size))]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for answer in executor.map(resolve_batch, batches):
+            for ip, location in answer.items():
+                locations[ip] = location
+                if cache is not None:
+                    cache.put(ip, location)
+
+    unresolved = [ip for ip in missing if ip not in locations]
+    if unresolved:
+        logger.info('Looking up %d addresses missing in batch results one by one', len(unresolved))
+        locations.update(resolve_ip_locations(unresolved, jobs=jobs, cache=cache, refresh=refresh))
+    return locations
+
+
+def resolve_ip_locations(ips: Iterable[str], locate: Callable[[str], Dict] = None,
+                         jobs: int = DEFAULT_JOBS, cache: GeoCache = None,
+                         refresh: bool = False) -> Dict[str, Dict]:
+    """Determine locations of many IP addresses concurrently.
+
+    Args:
+        ips: IP addresses, duplicates are only resolved once.
+        locate: function returning the location of a single IP address,
+            defaults to determine_ip_location() with a shared backoff state.
+        jobs: maximum number of lookups running at the same time.
+        cache: geolocation cache passed on to determine_ip_location().
+        refresh: if True, ignore cached locations.
+    Returns:
+        dict mapping each IP address to its location.
+    """
+    if locate is None:
+        backoff = RateLimitBackoff()
+
+        def locate(ip):
+            return determine_ip_location(ip, backoff=backoff, cache=cache, refresh=refresh)
+
+    unique_ips = list(dict.fromkeys(ips))
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return dict(zip(unique_ips, executor.map(locate, unique_ips)))
+
+
+# Regex to split interface name like 'de12-wirecard' into ('de', 12, 'wirecard')
+# for being able to properly sort list of wireguard configurations by name:
+WG_INTERFACE_RE = re.compile(r'(\w+)(\d+)-(.+)')
+
+
+def resolve_hostname(host: str) -> Optional[str]:
+    """Return (first) IP address of hostname, or None if it cannot be resolved."""
+    try:
+        return socket.getaddrinfo(host, None, proto=socket.IPPROTO_UDP)[0][4][0]
+    except OSError as exc:
+        logger.warning('Cannot resolve endpoint host %s: %s', host, exc)
+        return None
+
+
+def parse_wg_configs(paths: Iterable[pathlib.Path]) -> Iterator[Dict]:
+    """Yield interface name, sort key and endpoint IP of wireguard config files.
+
+    Endpoints given as hostname are resolved to their IP address.
+
+    Args:
+        paths: wireguard config files
+    """
+    for path in paths:
+        try:
+            server = wgconfig.read_config(path)
+        except (OSError, wgconfig.ConfigError) as exc:
+            logger.warning('Skipping wireguard configfile %s: %s', path, exc)
+            continue
+        # The interface is the name of the config file, e.g. 'de10-wireguard'
         # from '/etc/wireguard/de10-wireguard.conf':
-        wg_config['interface'] = wg_config['path'].stem
-        wg_config['sort_me'] = wg_pat.match(wg_config['interface']).groups()
-
-        conf = wg_config['path'].read_text()
-        match = ENDPOINT_RE.search(conf)
-        if match:
-            ip = match.group('ip')
-            wg_config.update(determine_ip_location(ip))
+        wg_config = {'path': path, 'interface': server.interface}
+        wg_config['sort_me'] = WG_INTERFACE_RE.match(wg_config['interface']).groups()
+
+        if server.endpoint_host:
+            wg_config['ip'] = server.endpoint_ip or resolve_hostname(server.endpoint_host)
         else:
             wg_config['ip'] = None
-            logger.warning(
-                'Cannot find endpoint IP in wireguard configfile %s', wg_config['conf']
+            logger.warning('Cannot find endpoint in wireguard configfile %s', path)
+        yield wg_config
+
+
+def _known_locations(wg_configs: List[Dict], known: Dict[str, Dict]) -> Dict[str, Dict]:
+    """Return {interface: location} for configs whose endpoint IP has a known location.
+
+    Args:
+        wg_configs: configs as yielded by parse_wg_configs()
+        known: locations found before, as {interface: row}
+    """
+    # Rows written before a column was added to locations.csv are looked up again:
+    known = {interface: row for interface, row in known.items() if all(field in row for field in LOCATIONS_FIELDS)}
+    by_ip = {row['ip']: row for row in known.values() if row.get('ip')}
+    reused = {}
+    for wg_config in wg_configs:
+        row = known.get(wg_config['interface'])
+        if not row or row.get('ip') != wg_config['ip']:
+            row = by_ip.get(wg_config['ip'])
+        if row:
+            reused[wg_config['interface']] = {key: value for key, value in row.items() if key != 'interface'}
+    return reused
+
+
+def iter_vpn_server_locations(wg_config_files: List[str], jobs: int = DEFAULT_JOBS,
+                              cache: GeoCache = None, refresh: bool = False,
+                              locate: Callable[[str], Dict] = None,
+                              batch_size: int = 0, token: str = None,
+                              known: Dict[str, Dict] = None) -> Iterator[Dict]:
+    """Find geographic locations of wireguard VPN server endpoints, yielding
+    each server as soon as it is resolved.
+
+    The pipeline discovers and parses all configs, sorts them by interface
+    name, and resolves their locations concurrently. Resolved servers are
+    yielded in sorted order, each one as soon as it and all servers before
+    it are done, so output can be written progressively.
+
+    Args:
+        wg_config_files: list of wireguard config files/directories
+        jobs: maximum number of concurrent geolocation lookups.
+        cache: if given, endpoints with known locations are not looked up again.
+        refresh: if True, look up all endpoints, regardless of the cache.
+        locate: geolocation backend, a function returning the location of
+            a single IP address. Defaults to querying ipinfo.io.
+        batch_size: if given (and no 'locate' backend), query ipinfo.io's
+            batch API with this many addresses per request.
+        token: ipinfo.io access token, used for batch requests.
+        known: locations found before, as {interface: row}. Configs whose
+            endpoint IP is known (preferably for the same interface) reuse
+            that location instead of being looked up.
+    Yields:
+        dictionaries containing configuration/location data.
+    """
+    wg_configs = sorted(parse_wg_configs(wgconfig.discover_configs(wg_config_files)), key=itemgetter('sort_me'))
+
+    if batch_size and locate is None:
+        def resolve(ips):
+            return determine_ip_locations_batched(
+                ips, batch_size=batch_size, token=token, jobs=1, cache=cache, refresh=refresh
             )
-    return sorted(wg_configs, key=itemgetter('sort_me'))
+    else:
+        batch_size = 1
+        if locate is None:
+            backoff = RateLimitBackoff()
+
+            def locate(ip):
+                return determine_ip_location(ip, backoff=backoff, cache=cache, refresh=refresh)
+
+        def resolve(ips):
+            return {ip: locate(ip) for ip in ips}
+
+    reused = _known_locations(wg_configs, known) if known else {}
+    to_resolve = [wg_config for wg_config in wg_configs if wg_config['interface'] not in reused]
+    logger.info('%d locations known, %d to resolve', len(reused), len(to_resolve))
+
+    # Servers sharing an endpoint IP are looked up once; the IPs are chunked
+    # in order of their first server, so servers can be yielded in order:
+    ips = list(dict.fromkeys(wg_config['ip'] for wg_config in to_resolve if wg_config['ip']))
+    chunks = [ips[pos:pos + batch_size] for pos in range(0, len(ips), batch_size)]
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    futures = iter([executor.submit(resolve, chunk) for chunk in chunks])
+    locations = {}
+    try:
+        for wg_config in wg_configs:
+            interface, ip = wg_config['interface'], wg_config['ip']
+            if interface in reused:
+                wg_config.update(reused[interface])
+            elif ip:
+                while ip not in locations:
+                    locations.update(next(futures).result())
+                wg_config.update(locations[ip])
+            yield wg_config
+    finally:
+        # Stop pending lookups if the consumer gives up early (e.g. on Ctrl-C),
+        # without waiting for the running ones:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def find_vpn_server_locations(wg_config_files: List[str], **kwargs) -> List[Dict]:
+    """Find geographic locations of wireguard VPN server endpoints.
+
+    Args:
+        wg_config_files: list of wireguard config files/directories
+        kwargs: options, see iter_vpn_server_locations()
+    Returns:
+        list of dictionaries containing configuration/location data, sorted by interface.
+    """
+    return list(iter_vpn_server_locations(wg_config_files, **kwargs))
@@ -1,45 +1,204 @@
 """Qt6 based GUI frontend for mozilla VPN."""
-import csv
 import logging
+import threading
 
-from PyQt6.QtCore import QTimer
+from PyQt6.QtCore import QAbstractListModel, QModelIndex, QObject, QRunnable, QSocketNotifier, \
+    QSortFilterProxyModel, QThreadPool, QTimer, Qt, pyqtSignal
 from PyQt6.QtWidgets import QApplication, QLabel, QWidget, QVBoxLayout, QHBoxLayout, \
-    QPushButton, QComboBox, QMessageBox, QSizePolicy, QMainWindow
+    QPushButton, QComboBox, QLineEdit, QMessageBox, QSizePolicy, QMainWindow, QProgressBar
 
-from mozvpn import wireguard
+from mozvpn import daemon, stats, wireguard
+from mozvpn.catalog import ServerCatalog, normalize
+from mozvpn.netwatch import LinkMonitor
 
 logger = logging.getLogger(__name__)
 
+# Poll interval for VPN connectivity, if link notifications are not available:
+CONNECTIVITY_POLL_INTERVAL = 1000  # ms
+# Number of servers added to the server list at once, while scrolling down:
+FETCH_BATCH_SIZE = 50
+# Interval for updating the throughput of the active connection:
+THROUGHPUT_INTERVAL = 1000  # ms
+
+
+class ServerListModel(QAbstractListModel):
+    """List of the servers of a catalog, for the server selector.
+
+    Rows are added in batches as the list is scrolled, so servers are only
+    read from the catalog (possibly memory mapped from a snapshot) when shown.
+    Servers are found by interface via the catalog's interface index.
+    """
+    # Data role of the interface, as used by QComboBox.currentData():
+    InterfaceRole = Qt.ItemDataRole.UserRole
+    # Data role of the normalized text matched by ServerFilterProxyModel:
+    SearchRole = Qt.ItemDataRole.UserRole + 1
+    _ROLES = (Qt.ItemDataRole.DisplayRole, InterfaceRole, SearchRole)
+
+    def __init__(self, server_catalog: ServerCatalog, parent: QObject = None):
+        super().__init__(parent)
+        self.catalog = server_catalog
+        self._loaded = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._loaded
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= self._loaded or role not in self._ROLES:
+            return None
+        server = self.catalog.servers[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return server['display']
+        if role == self.InterfaceRole:
+            return server['interface']
+        if role == self.SearchRole:
+            return normalize(' '.join((server['country'], server['region'], server['city'], server['interface'])))
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._loaded < len(self.catalog)
+
+    def fetchMore(self, parent=QModelIndex(), count: int = FETCH_BATCH_SIZE):
+        if parent.isValid():
+            return
+        count = min(count, len(self.catalog) - self._loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+        self._loaded += count
+        self.endInsertRows()
+
+    def fetch_all(self):
+        """Add all remaining servers, e.g. before searching them."""
+        self.fetchMore(count=len(self.catalog) - self._loaded)
+
+    def row(self, interface: str) -> int:
+        """Return row of interface (loading rows up to it), or -1 if unknown."""
+        positions = self.catalog.indexes['interface'].get(interface)
+        if not positions:
+            return -1
+        if positions[0] >= self._loaded:
+            self.fetchMore(count=positions[0] + 1 - self._loaded)
+        return positions[0]
+
+
+class ServerFilterProxyModel(QSortFilterProxyModel):
+    """Show servers matching all words of a search text in their country,
+    region, city or interface, ignoring case and accents."""
+
+    def __init__(self, parent: QObject = None):
+        super().__init__(parent)
+        self._words = []
+
+    def set_search_text(self, text: str):
+        """Only show servers matching text, e.g. 'de frankf' or 'nl2'."""
+        words = normalize(text).split()
+        if words and self.sourceModel().canFetchMore(QModelIndex()):
+            # Only loaded rows are filtered, so search all servers:
+            self.sourceModel().fetch_all()
+        self._words = words
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if not self._words:
+            return True
+        index = self.sourceModel().index(source_row, 0, source_parent)
+        text = self.sourceModel().data(index, ServerListModel.SearchRole) or ''
+        return all(word in text for word in self._words)
+
+
+class WorkerSignals(QObject):
+    """Signals to report the outcome of a Worker back to the GUI thread."""
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(Exception)
+
+
+class Worker(QRunnable):
+    """Run a (blocking) function in a thread of a QThreadPool.
+
+    The function's return value is emitted via signals.finished, an exception
+    raised by it via signals.failed.
+    """
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except Exception as exc:
+            self.signals.failed.emit(exc)
+        else:
+            self.signals.finished.emit(result)
+
 
 class MainWindow(QMainWindow):
     """
     MozVPN GUI window.
+
+    All calls to wireguard are run in a thread pool, so the GUI stays
+    responsive while external commands are running.
     """
     def __init__(self):
         """Compose main window widgets."""
         super().__init__()
         self.wireguard_interface = None
+        # Set while connecting or disconnecting:
+        self.busy = False
+        self.cancel_event = threading.Event()
+        self.thread_pool = QThreadPool.globalInstance()
+        # References to running workers, to protect their signals from garbage collection:
+        self._workers = set()
 
         self.setWindowTitle('MozVPN')
 
         vlayout = QVBoxLayout()
         vlayout.addWidget(QLabel('<h2>MozVPN</h2>'))
 
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText('Search country, city or server')
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.textChanged.connect(self._filter_servers)
+        vlayout.addWidget(self.search_edit)
+
         self.combo = QComboBox()
         self._fill_vpn_choice_combo()
         vlayout.addWidget(self.combo)
 
         self.connect_button = QPushButton('Connect')
-        self.connect_button.clicked.connect(self.toggle_connect)
+        self.connect_button.clicked.connect(lambda: self.toggle_connect())
         self.connect_button.setSizePolicy(
             QSizePolicy.Policy.Preferred, QSizePolicy.Policy.Minimum
         )
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_command)
+        self.cancel_button.hide()
         hlayout = QHBoxLayout()
         hlayout.addStretch()
         hlayout.addWidget(self.connect_button)
+        hlayout.addWidget(self.cancel_button)
         hlayout.addStretch()
         vlayout.addLayout(hlayout)
 
+        # Busy indicator, shown while connecting or disconnecting:
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setTextVisible(True)
+        self.progress_bar.hide()
+        vlayout.addWidget(self.progress_bar)
+
+        # Throughput of the active connection, sampled while connected:
+        self.throughput_label = QLabel()
+        self.throughput_label.hide()
+        vlayout.addWidget(self.throughput_label)
+        self.stats_sampler = stats.Sampler()
+        self._sampling = False
+        self.throughput_timer = QTimer()
+        self.throughput_timer.setInterval(THROUGHPUT_INTERVAL)
+        self.throughput_timer.timeout.connect(self._sample_throughput)
+
         container = QWidget()
         container.setLayout(vlayout)
         self.setCentralWidget(container)
@@ -47,60 +206,178 @@ class MainWindow(QMainWindow):
         self.show()
 
         # Check whether VPN is already running:
-        try:
-            iface = wireguard.interface()
-        except wireguard.CommandError as exc:
-            QMessageBox.critical(self, 'Error', exc.msg)
-            raise wireguard.ControlledExit()
-        if iface:
+        self._run_in_background(self._active_server, self._initial_connectivity, self._initial_connectivity_failed)
+
+        self._watch_connectivity()
+
+    def _run_in_background(self, fn, on_finished, on_failed):
+        """Run function in the thread pool and pass its outcome to one of the callbacks.
+
+        Args:
+            fn: function to be called without arguments.
+            on_finished: called with the function's return value.
+            on_failed: called with the exception raised by the function.
+        """
+        worker = Worker(fn)
+        self._workers.add(worker)
+        worker.signals.finished.connect(lambda result: (self._workers.discard(worker), on_finished(result)))
+        worker.signals.failed.connect(lambda exc: (self._workers.discard(worker), on_failed(exc)))
+        self.thread_pool.start(worker)
+
+    @staticmethod
+    def _active_server():
+        """Return active server, via the mozvpn daemon if it is running."""
+        return daemon.backend().active_server()
+
+    def _initial_connectivity(self, iface):
+        """Set up GUI according to the VPN connectivity found on startup."""
+        if iface and not self.busy:
             # VPN is already up when GUI was started:
             self.wireguard_interface = iface
             self.update_gui_activity_status()
             QMessageBox.information(self, 'Information', 'VPN is already running')
 
-        # Create timer to regularly check the underlying VPN connectivity:
+    def _initial_connectivity_failed(self, exc):
+        """Quit if wireguard cannot be queried on startup."""
+        QMessageBox.critical(self, 'Error', getattr(exc, 'msg', str(exc)))
+        QApplication.exit(1)
+
+    def _watch_connectivity(self):
+        """Trigger update_connectivity() whenever the VPN connectivity may have changed.
+
+        Preferably the kernel's link notifications are used, so the GUI reacts
+        immediately when an interface comes up or goes down, and stays idle
+        otherwise. If they are not available the connectivity is polled.
+        """
+        try:
+            self.link_monitor = LinkMonitor()
+        except OSError as exc:
+            logger.info('Link notifications not available (%s), polling connectivity instead.', exc)
+            self.link_monitor = None
+            self._poll_connectivity()
+        else:
+            self.link_notifier = QSocketNotifier(self.link_monitor.fileno(), QSocketNotifier.Type.Read)
+            self.link_notifier.activated.connect(self._link_changed)
+
+    def _poll_connectivity(self):
+        """Create timer to regularly check the underlying VPN connectivity."""
         self.connectivity_update_timer = QTimer()
-        self.connectivity_update_timer.setInterval(1000)  # fire every 1000ms
+        self.connectivity_update_timer.setInterval(CONNECTIVITY_POLL_INTERVAL)
         self.connectivity_update_timer.timeout.connect(self.update_connectivity)
         self.connectivity_update_timer.start()
 
+    def _link_changed(self):
+        """Handle link notifications from the kernel."""
+        try:
+            changed = self.link_monitor.changed()
+        except OSError as exc:
+            logger.warning('Link notifications failed (%s), polling connectivity instead.', exc)
+            # The socket may stay readable, so stop watching it:
+            self.link_notifier.setEnabled(False)
+            self.link_monitor.close()
+            self.link_monitor = None
+            self._poll_connectivity()
+            changed = True
+        if changed:
+            self.update_connectivity()
+
     def _fill_vpn_choice_combo(self):
-        """Fill the VPN server combobox from geolocation csv file."""
+        """Back the VPN server combobox by the server catalog, filtered by the search text."""
         try:
-            fp = open(wireguard.WIREGUARD_LOCATIONS_FILE)
+            server_catalog = ServerCatalog.load()
         except FileNotFoundError:
             QMessageBox.critical(
                 self, 'Error',
                 'File "locations.csv" could not be found.\nDid you run "mozvpn setup"?')
             raise wireguard.ControlledExit()
-        server_locations = csv.DictReader(fp)
-        for loc in server_locations:
-            # Split an interface name like 'de4-wireguard' and only save the 'de4'-part:
-            loc['iface'] = loc['interface'].split('-')[0]
-            loc_str = '{country} - {region} - {city} ({iface})'.format(**loc)
-            self.combo.addItem(loc_str, loc['interface'])
+        self.server_model = ServerListModel(server_catalog, self)
+        self.server_model.fetchMore()
+        self.server_proxy = ServerFilterProxyModel(self)
+        self.server_proxy.setSourceModel(self.server_model)
+        self.combo.setModel(self.server_proxy)
+
+    def _filter_servers(self, text: str):
+        """Only offer servers matching the search text, keeping the selection if it matches."""
+        selected = self.combo.currentData()
+        self.server_proxy.set_search_text(text)
+        if selected:
+            self._select_server(selected, clear_search=False)
+
+    def _select_server(self, interface: str, clear_search: bool = True):
+        """Select server in the combobox, clearing the search if it hides the server."""
+        source_row = self.server_model.row(interface)
+        if source_row < 0:
+            return
+        source_index = self.server_model.index(source_row, 0)
+        proxy_index = self.server_proxy.mapFromSource(source_index)
+        if not proxy_index.isValid():
+            if not clear_search:
+                return
+            self.search_edit.clear()
+            proxy_index = self.server_proxy.mapFromSource(source_index)
+        self.combo.setCurrentIndex(proxy_index.row())
+
+    def _sample_throughput(self):
+        """Sample traffic of the active connection in the background, and show its rates."""
+        if self._sampling:
+            return
+        self._sampling = True
+        self._run_in_background(self._read_throughput, self._show_throughput, self._throughput_failed)
+
+    def _read_throughput(self):
+        """Return rates of the active connection, see stats.Sampler.rates()."""
+        return self.stats_sampler.rates() if self.stats_sampler.sample() else None
+
+    def _show_throughput(self, rates):
+        self._sampling = False
+        if not rates or not self.throughput_timer.isActive():
+            return
+        self.throughput_label.setText(
+            f'\u2193 {stats.format_rate(rates["rx_rate"])} (avg {stats.format_rate(rates["rx_avg"])})   '
+            f'\u2191 {stats.format_rate(rates["tx_rate"])} (avg {stats.format_rate(rates["tx_avg"])})'
+        )
+        self.throughput_label.show()
+
+    def _throughput_failed(self, exc):
+        self._sampling = False
+        logger.error('Sampling throughput failed: %s', exc)
 
     def closeEvent(self, event):
         """Catch close event. If active VPN connection, ask for confirmation."""
-        if self.wireguard_interface:
+        if self.busy:
+            QMessageBox.information(self, 'Information', 'Please wait until the VPN connection has changed.')
+            event.ignore()
+        elif self.wireguard_interface:
             reply = QMessageBox.question(
                 self, 'Quit', 'Are you sure you want to quit and stop the active VPN?'
             )
-            if reply == QMessageBox.StandardButtons.Yes:
-                self.toggle_connect(force_off=True)
-            else:
-                event.ignore()
+            if reply == QMessageBox.StandardButton.Yes:
+                # Close window as soon as the VPN is down:
+                self.toggle_connect(force_off=True, on_done=self.close)
+            event.ignore()
 
     def update_connectivity(self):
         """Find out which VPN connection currently exists, and update GUI accordingly.
 
-        This method will be called regularly via self.connectivity_update_timer.
+        This method will be called whenever a network interface was added or
+        removed, or regularly via self.connectivity_update_timer if link
+        notifications are not available.
         Background: The VPN connection cannot only be changed thru the MozVPN GUI,
         but also via the command line tools. This method syncs the state of the GUI
         with the real actual VPN situation of the system.
         """
-        logger.debug('Updatting connectivity status via timer.')
-        iface = wireguard.interface()
+        if self.busy:
+            # The GUI is changing the connection itself, and will update afterwards.
+            return
+        logger.debug('Updating connectivity status.')
+        self._run_in_background(self._active_server, self._connectivity_updated,
+                                lambda exc: logger.error('Updating connectivity status failed: %s', exc))
+
+    def _connectivity_updated(self, iface):
+        """Update GUI with interface reported by update_connectivity()."""
+        if self.busy:
+            # Result is outdated, a connection change was started meanwhile.
+            return
         if iface != self.wireguard_interface:
             self.wireguard_interface = iface
             self.update_gui_activity_status()
@@ -114,47 +391,102 @@ class MainWindow(QMainWindow):
         else:
             button_text = 'Disconnect'
             button_color = 'red'
-            idx = self.combo.findData(self.wireguard_interface)
-            self.combo.setCurrentIndex(idx)
+            self._select_server(self.wireguard_interface)
         self.connect_button.setText(button_text)
         self.connect_button.setStyleSheet(f"background-color: {button_color}")
-        self.combo.setEnabled(self.wireguard_interface is None)
+        self.combo.setEnabled(self.wireguard_interface is None and not self.busy)
+        self.search_edit.setEnabled(self.wireguard_interface is None and not self.busy)
+        if self.wireguard_interface and not self.busy:
+            if not self.throughput_timer.isActive():
+                self.throughput_timer.start()
+        else:
+            self.throughput_timer.stop()
+            self.throughput_label.hide()
+        self.connect_button.setEnabled(not self.busy)
 
-    def toggle_connect(self, force_off: bool = False):
+    def set_busy(self, busy: bool, text: str = ''):
+        """Show or hide the progress indicator, and disable the controls while busy."""
+        self.busy = busy
+        self.progress_bar.setFormat(text)
+        self.progress_bar.setVisible(busy)
+        self.cancel_button.setVisible(busy)
+        self.cancel_button.setEnabled(busy)
+        self.update_gui_activity_status()
+
+    def cancel_command(self):
+        """Cancel the running connect or disconnect command."""
+        self.cancel_button.setEnabled(False)
+        self.progress_bar.setFormat('Cancelling ...')
+        self.cancel_event.set()
+
+    def toggle_connect(self, force_off: bool = False, on_done=None):
         """Toggle (connect or disconnect) Mozilla VPN connection.
 
+        The wireguard commands run in the background, meanwhile a progress
+        indicator is shown and the command can be cancelled.
+
         Args:
             force_off: if True this command only works for turning off VPN.
+            on_done: optional function, called after the VPN was toggled successfully.
         """
-        try:
-            if not self.wireguard_interface and not force_off:
-                iface = wireguard.interface()
-                if iface:
-                    QMessageBox.warning(self, 'Warning', 'VPN is already running!')
-                else:
-                    iface = self.combo.currentData()
-                    wireguard.connect(iface)
-            else:
-                iface = wireguard.interface()
-                if iface != self.wireguard_interface:
-                    # This should actually not happen: The GUI shows a different VPN
-                    # interface than the one reported by wireguard. This can only happen
-                    # if the VPN was changed outside the GUI, e.g. via mozpvn command line.
-                    logger.warning(f'wireguard interface shown in GUI ({self.wireguard_interface}) '
-                                   f'does not match interface reported by "wg show" command ({iface}).')
+        if self.busy:
+            return
+        connect = not self.wireguard_interface and not force_off
+        shown_iface = self.wireguard_interface
+        target_iface = self.combo.currentData()
+        if connect and not target_iface:
+            # The search text may hide all servers:
+            QMessageBox.information(self, 'Information', 'No server selected, please change the search.')
+            return
+        cancel = self.cancel_event
+        cancel.clear()
+
+        def toggle():
+            """Change VPN connectivity, return new interface or a warning message."""
+            backend = daemon.backend()
+            iface = backend.active_server()
+            if connect:
                 if iface:
-                    # Could be None if VPN connection was already down or turned off otherwise.
-                    wireguard.disconnect(iface)
-                iface = None
-        except wireguard.CommandError as exc:
-            QMessageBox.critical(self, 'Error', f'Unexpected error:\n{exc}')
-        else:
+                    return iface, 'VPN is already running!'
+                backend.connect(target_iface, cancel=cancel)
+                return target_iface, None
+            if iface != shown_iface:
+                # This should actually not happen: The GUI shows a different VPN
+                # interface than the one reported by wireguard. This can only happen
+                # if the VPN was changed outside the GUI, e.g. via mozpvn command line.
+                logger.warning(f'wireguard interface shown in GUI ({shown_iface}) '
+                               f'does not match interface reported by "wg show" command ({iface}).')
+            if iface:
+                # Could be None if VPN connection was already down or turned off otherwise.
+                backend.disconnect(iface, cancel=cancel)
+            return None, None
+
+        def finished(result):
+            iface, warning = result
+            self.set_busy(False)
             self.wireguard_interface = iface
             self.update_gui_activity_status()
+            if warning:
+                QMessageBox.warning(self, 'Warning', warning)
+            elif on_done:
+                on_done()
+
+        def failed(exc):
+            self.set_busy(False)
+            if isinstance(exc, wireguard.CommandCancelled):
+                QMessageBox.information(self, 'Information', 'Cancelled.')
+            else:
+                QMessageBox.critical(self, 'Error', f'Unexpected error:\n{exc}')
+            # The command may have been interrupted halfway, so check real state:
+            self.update_connectivity()
+
+        self.set_busy(True, 'Connecting ...' if connect else 'Disconnecting ...')
+        self._run_in_background(toggle, finished, failed)
 
 
 def gui():
     """Main gui function, to be called from cli.py"""
     app = QApplication([])
     _ = MainWindow()
-    app.exec()
+    if app.exec():
+        raise wireguard.ControlledExit()
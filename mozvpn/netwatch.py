@@ -0,0 +1,83 @@
+"""Event-driven detection of network interface changes via rtnetlink (Linux only)."""
+import errno
+import socket
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Constants from <linux/rtnetlink.h>:
+RTMGRP_LINK = 0x1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+# struct nlmsghdr: length, type, flags, sequence number, port id
+NLMSGHDR = struct.Struct('=LHHLL')
+
+
+def link_changed(data: bytes) -> bool:
+    """Return True if the netlink messages in data notify about an added,
+    removed or changed interface."""
+    changed = False
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            changed = True
+        if length < NLMSGHDR.size:
+            break
+        # Netlink messages are aligned to 4 bytes:
+        offset += (length + 3) & ~3
+    return changed
+
+
+class LinkMonitor:
+    """Subscription to link notifications of the kernel.
+
+    The kernel sends a message whenever a network interface is added, removed
+    or changed. The socket becomes readable then, so it can be watched by any
+    event loop (select, QSocketNotifier, ...) without polling.
+
+    Raises:
+        OSError if rtnetlink is not available (e.g. on non-Linux systems).
+    """
+
+    def __init__(self):
+        if not hasattr(socket, 'AF_NETLINK'):
+            raise OSError('rtnetlink is not supported on this platform')
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK,
+                                  socket.NETLINK_ROUTE)
+        try:
+            self.sock.bind((0, RTMGRP_LINK))
+        except OSError:
+            self.sock.close()
+            raise
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def changed(self) -> bool:
+        """Read all pending notifications.
+
+        Returns:
+            True if an interface was added, removed or changed since the last call.
+        Raises:
+            OSError if the socket failed, then the caller should fall back to
+            polling, since the socket might stay readable.
+        """
+        changed = False
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                if exc.errno != errno.ENOBUFS:
+                    raise
+                # Notifications were dropped, so the state is unknown:
+                logger.debug('Link notifications were dropped: %s', exc)
+                return True
+            changed = link_changed(data) or changed
+        return changed
+
+    def close(self):
+        self.sock.close()
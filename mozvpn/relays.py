@@ -0,0 +1,171 @@
+"""Incremental installation of relay configurations, see 'mozvpn setup --incremental'.
+
+The installed wireguard configurations are only readable by root, so a
+manifest next to them records the sha256 hash of each one. Comparing freshly
+downloaded configurations against it tells which relays are new, changed or
+gone; only those are geolocated and installed, and locations.csv is merged.
+"""
+import os
+import csv
+import json
+import shlex
+import hashlib
+import logging
+import pathlib
+from typing import Dict, Iterable, List, Tuple
+
+from mozvpn import catalog, wgconfig, wghelper, wireguard
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'mozvpn-manifest.json'
+LOCATIONS_NAME = 'locations.csv'
+SNAPSHOT_NAME = 'locations.bin'
+
+
+def file_hash(path) -> str:
+    """Return sha256 hash of file content."""
+    with open(path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def config_hashes(directory) -> Dict[str, str]:
+    """Return {file name: hash} of all wireguard configs in directory."""
+    return {path.name: file_hash(path) for path in wgconfig.discover_configs([directory])}
+
+
+def read_manifest(directory) -> Dict[str, str]:
+    """Return {file name: hash} of the configs installed in directory, empty if unknown."""
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as exc:
+        logger.info('No manifest of installed configurations: %s', exc)
+        return {}
+
+
+def write_manifest(directory, hashes: Dict[str, str] = None):
+    """Write manifest of the configs in directory (or of the given hashes) into directory."""
+    if hashes is None:
+        hashes = config_hashes(directory)
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as fp:
+        json.dump(hashes, fp, indent=0, sort_keys=True)
+
+
+def read_locations(path) -> Dict[str, Dict]:
+    """Return {interface: row} of a locations.csv file, empty if it does not exist."""
+    try:
+        with open(path, newline='') as fp:
+            return {row['interface']: row for row in csv.DictReader(fp)}
+    except FileNotFoundError:
+        return {}
+
+
+def compare(new: Dict[str, str], installed: Dict[str, str]) -> Tuple[List[str], List[str]]:
+    """Compare hashes of downloaded and installed configs.
+
+    Returns:
+        (names of new or changed configs, names of configs not downloaded anymore)
+    """
+    changed = sorted(name for name, digest in new.items() if installed.get(name) != digest)
+    removed = sorted(name for name in installed if name not in new)
+    return changed, removed
+
+
+def prepare_update(download_dir, etc_dir: str = None, keep: Iterable[str] = ()) -> Tuple[List[str], List[str]]:
+    """Prepare installing the configs downloaded into download_dir incrementally.
+
+    New and changed configs (and those missing in locations.csv) are
+    geolocated, and the merged locations.csv, its snapshot and the new
+    manifest are written to download_dir.
+
+    Args:
+        download_dir: directory containing the downloaded configs.
+        etc_dir: directory of the installed configs, defaults to wireguard.WIREGUARD_ETC_DIR.
+        keep: interfaces which must not be removed, even if not downloaded anymore
+            (e.g. the active one).
+    Returns:
+        (names of the files in download_dir to install, names of configs to remove)
+    """
+    # Imported here, since only needed for setting up:
+    from mozvpn import mozvpn
+    from mozvpn.geocache import GeoCache
+
+    etc_dir = etc_dir or wireguard.WIREGUARD_ETC_DIR
+    download_dir = pathlib.Path(download_dir)
+    new_hashes = config_hashes(download_dir)
+    installed = read_manifest(etc_dir)
+    locations = read_locations(os.path.join(etc_dir, LOCATIONS_NAME))
+    changed, removed = compare(new_hashes, installed)
+    kept = [name for name in removed if name[:-len('.conf')] in keep]
+    removed = [name for name in removed if name not in kept]
+    # Also locate configs missing in locations.csv, or lacking columns added later:
+    to_locate = [name for name in new_hashes if name in changed
+                 or not all(field in locations.get(name[:-len('.conf')], {}) for field in mozvpn.LOCATIONS_FIELDS)]
+    logger.info('%d configs changed, %d removed, %d to geolocate', len(changed), len(removed), len(to_locate))
+    if not (changed or removed or to_locate):
+        return [], []
+
+    cache = GeoCache()
+    try:
+        for row in mozvpn.iter_vpn_server_locations([str(download_dir / name) for name in to_locate], cache=cache):
+            locations[row['interface']] = row
+    finally:
+        if cache.modified:
+            cache.save()
+    for name in removed:
+        locations.pop(name[:-len('.conf')], None)
+
+    def sort_key(row):
+        match = mozvpn.WG_INTERFACE_RE.match(row['interface'])
+        return match.groups() if match else (row['interface'],)
+
+    rows = sorted(locations.values(), key=sort_key)
+    csv_path = download_dir / LOCATIONS_NAME
+    with open(csv_path, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, mozvpn.LOCATIONS_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    catalog.ServerCatalog.from_records(rows).write_snapshot(csv_path)
+    write_manifest(download_dir, dict(new_hashes, **{name: installed[name] for name in kept}))
+    return changed + [LOCATIONS_NAME, SNAPSHOT_NAME, MANIFEST_NAME], removed
+
+
+def install_commands(download_dir, files: List[str], removed: List[str], etc_dir: str = None) -> List[str]:
+    """Return commands (to be run as root) installing files from download_dir,
+    and removing configs.
+
+    Every file is copied next to its destination first and then renamed, so
+    it is replaced atomically. Timestamps are preserved, since the snapshot
+    of locations.csv refers to its modification time.
+
+    Raises:
+        RuntimeError if a file name is neither a server config nor one of the catalog files.
+    """
+    etc_dir = etc_dir or wireguard.WIREGUARD_ETC_DIR
+    cmds = []
+    for name in files:
+        mode = '440' if name.endswith('.conf') else '444'
+        _check_name(name)
+        source = shlex.quote(os.path.join(str(download_dir), name))
+        tmp_path = shlex.quote(os.path.join(etc_dir, f'.{name}.tmp'))
+        path = shlex.quote(os.path.join(etc_dir, name))
+        cmds.append(f'install -p -o root -g root -m {mode} {source} {tmp_path}')
+        cmds.append(f'mv -f {tmp_path} {path}')
+    for name in removed:
+        cmds.append(f'rm -f {shlex.quote(os.path.join(etc_dir, _check_name(name)))}')
+    return cmds
+
+
+def _check_name(name: str) -> str:
+    """Return name if it is safe to put into a command run as root.
+
+    The names come from the downloaded relay list, so they are restricted to
+    those 'mozvpn-helper' accepts (see wghelper.NAME_PATTERN), plus the
+    catalog files; the commands are also formatted with str.format(), so
+    braces must not pass either.
+    """
+    if name not in (LOCATIONS_NAME, SNAPSHOT_NAME, MANIFEST_NAME) and not (
+            name.endswith('.conf') and wghelper.NAME_PATTERN.fullmatch(name[:-len('.conf')])):
+        raise RuntimeError(f'Invalid relay file name "{name}"')
+    return name
@@ -0,0 +1,220 @@
+"""Compact binary snapshot of the server catalog, loaded via mmap.
+
+The snapshot is written next to locations.csv (as locations.bin) by
+'mozvpn geolocate'. It contains all server records, their precomputed
+display strings and the catalog's lookup indexes, so loading it only maps
+the file into memory; records and index entries are decoded on access.
+
+File layout (all integers little endian):
+    header: magic, format version, number of records, size and mtime of
+            the csv file the snapshot was made from
+    section table: (offset, length) of each section
+    sections: string blob (utf8), followed by uint32 arrays:
+        - string offsets of all record fields (len(FIELDS) per record)
+        - per index: string offsets of the sorted keys, offsets into the
+          postings array per key, postings (record positions)
+      and a float64 array (8 byte aligned):
+        - unit vectors (x, y, z) of the servers' locations, NaN if unknown
+"""
+import os
+import sys
+import mmap
+import bisect
+import struct
+import logging
+import pathlib
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MOZVPNCT'
+VERSION = 2
+FIELDS = ('interface', 'ip', 'country', 'region', 'city', 'loc', 'display')
+INDEX_FIELDS = ('interface', 'country', 'region', 'city')
+# magic, version, number of records, csv size, csv mtime (ns)
+HEADER = struct.Struct('<8sHxxIQq')
+SECTION = struct.Struct('<II')
+# string blob, record fields, three sections per index, and unit vectors:
+NUM_SECTIONS = 3 + 3 * len(INDEX_FIELDS)
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot is missing, malformed or out of date."""
+
+
+def snapshot_path(csv_path) -> pathlib.Path:
+    """Return path of the snapshot belonging to a locations csv file."""
+    return pathlib.Path(csv_path).with_suffix('.bin')
+
+
+def write_snapshot(servers: List[Dict], indexes: Dict[str, Dict[str, List[int]]], vectors: Iterable[float],
+                   csv_path, path=None):
+    """Write snapshot of a server catalog.
+
+    The snapshot is bound to the current size and modification time of the
+    csv file, so it has to be written after the csv file is complete.
+
+    Args:
+        servers: server records containing (at least) all FIELDS.
+        indexes: for each of INDEX_FIELDS a mapping of key -> record positions.
+        vectors: unit vectors of the servers' locations, three floats per server.
+        csv_path: locations csv file the servers were read from.
+        path: snapshot file, defaults to snapshot_path(csv_path).
+    """
+    path = pathlib.Path(path) if path else snapshot_path(csv_path)
+    blob = bytearray()
+
+    def add_strings(strings):
+        offsets = array('I', [len(blob)])
+        for string in strings:
+            blob.extend((string or '').encode('utf8'))
+            offsets.append(len(blob))
+        return offsets
+
+    arrays = [add_strings(server.get(field) for server in servers for field in FIELDS)]
+    for field in INDEX_FIELDS:
+        keys = sorted(indexes[field])
+        postings = array('I')
+        postings_offsets = array('I', [0])
+        for key in keys:
+            postings.extend(indexes[field][key])
+            postings_offsets.append(len(postings))
+        arrays.extend([add_strings(keys), postings_offsets, postings])
+    arrays.append(array('d', vectors))
+
+    if sys.byteorder != 'little':
+        for arr in arrays:
+            arr.byteswap()
+    sections = []
+    offset = HEADER.size + NUM_SECTIONS * SECTION.size
+    sections.append((offset, len(blob)))
+    offset += len(blob)
+    for arr in arrays:
+        # Align each array to its item size:
+        offset += -offset % arr.itemsize
+        nbytes = len(arr) * arr.itemsize
+        sections.append((offset, nbytes))
+        offset += nbytes
+
+    csv_stat = os.stat(csv_path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with open(tmp_path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(servers), csv_stat.st_size, csv_stat.st_mtime_ns))
+        for section in sections:
+            fp.write(SECTION.pack(*section))
+        fp.write(blob)
+        for arr, (offset, _) in zip(arrays, sections[1:]):
+            fp.write(bytes(offset - fp.tell()))
+            arr.tofile(fp)
+    os.replace(tmp_path, path)
+
+
+class _Strings(Sequence):
+    """Strings from the snapshot's blob, addressed by an array of offsets."""
+
+    def __init__(self, blob: memoryview, offsets: memoryview):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return str(self.blob[self.offsets[idx]:self.offsets[idx + 1]], 'utf8')
+
+
+class _Records(Sequence):
+    """Server records of the snapshot, decoded on access."""
+
+    def __init__(self, blob: memoryview, offsets: memoryview, count: int):
+        self.strings = _Strings(blob, offsets)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, pos):
+        if not 0 <= pos < self.count:
+            raise IndexError(pos)
+        base = pos * len(FIELDS)
+        return {field: self.strings[base + idx] for idx, field in enumerate(FIELDS)}
+
+
+class _Index(Mapping):
+    """Index of the snapshot: sorted keys, looked up by binary search."""
+
+    def __init__(self, keys: _Strings, postings_offsets: memoryview, postings: memoryview):
+        self._keys = keys
+        self.postings_offsets = postings_offsets
+        self.postings = postings
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, key):
+        idx = bisect.bisect_left(self._keys, key)
+        if idx == len(self._keys) or self._keys[idx] != key:
+            raise KeyError(key)
+        return self.postings[self.postings_offsets[idx]:self.postings_offsets[idx + 1]].tolist()
+
+
+class Snapshot:
+    """Memory mapped catalog snapshot.
+
+    Attributes:
+        servers: sequence of server records (dicts with FIELDS)
+        indexes: for each of INDEX_FIELDS a mapping of key -> record positions
+        vectors: unit vectors of the servers' locations, see catalog.ServerCatalog.unit_vectors()
+
+    Raises:
+        SnapshotError if the snapshot is missing, malformed, or older than
+        the csv file.
+    """
+
+    def __init__(self, csv_path, path=None):
+        path = pathlib.Path(path) if path else snapshot_path(csv_path)
+        if sys.byteorder != 'little':
+            raise SnapshotError('Snapshots are only supported on little endian systems')
+        try:
+            csv_stat = os.stat(csv_path)
+            with open(path, 'rb') as fp:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as exc:
+            raise SnapshotError(f'Cannot open snapshot {path}: {exc}') from exc
+        try:
+            self._load(csv_stat)
+        except (struct.error, ValueError, TypeError) as exc:
+            raise SnapshotError(f'Malformed snapshot {path}: {exc}') from exc
+
+    def _load(self, csv_stat):
+        magic, version, count, csv_size, csv_mtime_ns = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError('Snapshot has unknown format')
+        if (csv_size, csv_mtime_ns) != (csv_stat.st_size, csv_stat.st_mtime_ns):
+            raise SnapshotError('Snapshot is out of date')
+        data = memoryview(self._mmap)
+        sections = []
+        for no in range(NUM_SECTIONS):
+            offset, length = SECTION.unpack_from(self._mmap, HEADER.size + no * SECTION.size)
+            if offset + length > len(self._mmap):
+                raise ValueError('section exceeds file size')
+            sections.append(data[offset:offset + length])
+        blob = sections[0]
+        arrays = [section.cast('I') for section in sections[1:-1]]
+        if len(arrays[0]) != count * len(FIELDS) + 1:
+            raise ValueError('record count does not match')
+        self.vectors = sections[-1].cast('d')
+        if len(self.vectors) != 3 * count:
+            raise ValueError('number of unit vectors does not match')
+        self.servers = _Records(blob, arrays[0], count)
+        self.indexes = {}
+        for no, field in enumerate(INDEX_FIELDS):
+            keys, postings_offsets, postings = arrays[1 + 3 * no:4 + 3 * no]
+            self.indexes[field] = _Index(_Strings(blob, keys), postings_offsets, postings)
@@ -0,0 +1,177 @@
+"""Traffic statistics of the active VPN tunnel.
+
+The byte counters of the wireguard interface are sampled periodically into a
+ring buffer of fixed capacity (plain arrays of floats), so memory use does
+not grow with uptime. Rates are computed between the last two samples, and
+as moving average over a time window.
+
+The counters are read from sysfs (no privileges needed), or from the peer
+statistics of the monitor (see monitor.read_peer_stats()) where sysfs is not
+available.
+"""
+import os
+import time
+import logging
+from array import array
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from mozvpn import defaults, monitor, wireguard
+
+logger = logging.getLogger(__name__)
+
+# Number of samples kept, e.g. two minutes at one sample per second:
+DEFAULT_CAPACITY = 120
+DEFAULT_INTERVAL = defaults.STATS_INTERVAL
+DEFAULT_WINDOW = defaults.STATS_WINDOW
+SIZE_UNITS = ('B', 'kB', 'MB', 'GB', 'TB')
+RATE_UNITS = tuple(f'{unit}/s' for unit in SIZE_UNITS)
+
+
+def read_counters(iface: str) -> Optional[Tuple[int, int]]:
+    """Return (received, sent) bytes of interface, or None if it does not exist."""
+    statistics_dir = os.path.join(wireguard.SYS_CLASS_NET_DIR, iface, 'statistics')
+    try:
+        with open(os.path.join(statistics_dir, 'rx_bytes')) as rx_fp, \
+                open(os.path.join(statistics_dir, 'tx_bytes')) as tx_fp:
+            return int(rx_fp.read()), int(tx_fp.read())
+    except (OSError, ValueError):
+        pass
+    try:
+        peer = monitor.read_peer_stats(iface)
+    except (wireguard.CommandError, ValueError) as exc:
+        logger.info('Cannot read transfer statistics of %s: %s', iface, exc)
+        return None
+    return (peer.rx, peer.tx) if peer else None
+
+
+class RingBuffer:
+    """Fixed number of (time, rx, tx) samples, the oldest are overwritten."""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        if capacity < 2:
+            raise ValueError('capacity must be at least 2')
+        self.capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._rx = array('d', bytes(8 * capacity))
+        self._tx = array('d', bytes(8 * capacity))
+        # Position of the next sample, and number of samples stored:
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def append(self, timestamp: float, rx: float, tx: float):
+        pos = self._next
+        self._times[pos] = timestamp
+        self._rx[pos] = rx
+        self._tx[pos] = tx
+        self._next = (pos + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def __getitem__(self, idx: int) -> Tuple[float, float, float]:
+        """Return (time, rx, tx) of sample idx, 0 being the oldest and -1 the latest sample."""
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError('sample index out of range')
+        pos = (self._next - self._count + idx) % self.capacity
+        return self._times[pos], self._rx[pos], self._tx[pos]
+
+    def __iter__(self) -> Iterator[Tuple[float, float, float]]:
+        for idx in range(self._count):
+            yield self[idx]
+
+
+class Sampler:
+    """Sample the byte counters of the active VPN interface into a ring buffer."""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, window: float = DEFAULT_WINDOW,
+                 interface: Callable[[], Optional[str]] = None, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            capacity: number of samples kept.
+            window: seconds covered by the moving averages.
+            interface: returns the active interface, defaults to wireguard.interface().
+            clock: returns the current time in seconds.
+        """
+        self.buffer = RingBuffer(capacity)
+        self.window = window
+        self.interface = interface or wireguard.interface
+        self.clock = clock
+        self.iface = None
+
+    def sample(self) -> bool:
+        """Add a sample of the active interface.
+
+        The samples are discarded whenever the interface changes or its
+        counters were reset (i.e. it was recreated).
+
+        Returns:
+            False if not connected.
+        """
+        iface = self.interface()
+        counters = read_counters(iface) if iface else None
+        if counters is None:
+            self.iface = None
+            self.buffer.clear()
+            return False
+        if iface != self.iface or (self.buffer and (counters[0] < self.buffer[-1][1] or counters[1] < self.buffer[-1][2])):
+            self.iface = iface
+            self.buffer.clear()
+        self.buffer.append(self.clock(), *counters)
+        return True
+
+    def rates(self) -> Optional[Dict]:
+        """Return current and average rates of the active interface, or None
+        if there are not enough samples yet.
+
+        Returns:
+            {'interface': 'de4-wireguard', 'rx_bytes': total received, 'tx_bytes': total sent,
+             'rx_rate': bytes/s, 'tx_rate': bytes/s, 'rx_avg': bytes/s, 'tx_avg': bytes/s}
+        """
+        if len(self.buffer) < 2:
+            return None
+        latest = self.buffer[-1]
+        previous = first = self.buffer[-2]
+        # Find the oldest sample within the window:
+        for idx in range(len(self.buffer) - 2):
+            sample = self.buffer[idx]
+            if latest[0] - sample[0] <= self.window:
+                first = sample
+                break
+        if latest[0] <= previous[0]:
+            return None
+        return {
+            'interface': self.iface,
+            'rx_bytes': int(latest[1]),
+            'tx_bytes': int(latest[2]),
+            'rx_rate': (latest[1] - previous[1]) / (latest[0] - previous[0]),
+            'tx_rate': (latest[2] - previous[2]) / (latest[0] - previous[0]),
+            'rx_avg': (latest[1] - first[1]) / (latest[0] - first[0]),
+            'tx_avg': (latest[2] - first[2]) / (latest[0] - first[0]),
+        }
+
+
+def _format(value: float, units: Tuple[str, ...]) -> str:
+    for unit in units[:-1]:
+        if abs(value) < 1000:
+            break
+        value /= 1000
+    else:
+        unit = units[-1]
+    return f'{value:.0f} {unit}' if unit == units[0] else f'{value:.1f} {unit}'
+
+
+def format_rate(rate: float) -> str:
+    """Return rate in bytes per second as human readable text, e.g. '1.2 MB/s'."""
+    return _format(rate, RATE_UNITS)
+
+
+def format_bytes(size: float) -> str:
+    """Return size in bytes as human readable text, e.g. '1.2 GB'."""
+    return _format(size, SIZE_UNITS)
@@ -0,0 +1,194 @@
+"""Parser for wireguard configuration files, as used by wg-quick.
+
+Example of a config file as written by 'mozwire relay save':
+
+    [Interface]
+    PrivateKey = 8GboYh0YF3q/hJhoPFoL3HM/ObgOuC8YI6UXWsgWL2M=
+    Address = 10.66.127.32/32,fc00:bbbb:bbbb:bb01::3:7f1f/128
+    DNS = 10.64.0.1
+
+    [Peer]
+    PublicKey = 7ncQXMKpxdDMa7VZpEFWivpYpsFNcYd5JSpNkWnLhGQ=
+    AllowedIPs = 0.0.0.0/0,::0/0
+    Endpoint = 185.213.155.73:51820
+"""
+import os
+import logging
+import pathlib
+import ipaddress
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 51820
+
+
+class ConfigError(Exception):
+    """Raised when a wireguard config file cannot be parsed."""
+
+
+@dataclass
+class WireguardConfig:
+    """Settings of one VPN server, i.e. of one wireguard config file.
+
+    Only the first [Peer] section is taken into account, since server configs
+    contain exactly one peer.
+    """
+    __slots__ = ('interface', 'path', 'private_key', 'address', 'dns', 'mtu',
+                 'public_key', 'endpoint_host', 'endpoint_port', 'allowed_ips')
+    interface: str
+    path: pathlib.Path
+    private_key: Optional[str]
+    address: Tuple[str, ...]
+    dns: Tuple[str, ...]
+    mtu: Optional[int]
+    public_key: Optional[str]
+    endpoint_host: Optional[str]
+    endpoint_port: Optional[int]
+    allowed_ips: Tuple[str, ...]
+
+    @property
+    def endpoint_ip(self) -> Optional[str]:
+        """Endpoint host if it is an IP address (and not a hostname), otherwise None."""
+        try:
+            return str(ipaddress.ip_address(self.endpoint_host))
+        except ValueError:
+            return None
+
+    def interface_settings(self) -> tuple:
+        """Settings of the [Interface] section, for comparing the local side of configs."""
+        return self.private_key, self.address, self.dns, self.mtu
+
+
+def split_endpoint(endpoint: str) -> Tuple[str, int]:
+    """Split endpoint into host and port.
+
+    Examples:
+        '185.213.155.73:51820' -> ('185.213.155.73', 51820)
+        '[2a03:1b20:1:f011::a01f]:51820' -> ('2a03:1b20:1:f011::a01f', 51820)
+        'de4.relays.example.com' -> ('de4.relays.example.com', 51820)
+    Raises:
+        ConfigError if the port is invalid.
+    """
+    if endpoint.startswith('['):
+        host, sep, port = endpoint[1:].partition(']')
+        port = port[1:] if port.startswith(':') else ''
+    elif endpoint.count(':') == 1:
+        host, _, port = endpoint.partition(':')
+    else:
+        # Hostname or IPv4 address without port, or bare IPv6 address:
+        host, port = endpoint, ''
+    try:
+        return host, int(port) if port else DEFAULT_PORT
+    except ValueError:
+        raise ConfigError(f'Invalid endpoint "{endpoint}"') from None
+
+
+def _split_list(value: str) -> Tuple[str, ...]:
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def parse_config(text: str, interface: str, path: pathlib.Path = None) -> WireguardConfig:
+    """Parse content of a wireguard config file in a single pass.
+
+    Args:
+        text: content of the config file
+        interface: interface name, i.e. the name of the config file without '.conf'
+        path: path of the config file, for reference only
+    Raises:
+        ConfigError if the content is malformed.
+    """
+    interface_settings = {}
+    peer_settings = {}
+    settings = None
+    peers = 0
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith('['):
+            section = line.lower()
+            if section == '[interface]':
+                settings = interface_settings
+            elif section == '[peer]':
+                peers += 1
+                settings = peer_settings if peers == 1 else {}
+            else:
+                settings = {}
+            continue
+        key, sep, value = line.partition('=')
+        if not sep or settings is None:
+            raise ConfigError(f'{path or interface}, line {line_no}: invalid line "{line}"')
+        # Keys are case insensitive; lists may be spread over several lines:
+        key = key.strip().lower()
+        value = value.strip()
+        if key in settings and key in ('address', 'dns', 'allowedips'):
+            settings[key] += ',' + value
+        else:
+            settings[key] = value
+
+    endpoint_host = endpoint_port = None
+    if 'endpoint' in peer_settings:
+        endpoint_host, endpoint_port = split_endpoint(peer_settings['endpoint'])
+    mtu = interface_settings.get('mtu')
+    try:
+        mtu = int(mtu) if mtu else None
+    except ValueError:
+        raise ConfigError(f'{path or interface}: invalid MTU "{mtu}"') from None
+    return WireguardConfig(
+        interface=interface,
+        path=path,
+        private_key=interface_settings.get('privatekey'),
+        address=_split_list(interface_settings.get('address', '')),
+        dns=_split_list(interface_settings.get('dns', '')),
+        mtu=mtu,
+        public_key=peer_settings.get('publickey'),
+        endpoint_host=endpoint_host,
+        endpoint_port=endpoint_port,
+        allowed_ips=_split_list(peer_settings.get('allowedips', '')),
+    )
+
+
+def read_config(path: pathlib.Path) -> WireguardConfig:
+    """Read and parse wireguard config file.
+
+    Raises:
+        OSError if the file cannot be read, ConfigError if it is malformed.
+    """
+    path = pathlib.Path(path)
+    with open(path, encoding='utf8') as fp:
+        return parse_config(fp.read(), path.stem, path)
+
+
+def discover_configs(paths: Iterable[str]) -> Iterator[pathlib.Path]:
+    """Yield paths of wireguard config files.
+
+    Args:
+        paths: wireguard config files, or directories containing them.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.conf') and entry.is_file():
+                        yield pathlib.Path(entry.path)
+        else:
+            # The file itself is assumed to be a wireguard config file:
+            yield pathlib.Path(path)
+
+
+def read_configs(paths: Iterable[str]) -> List[WireguardConfig]:
+    """Read all wireguard config files from the given files/directories,
+    sorted by interface name. Malformed files are logged and skipped.
+
+    Raises:
+        OSError if a file cannot be read.
+    """
+    configs = []
+    for path in discover_configs(paths):
+        try:
+            configs.append(read_config(path))
+        except ConfigError as exc:
+            logger.warning('Skipping wireguard config %s: %s', path, exc)
+    return sorted(configs, key=lambda conf: conf.interface)
@@ -0,0 +1,157 @@
+#!/usr/bin/python3 -I
+"""Privileged helper of mozvpn, run as root via sudo.
+
+'mozvpn setup' installs a root-owned copy of this file as HELPER_PATH, and
+allows members of group mozvpn to run it (besides 'wg-quick up|down') via
+sudo. It only accepts server names and takes all peer settings from the
+server's config file in /etc/wireguard, so it cannot be used to configure
+arbitrary peers, keys or interface settings.
+
+Since the installed mozvpn package may be writable by its users, this file
+must not import anything but the standard library.
+
+Usage:
+    mozvpn-helper switch INTERFACE SERVER
+    mozvpn-helper dump INTERFACE
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+HELPER_PATH = '/usr/local/sbin/mozvpn-helper'
+WIREGUARD_ETC_DIR = '/etc/wireguard'
+# Only look up 'wg' in directories writable by root, see wireguard.check_wireguard_commands():
+SECURE_PATH = '/usr/bin:/bin:/usr/sbin:/usr/local/bin:/usr/local/sbin'
+SYS_CLASS_NET_DIR = '/sys/class/net'
+# Root-owned directory recording which server an interface was switched to,
+# so all users and programs agree on it, see wireguard.active_server():
+STATE_DIR = '/run/mozvpn'
+STATE_FILE = 'active.json'
+# Names of interfaces and servers, as installed by 'mozvpn setup':
+NAME_PATTERN = re.compile(r'[A-Za-z0-9_]+(-[A-Za-z0-9_]+)*-wireguard')
+
+
+class HelperError(Exception):
+    """Raised when a request is invalid or cannot be carried out."""
+
+
+def check_name(name: str) -> str:
+    """Return name if it is a valid interface or server name, e.g. 'de4-wireguard'."""
+    if not NAME_PATTERN.fullmatch(name) or len(name) > 64:
+        raise HelperError(f'Invalid name "{name}"')
+    return name
+
+
+def read_peer(server: str, etc_dir: str = WIREGUARD_ETC_DIR) -> dict:
+    """Return public key, endpoint and allowed IPs of the first peer in the server's config file."""
+    path = os.path.join(etc_dir, f'{check_name(server)}.conf')
+    peer = {'publickey': None, 'endpoint': None, 'allowedips': []}
+    section = None
+    with open(path) as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if line.startswith('['):
+                if section == 'peer':
+                    break
+                section = line.strip('[]').strip().lower()
+            elif section == 'peer' and '=' in line:
+                key, value = (part.strip() for part in line.split('=', 1))
+                key = key.lower()
+                if key == 'allowedips':
+                    peer[key].extend(ip.strip() for ip in value.split(',') if ip.strip())
+                elif key in peer:
+                    peer[key] = value
+    if not (peer['publickey'] and peer['endpoint'] and peer['allowedips']):
+        raise HelperError(f'Peer settings in {path} are incomplete')
+    return peer
+
+
+def wg(*args: str) -> str:
+    """Run 'wg' with args, and return its output."""
+    wg_path = shutil.which('wg', path=SECURE_PATH)
+    if not wg_path:
+        raise HelperError('Could not find wireguard command "wg"')
+    proc = subprocess.run([wg_path, *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode:
+        raise HelperError(proc.stderr.strip() or f'wg failed with exit code {proc.returncode}')
+    return proc.stdout
+
+
+def ifindex(iface: str):
+    """Return kernel index of interface, which changes whenever it is recreated, or None."""
+    try:
+        with open(os.path.join(SYS_CLASS_NET_DIR, iface, 'ifindex')) as fp:
+            return int(fp.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_state(iface: str, server: str):
+    """Record that interface was switched to server, readable by everyone."""
+    os.makedirs(STATE_DIR, mode=0o755, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=STATE_DIR, prefix='.active')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'interface': iface, 'ifindex': ifindex(iface), 'server': server}, fp)
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, os.path.join(STATE_DIR, STATE_FILE))
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def switch(iface: str, server: str, etc_dir: str = WIREGUARD_ETC_DIR):
+    """Replace all peers of the running interface by the peer of server, and record the switch."""
+    check_name(iface)
+    peer = read_peer(server, etc_dir)
+    args = ['set', iface]
+    for public_key in wg('show', iface, 'peers').split():
+        if public_key != peer['publickey']:
+            args += ['peer', public_key, 'remove']
+    args += ['peer', peer['publickey'], 'endpoint', peer['endpoint'], 'allowed-ips', ','.join(peer['allowedips'])]
+    wg(*args)
+    write_state(iface, server)
+
+
+def dump(iface: str):
+    """Print 'wg show INTERFACE dump' without the private and preshared keys.
+
+    The first line describes the interface and lacks its private key, i.e. it
+    reads 'public-key  listen-port  fwmark'; the preshared key of each peer
+    line is replaced by '(hidden)', so the peer lines keep their format.
+    """
+    lines = wg('show', check_name(iface), 'dump').splitlines()
+    if lines:
+        lines[0] = '\t'.join(lines[0].split('\t')[1:])
+    for pos, line in enumerate(lines[1:], 1):
+        fields = line.split('\t')
+        if len(fields) > 1:
+            fields[1] = '(hidden)'
+        lines[pos] = '\t'.join(fields)
+    print('\n'.join(lines))
+
+
+# Commands with their number of arguments; etc_dir is never taken from the command line:
+COMMANDS = {'switch': (switch, 2), 'dump': (dump, 1)}
+
+
+def main(argv=None) -> int:
+    args = sys.argv[1:] if argv is None else argv
+    command, nargs = COMMANDS.get(args[0], (None, None)) if args else (None, None)
+    if not command or len(args) - 1 != nargs:
+        print('Usage:' + __doc__.split('Usage:')[1].rstrip(), file=sys.stderr)
+        return 2
+    try:
+        command(*args[1:])
+    except (HelperError, OSError) as exc:
+        print(f'Error: {exc}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,20 @@
 """
 Functions for interacting with wireguard command line tools.
 """
+import os
+import json
+import stat
+import time
+import queue
 import shutil
 import logging
+import pathlib
 import tempfile
+import threading
 import subprocess
+from typing import Optional
 
-import requests
+from mozvpn import httpclient, metrics, wgconfig, wghelper
 
 logger = logging.getLogger(__name__)
 
@@ -14,12 +22,32 @@ logger = logging.getLogger(__name__)
 # ### This should be refactored in order to support Windows as well.
 # Wireguard commands:
 WIREGUARD_QUICK_CMD = 'sudo -n wg-quick {cmd} {cfg}'
+# Replace the peer of a running interface by the one of another server, see module wghelper:
+WIREGUARD_SWITCH_CMD = 'sudo -n {helper} switch {iface} {server}'
 # 'wg show' requires sudo:
 # WIREGUARD_SHOW_CMD = 'sudo -n wg show'
+# Peer statistics of an interface without its keys, see monitor.parse_dump() and module wghelper:
+WIREGUARD_SHOW_DUMP_CMD = 'sudo -n {helper} dump {iface}'
 # 'wg show interfaces' does not require sudo:
 WIREGUARD_SHOW_INTERFACES_CMD = 'wg show interfaces'
 WIREGUARD_ETC_DIR = '/etc/wireguard'
+# Network interfaces are listed here on Linux; kernel wireguard interfaces
+# are marked with 'DEVTYPE=wireguard' in their uevent file:
+SYS_CLASS_NET_DIR = '/sys/class/net'
+# Userspace implementations (wireguard-go, boringtun) create a control socket
+# per interface here:
+WIREGUARD_RUN_DIR = '/var/run/wireguard'
 WIREGUARD_LOCATIONS_FILE = '/etc/wireguard/locations.csv'
+# Maximum runtime of external commands in seconds:
+COMMAND_TIMEOUT = 20
+# Interval in seconds to check whether a running command should be cancelled:
+CANCEL_CHECK_INTERVAL = 0.1
+# Functions of this module asked concurrently for the external IP address, see hedged_ip_lookup():
+IP_PROVIDERS = ('ipinfo', 'mullvad_info')
+# Seconds to wait for the first valid answer of the IP providers:
+IP_LOOKUP_TIMEOUT = 15
+# Seconds the external IP address is reused while the connection stays the same:
+IP_CACHE_TTL = 300
 
 
 class WireguardError(Exception):
@@ -36,11 +64,16 @@ class CommandError(Exception):
         return f'Command failed:\n"{self.cmd}"\nMessage: {str(self)}'
 
 
+class CommandCancelled(CommandError):
+    """Raised when a running command was cancelled on request."""
+
+
 class ControlledExit(Exception):
     """Raise when error handling is finished and program can gracefully exit."""
 
 
-def run_command(cmd: str, shell: bool = False, verbose: bool = False, dry_run: bool = False) -> str:
+def run_command(cmd: str, shell: bool = False, verbose: bool = False, dry_run: bool = False,
+                cancel: threading.Event = None) -> str:
     """Run external command, and collect results or errors.
 
     Args:
@@ -49,31 +82,61 @@ def run_command(cmd: str, shell: bool = False, verbose: bool = False, dry_run: b
         verbose: if True print command to stdout.
         dry_run: if True then the commands will only be written to stdout only.
             and not executed.
+        cancel: if given, the command gets terminated as soon as this event is set.
 
     Raises:
         CommandError in case of failling command execution.
+        CommandCancelled if the command was cancelled via the 'cancel' event.
     """
     run_cmd = cmd if shell else cmd.split()
     if verbose or dry_run:
         print(cmd)
     if dry_run:
         return
+    start = time.perf_counter()
+    status = 'error'
     try:
-        proc = subprocess.run(run_cmd, timeout=20, shell=shell, capture_output=True)
-    except FileNotFoundError as exc:
-        logger.exception(f'Running "{cmd}" failed. Details:')
-        raise CommandError(exc, cmd) from exc
-    except subprocess.SubprocessError as exc:
-        logger.exception(exc)
-        raise CommandError(f'Unexpected error: {str(exc)}', cmd) from exc
+        try:
+            proc = subprocess.Popen(run_cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError as exc:
+            logger.exception(f'Running "{cmd}" failed. Details:')
+            raise CommandError(exc, cmd) from exc
+        except subprocess.SubprocessError as exc:
+            logger.exception(exc)
+            raise CommandError(f'Unexpected error: {str(exc)}', cmd) from exc
+        deadline = time.monotonic() + COMMAND_TIMEOUT
+        with proc:
+            while True:
+                try:
+                    stdout, stderr = proc.communicate(
+                        timeout=CANCEL_CHECK_INTERVAL if cancel is not None else COMMAND_TIMEOUT
+                    )
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancel is not None and cancel.is_set():
+                        proc.terminate()
+                        proc.communicate()
+                        status = 'cancelled'
+                        logger.info('Command "%s" cancelled', cmd)
+                        raise CommandCancelled('Command was cancelled', cmd)
+                    if time.monotonic() >= deadline:
+                        proc.kill()
+                        proc.communicate()
+                        status = 'timeout'
+                        exc = subprocess.TimeoutExpired(run_cmd, COMMAND_TIMEOUT)
+                        logger.error(exc)
+                        raise CommandError(f'Unexpected error: {str(exc)}', cmd) from exc
+        status = str(proc.returncode)
+    finally:
+        metrics.record_command(cmd, time.perf_counter() - start, status)
     if proc.returncode:
-        err = proc.stderr.decode('utf8')
+        err = stderr.decode('utf8')
         logger.error('Command "%s" failed: %s', cmd, err)
         raise CommandError(err, cmd)
-    return proc.stdout.decode('utf8').strip()
+    return stdout.decode('utf8').strip()
 
 
-def connect(conf_or_if: str):
+def connect(conf_or_if: str, cancel: threading.Event = None):
     """Establish connection to VPN server via wg-quick command.
 
     Args:
@@ -82,12 +145,13 @@ def connect(conf_or_if: str):
             - Name of wireguard interface, e.g. "us122-wireguard"
               In this case the corresponding configuration file has to exist
               in the /etc/wireguard/ directory.
+        cancel: if given, setting this event aborts the connection attempt.
     """
     wg_quick_cmd = WIREGUARD_QUICK_CMD.format(cmd='up', cfg=conf_or_if)
-    run_command(wg_quick_cmd)
+    run_command(wg_quick_cmd, cancel=cancel)
 
 
-def disconnect(conf_or_if: str):
+def disconnect(conf_or_if: str, cancel: threading.Event = None):
     """Shut down connection to VPN server via wg-quick command.
 
     Args:
@@ -96,9 +160,141 @@ def disconnect(conf_or_if: str):
             - Name of wireguard interface, e.g. "us122-wireguard"
               In this case the corresponding configuration file has to exist
               at /etc/wireguard/INTERFACE.conf.
+            - Name of the server the interface was switched to, see switch().
+        cancel: if given, setting this event aborts the shutdown.
     """
+    state = _read_state()
+    if state.get('server') == conf_or_if and _active_server(state['interface']) == conf_or_if:
+        conf_or_if = state['interface']
     wg_quick_cmd = WIREGUARD_QUICK_CMD.format(cmd='down', cfg=conf_or_if)
-    run_command(wg_quick_cmd)
+    run_command(wg_quick_cmd, cancel=cancel)
+
+
+def switch(server: str, cancel: threading.Event = None) -> str:
+    """Switch the active VPN connection to another server.
+
+    If both servers only differ in their peer (public key and endpoint),
+    the peer of the running interface is replaced (by the root-owned helper,
+    see module wghelper), so the interface, its routes and DNS settings stay
+    in place and the connection is only interrupted until the first
+    handshake with the new server.
+    Otherwise, or if replacing the peer fails, the connection is shut down
+    and set up again.
+
+    Since the interface keeps its name, the helper records the server it was
+    switched to in a root-owned state file, see active_server().
+
+    Args:
+        server: interface name of the new server, e.g. "nl2-wireguard".
+        cancel: if given, setting this event aborts the switch.
+    Returns:
+        'peer' if only the peer was replaced, 'reconnect' otherwise.
+    Raises:
+        WireguardError if no VPN connection is active.
+        CommandError if reconnecting failed.
+    """
+    iface = interface()
+    if not iface:
+        raise WireguardError('Not connected')
+    if _can_replace_peer(_active_server(iface), server):
+        try:
+            run_command(WIREGUARD_SWITCH_CMD.format(helper=wghelper.HELPER_PATH, iface=iface, server=server), cancel=cancel)
+        except CommandCancelled:
+            raise
+        except CommandError as exc:
+            logger.warning('Replacing peer failed, reconnecting instead: %s', exc)
+        else:
+            return 'peer'
+    disconnect(iface, cancel=cancel)
+    connect(server, cancel=cancel)
+    return 'reconnect'
+
+
+def _can_replace_peer(current: str, server: str) -> bool:
+    """Return True if the peer of the current server can be replaced by the
+    one of the new server, i.e. both only differ in their peer."""
+    try:
+        old = wgconfig.read_config(os.path.join(WIREGUARD_ETC_DIR, f'{current}.conf'))
+        new = wgconfig.read_config(os.path.join(WIREGUARD_ETC_DIR, f'{server}.conf'))
+    except (OSError, wgconfig.ConfigError) as exc:
+        logger.info('Cannot compare server configurations: %s', exc)
+        return False
+    # wg-quick derived addresses, DNS and routes from the interface's config,
+    # so these must not change:
+    if old.interface_settings() != new.interface_settings() or old.allowed_ips != new.allowed_ips:
+        logger.info('Servers %s and %s differ in more than their peer', current, server)
+        return False
+    if not (old.public_key and new.public_key and new.endpoint_host and new.allowed_ips):
+        logger.info('Peer settings of %s or %s are incomplete', current, server)
+        return False
+    return True
+
+
+def runtime_dir() -> pathlib.Path:
+    """Return private directory for runtime files of the user (e.g. the daemon's
+    socket), within the user's runtime directory, which is cleared on logout.
+
+    The directory is created if missing. An existing one is refused unless it
+    is owned by the user and not accessible by others, since it may have been
+    created by another user (e.g. in /tmp, if XDG_RUNTIME_DIR is not set).
+
+    Raises:
+        PermissionError if the directory is not private to the user.
+    """
+    base_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    path = pathlib.Path(base_dir) / f'mozvpn-{os.getuid()}'
+    try:
+        path.mkdir(mode=0o700, parents=True)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'Runtime directory {path} must be a directory owned by you with mode 0700')
+    return path
+
+
+def state_path() -> pathlib.Path:
+    """Return path of the file recording which server an interface was switched to, see module wghelper."""
+    return pathlib.Path(wghelper.STATE_DIR) / wghelper.STATE_FILE
+
+
+def _ifindex(iface: str) -> Optional[int]:
+    """Return kernel index of interface, which changes whenever it is recreated."""
+    try:
+        with open(os.path.join(SYS_CLASS_NET_DIR, iface, 'ifindex')) as fp:
+            return int(fp.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _read_state() -> dict:
+    try:
+        with open(state_path()) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def _active_server(iface: str) -> str:
+    # The state is only cleared by a reboot, but it is only valid as long as
+    # the interface is not recreated (by disconnecting or connecting):
+    state = _read_state()
+    if state.get('interface') == iface and state.get('ifindex') is not None and state['ifindex'] == _ifindex(iface):
+        return state['server']
+    return iface
+
+
+def active_server() -> Optional[str]:
+    """Return server of the active VPN connection.
+
+    This is the name of the connected interface, unless the interface was
+    switched to another server via switch().
+
+    Returns:
+        Server name (e.g. 'nl2-wireguard'), or None if not connected.
+    """
+    iface = interface()
+    return _active_server(iface) if iface else None
 
 
 def ipinfo():
@@ -117,7 +313,7 @@ def ipinfo():
           "readme": "https://ipinfo.io/missingauth"
         }
     """
-    res = requests.get('https://ipinfo.io')
+    res = httpclient.get('https://ipinfo.io')
     return res.json()
 
 
@@ -138,10 +334,99 @@ def mullvad_info():
           "organization": "Telecom"
         }
     """
-    res = requests.get('https://am.i.mullvad.net/json')
+    res = httpclient.get('https://am.i.mullvad.net/json')
     return res.json()
 
 
+def hedged_ip_lookup(providers=None, timeout: float = IP_LOOKUP_TIMEOUT) -> dict:
+    """Ask all IP providers at once and return the first valid answer.
+
+    The lookup takes as long as the fastest provider answering, slow or
+    failing providers do not delay it (they are left running in the background).
+
+    Args:
+        providers: functions returning JSON with key 'ip', defaults to IP_PROVIDERS.
+        timeout: seconds to wait for a valid answer.
+    Returns:
+        Answer of the fastest provider, see ipinfo() and mullvad_info().
+    Raises:
+        OSError if no provider answered with an IP address in time.
+    """
+    providers = providers or [globals()[name] for name in IP_PROVIDERS]
+    answers = queue.Queue()
+
+    def ask(provider):
+        try:
+            answers.put((provider, provider(), None))
+        except Exception as exc:  # passed on to the caller
+            answers.put((provider, None, exc))
+
+    for provider in providers:
+        # Daemon threads, so a hanging provider does not delay exiting:
+        threading.Thread(target=ask, args=(provider,), daemon=True).start()
+    deadline = time.monotonic() + timeout
+    error = 'timed out'
+    for _ in providers:
+        try:
+            provider, info, exc = answers.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if isinstance(info, dict) and info.get('ip'):
+            return info
+        error = exc or f'no ip address in answer of {provider.__name__}'
+        logger.info('IP lookup via %s failed: %s', provider.__name__, error)
+    raise OSError(f'Cannot determine external ip address: {error}')
+
+
+def ip_cache_path() -> pathlib.Path:
+    """Return path of the file caching the external IP address, see external_ip()."""
+    return runtime_dir() / 'ip.json'
+
+
+def _connection_key() -> list:
+    """Return [interface, ifindex, server] of the active connection, which
+    changes on every (re)connect or switch."""
+    iface = interface()
+    return [iface, _ifindex(iface), _active_server(iface)] if iface else [None, None, None]
+
+
+def external_ip(refresh: bool = False) -> dict:
+    """Return externally visible IP information, cached for the active connection.
+
+    The cached answer is reused for IP_CACHE_TTL seconds, unless the
+    connection changed in the meantime. Otherwise all IP providers are asked
+    at once, see hedged_ip_lookup().
+
+    Args:
+        refresh: if True look up the IP address, even if it is cached.
+    Returns:
+        JSON with at least key 'ip', see ipinfo() and mullvad_info().
+    Raises:
+        OSError if the IP address cannot be determined.
+    """
+    key = _connection_key()
+    path = ip_cache_path()
+    if not refresh:
+        try:
+            with open(path) as fp:
+                cached = json.load(fp)
+            if cached['key'] == key and 0 <= time.time() - cached['time'] < IP_CACHE_TTL:
+                return cached['info']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    info = hedged_ip_lookup()
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix='.ip')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'key': key, 'time': time.time(), 'info': info}, fp)
+        os.replace(tmp_name, path)
+    except OSError as exc:
+        os.unlink(tmp_name)
+        logger.warning('Cannot cache external ip address: %s', exc)
+    return info
+
+
 def status(ip: bool = False) -> str:
     """Show status of VPN connection.
 
@@ -155,29 +440,63 @@ def status(ip: bool = False) -> str:
         - 'Connected to de10-wireguard'
         - 'Connected to de10-wireguard, ip: 234.12.642.0'
     """
-    iface = interface()
-    if iface:
-        if ip:
-            ip_addr = ipinfo()["ip"]
-            ip_info = f', ip: {ip_addr}'
-        else:
-            ip_info = ''
-        stat_info = f'Connected to: {iface}{ip_info}'
-    else:
-        stat_info = 'Not connected'
-    return stat_info
+    server = active_server()
+    return status_text(server, external_ip()['ip'] if server and ip else None)
+
+
+def status_text(server: Optional[str], ip_addr: str = None) -> str:
+    """Return status of VPN connection to server (None if not connected), see status()."""
+    if not server:
+        return 'Not connected'
+    ip_info = f', ip: {ip_addr}' if ip_addr else ''
+    return f'Connected to: {server}{ip_info}'
 
 
 def interface() -> str:
     """Return interface of VPN connection, if available.
 
+    On Linux the interfaces are determined from sysfs, otherwise the 'wg'
+    command is used.
+
     Returns:
         Name of connected interface (e.g. 'de12-wireguard), otherwise None, if not connected.
     """
-    iface = run_command(WIREGUARD_SHOW_INTERFACES_CMD)
+    ifaces = sysfs_interfaces()
+    if ifaces is None:
+        iface = run_command(WIREGUARD_SHOW_INTERFACES_CMD)
+    else:
+        iface = ' '.join(ifaces)
     return iface if iface else None
 
 
+def sysfs_interfaces() -> list:
+    """Find wireguard interfaces without running the 'wg' command.
+
+    Returns:
+        Sorted list of wireguard interface names, or None if sysfs is not
+        available (i.e. not running on Linux).
+    """
+    try:
+        links = os.listdir(SYS_CLASS_NET_DIR)
+    except OSError:
+        return None
+    ifaces = set()
+    for link in links:
+        try:
+            with open(os.path.join(SYS_CLASS_NET_DIR, link, 'uevent')) as fp:
+                if 'DEVTYPE=wireguard\n' in fp.read():
+                    ifaces.add(link)
+        except OSError:
+            # Interface vanished meanwhile
+            continue
+    try:
+        sockets = os.listdir(WIREGUARD_RUN_DIR)
+    except OSError:
+        sockets = []
+    ifaces.update(name[:-5] for name in sockets if name.endswith('.sock') and name[:-5] in links)
+    return sorted(ifaces)
+
+
 def check_wireguard_commands() -> dict:
     """Check absolute path to 'wg' and 'wg-quick' commands if they are installed
        and executable.
@@ -202,26 +521,33 @@ def check_wireguard_commands() -> dict:
     return full_cmds
 
 
+# Note that '*' in sudoers also matches spaces, so 'wg' itself is not allowed
+# (it could set arbitrary keys and peers, and 'wg show' prints private keys);
+# the helper only accepts server names:
 NON_ROOT_SETUP_COMMANDS_LINUX = [
     'chmod 700 {tmp_dir}',
-    ('echo "%mozvpn ALL = (root) NOPASSWD: {wg-quick} up *-wireguard, {wg-quick} down *-wireguard" '
-     '> {tmp_dir}/mozvpn.sudo'),
+    ('echo "%mozvpn ALL = (root) NOPASSWD: {wg-quick} up *-wireguard, {wg-quick} down *-wireguard, '
+     '{helper}" > {tmp_dir}/mozvpn.sudo'),
     'mozwire relay save -o {tmp_dir} -n {limit}',
-    'mozvpn geolocate {tmp_dir} -o {tmp_dir}/locations.csv',
 ]
+# Only for full setup, incremental setup geolocates changed relays only:
+GEOLOCATE_COMMAND_LINUX = 'mozvpn geolocate {tmp_dir} -o {tmp_dir}/locations.csv'
 ROOT_SETUP_COMMANDS_LINUX = [
     'groupadd -f mozvpn',
     'usermod -a -G mozvpn {user}',
     'chown root.root {tmp_dir}/*',
     'mv {tmp_dir}/mozvpn.sudo /etc/sudoers.d/mozvpn',
     'chmod 440 /etc/sudoers.d/mozvpn',
+    'install -D -o root -g root -m 755 {helper_source} {helper}',
     'mkdir -p /etc/wireguard',
+]
+ROOT_INSTALL_COMMANDS_LINUX = [
     'mv {tmp_dir}/* {wireguard_etc_dir}',
     'chmod 440 {wireguard_etc_dir}/*.conf',
 ]
 
 
-def setup_wireguard_configuration(user: str, verbose: bool, dry_run: bool, limit: int):
+def setup_wireguard_configuration(user: str, verbose: bool, dry_run: bool, limit: int, incremental: bool = False):
     """Setup configurations needed to operate wireguard.
 
     Args:
@@ -230,20 +556,43 @@ def setup_wireguard_configuration(user: str, verbose: bool, dry_run: bool, limit
         dry_run: if True then the commands will only be written to stdout only.
         limit: Limit the number of servers downloaded via mozwire
             and not executed.
+        incremental: if True only geolocate and install relays which are new
+            or changed since the last setup, see module relays.
     """
+    # Imported here, since relays depends on this module:
+    from mozvpn import relays
+
     params = check_wireguard_commands()
     params['user'] = user
     params['limit'] = limit
     params['wireguard_etc_dir'] = WIREGUARD_ETC_DIR
+    params['helper'] = wghelper.HELPER_PATH
+    params['helper_source'] = os.path.abspath(wghelper.__file__)
 
     with tempfile.TemporaryDirectory() as tmp_dir:
         params['tmp_dir'] = tmp_dir
 
-        for cmd in NON_ROOT_SETUP_COMMANDS_LINUX:
+        non_root_cmds = NON_ROOT_SETUP_COMMANDS_LINUX if incremental else NON_ROOT_SETUP_COMMANDS_LINUX + [GEOLOCATE_COMMAND_LINUX]
+        for cmd in non_root_cmds:
             scmd = cmd.format(**params)
             run_command(scmd, shell=True, verbose=verbose, dry_run=dry_run)
 
-        for cmd in ROOT_SETUP_COMMANDS_LINUX:
+        if incremental and dry_run:
+            print('# Changed relays are only known after downloading, installing them is not shown.')
+            install_cmds = []
+        elif incremental:
+            active = interface()
+            files, removed = relays.prepare_update(tmp_dir, keep=[active] if active else [])
+            install_cmds = relays.install_commands(tmp_dir, files, removed)
+            changed = [name for name in files if name.endswith('.conf')]
+            print(f'{len(changed)} relays new or changed, {len(removed)} removed.')
+        elif dry_run:
+            install_cmds = ROOT_INSTALL_COMMANDS_LINUX
+        else:
+            relays.write_manifest(tmp_dir)
+            install_cmds = ROOT_INSTALL_COMMANDS_LINUX
+
+        for cmd in ROOT_SETUP_COMMANDS_LINUX + install_cmds:
             scmd = 'sudo ' + cmd.format(**params)
             run_command(scmd, shell=True, verbose=verbose, dry_run=dry_run)
 
@@ -36,6 +36,7 @@ setup(
         'console_scripts': [
             'mozvpn=mozvpn.cli:main',
             'xmozvpn=mozvpn.cli:xmozvpn',
+            'mozvpnd=mozvpn.cli:mozvpnd',
         ],
     },
     install_requires=requirements,
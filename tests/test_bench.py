@@ -0,0 +1,84 @@
+"""Tests for the server benchmark, against a local stand-in target."""
+import io
+import csv
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mozvpn import bench, monitor, wireguard
+
+DOWNLOAD_SIZE = 1000000
+
+
+class DownloadHandler(BaseHTTPRequestHandler):
+    """Answer every GET request with DOWNLOAD_SIZE bytes."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(DOWNLOAD_SIZE))
+        self.end_headers()
+        self.wfile.write(bytes(DOWNLOAD_SIZE))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def target():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DownloadHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield 'http://%s:%d/download' % server.server_address
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_percentiles():
+    values = list(range(1, 101))
+    assert bench.percentile(values, 50) == 50.5
+    assert bench.percentile(values, 99) == pytest.approx(99.01)
+    assert bench.summarize([3.0]) == {'n': 1, 'p50': 3.0, 'p95': 3.0, 'p99': 3.0}
+    assert bench.summarize([]) == {'n': 0, 'p50': None, 'p95': None, 'p99': None}
+
+
+def test_run(target, monkeypatch):
+    """Each server is connected, measured and disconnected in every round."""
+    calls = []
+
+    class Backend:
+        connect = staticmethod(lambda server: calls.append(('up', server)))
+        disconnect = staticmethod(lambda server: calls.append(('down', server)))
+
+    # The first handshake is reported on the third check:
+    checks = []
+
+    def read_peer_stats(iface):
+        checks.append(iface)
+        return monitor.PeerStats('key=', '1.2.3.4:51820', 1700000000 if len(checks) % 3 == 0 else 0, 0, 0)
+    monkeypatch.setattr(monitor, 'read_peer_stats', read_peer_stats)
+    monkeypatch.setattr(wireguard, 'interface', lambda: 'wg0')
+    monkeypatch.setattr(bench, 'HANDSHAKE_POLL_INTERVAL', 0.001)
+
+    samples = bench.run(['de1-wireguard', 'nl1-wireguard'], url=target, rounds=2, pings=5, backend=Backend)
+    assert calls == [('up', 'de1-wireguard'), ('down', 'de1-wireguard'),
+                     ('up', 'nl1-wireguard'), ('down', 'nl1-wireguard')] * 2
+    assert [(sample['server'], sample['round']) for sample in samples] == \
+        [('de1-wireguard', 1), ('nl1-wireguard', 1), ('de1-wireguard', 2), ('nl1-wireguard', 2)]
+    assert all(len(sample['latency']) == 5 and sample['throughput'] > 0 for sample in samples)
+    assert all(sample['handshake'] >= sample['connect'] for sample in samples)
+    assert len(checks) == 12
+
+    summary = bench.summarize_samples(samples)
+    assert summary['de1-wireguard']['latency']['n'] == 10
+    assert summary['nl1-wireguard']['connect']['n'] == 2
+
+    output = io.StringIO()
+    bench.write_json(output, samples)
+    assert json.loads(output.getvalue())['summary'] == json.loads(json.dumps(summary))
+    output = io.StringIO()
+    bench.write_csv(output, samples)
+    rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+    assert [(row['server'], row['metric']) for row in rows[:4]] == [('de1-wireguard', metric) for metric in bench.METRICS]
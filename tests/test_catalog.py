@@ -0,0 +1,111 @@
+"""Tests for the VPN server catalog."""
+from click.testing import CliRunner
+
+from mozvpn import catalog, cli, mozvpn, snapshot, wireguard
+
+LOCATIONS_CSV = '''interface,ip,country,region,city,loc
+ch1-wireguard,1.1.1.1,CH,Zurich,Zürich,"47.3667,8.5500"
+ch2-wireguard,1.1.1.2,CH,Zurich,Zürich,"47.3667,8.5500"
+de1-wireguard,2.2.2.1,DE,Hesse,Frankfurt am Main,"50.1155,8.6842"
+de2-wireguard,2.2.2.2,DE,Berlin,Berlin,"52.5244,13.4105"
+'''
+
+
+def test_find_servers(tmp_path):
+    """Locations are matched case and accent insensitively, and approximately."""
+    locations_file = tmp_path / 'locations.csv'
+    locations_file.write_text(LOCATIONS_CSV)
+    server_catalog = catalog.ServerCatalog.load(locations_file)
+
+    assert [s['interface'] for s in server_catalog.find(city='zurich')] == ['ch1-wireguard', 'ch2-wireguard']
+    assert [s['interface'] for s in server_catalog.find(country='de', city='Frankfurt am Mian')] == ['de1-wireguard']
+    assert server_catalog.find(country='ch', city='berlin') == []
+    assert server_catalog.find(city='Tokyo') == []
+    assert server_catalog.choose(country='DE')['interface'] == 'de1-wireguard'
+    assert server_catalog.server('de2-wireguard')['city'] == 'Berlin'
+
+
+def test_up_by_location(tmp_path, monkeypatch):
+    """'mozvpn up' connects to a server at the given location."""
+    locations_file = tmp_path / 'locations.csv'
+    locations_file.write_text(LOCATIONS_CSV)
+    monkeypatch.setattr(wireguard, 'WIREGUARD_LOCATIONS_FILE', str(locations_file))
+    monkeypatch.setattr(wireguard, 'interface', lambda: None)
+    # No mozvpn daemon is running here:
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    connected = []
+    monkeypatch.setattr(wireguard, 'connect', connected.append)
+
+    result = CliRunner().invoke(cli.main, ['up', '--city', 'berlin'])
+    assert result.exit_code == 0
+    assert connected == ['de2-wireguard']
+
+
+def test_snapshot(tmp_path):
+    """A catalog loaded from its snapshot equals the one read from csv, until the csv changes."""
+    locations_file = tmp_path / 'locations.csv'
+    locations_file.write_text(LOCATIONS_CSV)
+    csv_catalog = catalog.ServerCatalog.load(locations_file)
+    csv_catalog.write_snapshot(locations_file)
+
+    snap_catalog = catalog.ServerCatalog.load(locations_file)
+    assert not isinstance(snap_catalog.indexes['city'], dict)
+    assert list(snap_catalog.servers) == csv_catalog.servers
+    assert snap_catalog.servers[0]['display'] == 'CH - Zurich - Zürich (ch1)'
+    assert snap_catalog.find(country='DE', city='Frankfurt') == csv_catalog.find(country='DE', city='Frankfurt')
+    assert snap_catalog.server('de2-wireguard')['city'] == 'Berlin'
+    assert snap_catalog.server('xx1-wireguard') is None
+    assert list(snap_catalog.unit_vectors()) == list(csv_catalog.unit_vectors())
+
+    locations_file.write_text(LOCATIONS_CSV + 'at1-wireguard,3.3.3.3,AT,Vienna,Vienna\n')
+    assert len(catalog.ServerCatalog.load(locations_file)) == 5
+
+
+def test_geolocate_writes_snapshot(tmp_path, monkeypatch):
+    """'mozvpn geolocate -o FILE' writes a snapshot next to the csv file."""
+    (tmp_path / 'de1-wireguard.conf').write_text('[Peer]\nEndpoint = 1.1.1.1:51820\n')
+    monkeypatch.setattr(mozvpn, 'determine_ip_location', lambda ip, **kwargs: {'country': 'DE', 'city': 'Berlin'})
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    locations_file = tmp_path / 'locations.csv'
+
+    result = CliRunner().invoke(cli.main, ['geolocate', str(tmp_path), '-o', str(locations_file)])
+    assert result.exit_code == 0
+    snap = snapshot.Snapshot(locations_file)
+    assert snap.servers[0]['display'] == 'DE -  - Berlin (de1)'
+
+
+def test_nearest(tmp_path):
+    """Servers are ranked by great-circle distance, servers without location are left out."""
+    locations_file = tmp_path / 'locations.csv'
+    locations_file.write_text(LOCATIONS_CSV + 'at1-wireguard,3.3.3.3,AT,Vienna,Vienna,\n')
+    server_catalog = catalog.ServerCatalog.load(locations_file)
+
+    # Near Mainz, Frankfurt is 30 km away, Zürich 300 km and Berlin 460 km:
+    nearest = server_catalog.nearest(50.0, 8.27, k=3)
+    assert [server['interface'] for server, _ in nearest] == ['de1-wireguard', 'ch1-wireguard', 'ch2-wireguard']
+    assert 25 < nearest[0][1] < 35 and 280 < nearest[1][1] < 320
+    assert len(server_catalog.nearest(50.0, 8.27, k=10)) == 4
+    assert server_catalog.choose(near=(52.0, 13.0))['interface'] == 'de2-wireguard'
+    assert server_catalog.choose(country='CH', near=(52.0, 13.0))['interface'] == 'ch1-wireguard'
+    assert server_catalog.choose(country='AT', near=(52.0, 13.0)) is None
+
+    assert catalog.parse_coordinates(' 50.1155, 8.6842') == (50.1155, 8.6842)
+    assert catalog.parse_coordinates('') is None
+    assert catalog.parse_coordinates('95,10') is None
+
+
+def test_up_nearest(tmp_path, monkeypatch):
+    """'mozvpn up --nearest' connects to the server nearest to given coordinates or to the ip address."""
+    locations_file = tmp_path / 'locations.csv'
+    locations_file.write_text(LOCATIONS_CSV)
+    monkeypatch.setattr(wireguard, 'WIREGUARD_LOCATIONS_FILE', str(locations_file))
+    monkeypatch.setattr(wireguard, 'interface', lambda: None)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    monkeypatch.setattr(wireguard, 'external_ip', lambda: {'ip': '9.9.9.9', 'loc': '47.0,8.0'})
+    connected = []
+    monkeypatch.setattr(wireguard, 'connect', connected.append)
+
+    assert CliRunner().invoke(cli.main, ['up', '--nearest', '52,13']).exit_code == 0
+    assert CliRunner().invoke(cli.main, ['up', '--nearest', 'auto']).exit_code == 0
+    assert connected == ['de2-wireguard', 'ch1-wireguard']
+    assert CliRunner().invoke(cli.main, ['up', '--nearest', 'here']).exit_code == 2
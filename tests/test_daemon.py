@@ -0,0 +1,149 @@
+"""Tests for the mozvpn daemon and its client."""
+import os
+import socket
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+from mozvpn import cli, daemon, wireguard
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """Daemon running in a thread, listening on the default socket within tmp_path."""
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    monkeypatch.setattr(wireguard, 'SYS_CLASS_NET_DIR', str(tmp_path / 'net'))
+    server = daemon.make_server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.daemon.close()
+    thread.join()
+
+
+def test_client_commands(server, monkeypatch):
+    """Commands are run by the daemon, errors are raised again by the client."""
+    connected = []
+
+    def connect(conf_or_if, cancel):
+        connected.append(conf_or_if)
+        monkeypatch.setattr(wireguard, 'interface', lambda: conf_or_if)
+    monkeypatch.setattr(wireguard, 'interface', lambda: None)
+    monkeypatch.setattr(wireguard, 'connect', connect)
+
+    client = daemon.backend()
+    assert isinstance(client, daemon.Client)
+    assert client.status() == 'Not connected'
+    client.connect('de4-wireguard')
+    assert connected == ['de4-wireguard']
+    assert client.active_server() == 'de4-wireguard'
+    assert client.status() == 'Connected to: de4-wireguard'
+
+    def run_command(cmd, **kwargs):
+        raise wireguard.CommandError('sudo: a password is required', cmd)
+    monkeypatch.setattr(wireguard, 'run_command', run_command)
+    with pytest.raises(wireguard.CommandError) as excinfo:
+        client.disconnect('de4-wireguard')
+    assert excinfo.value.cmd == 'sudo -n wg-quick down de4-wireguard'
+
+    with pytest.raises(daemon.DaemonError):
+        daemon.make_server()
+
+
+def test_cli_uses_daemon(server, monkeypatch):
+    """The CLI asks the daemon if it is running, and controls wireguard directly otherwise."""
+    monkeypatch.setattr(server.daemon, 'active_server', lambda: 'nl2-wireguard')
+    monkeypatch.setattr(wireguard, 'interface', lambda: 'de4-wireguard')
+    result = CliRunner().invoke(cli.main, ['status'])
+    assert result.output == 'Connected to: nl2-wireguard\n'
+
+    # As on exit of serve():
+    server.shutdown()
+    server.server_close()
+    os.unlink(server.server_address)
+    result = CliRunner().invoke(cli.main, ['status'])
+    assert result.output == 'Connected to: de4-wireguard\n'
+
+
+def test_backend_cached(server, monkeypatch):
+    """The daemon is pinged again only after a while, or when it refused a connection."""
+    pings = []
+    monkeypatch.setattr(server.daemon, 'ping', lambda: pings.append(1) or True)
+    client = daemon.backend()
+    assert daemon.backend() is client
+    assert len(pings) == 1
+    server.shutdown()
+    server.server_close()
+    with pytest.raises(ConnectionRefusedError):
+        client.active_server()
+    assert daemon.backend() is wireguard
+
+
+def test_client_errors(tmp_path):
+    """A daemon answering garbage is not running, one not answering at all times out."""
+    path = str(tmp_path / 'mozvpnd.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(path)
+        listener.listen(1)
+
+        def answer():
+            conn, _ = listener.accept()
+            with conn:
+                conn.sendall(b'garbage\n')
+        thread = threading.Thread(target=answer)
+        thread.start()
+        assert not daemon.Client(path).running()
+        thread.join()
+
+        with pytest.raises(socket.timeout):
+            daemon.Client(path)._call('status', timeout=0.1)
+
+
+def test_insecure_runtime_dir(tmp_path, monkeypatch):
+    """A runtime directory accessible by other users is not used for the socket."""
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    wireguard.runtime_dir().chmod(0o777)
+    assert daemon.backend() is wireguard
+    with pytest.raises(daemon.DaemonError, match='mode 0700'):
+        daemon.make_server()
+
+
+def test_client_timeouts(monkeypatch):
+    """Only queries time out, changing the connection may take arbitrarily long."""
+    timeouts = {}
+
+    def call(self, command, args=None, cancel=None, timeout=daemon.CALL_TIMEOUT):
+        timeouts[command] = timeout
+    monkeypatch.setattr(daemon.Client, '_call', call)
+    client = daemon.Client('/nonexistent/mozvpnd.sock')
+    client.status()
+    client.active_server()
+    client.connect('de4-wireguard')
+    client.switch('nl2-wireguard')
+    client.disconnect('nl2-wireguard')
+    assert timeouts == {'status': daemon.CALL_TIMEOUT, 'active_server': daemon.CALL_TIMEOUT,
+                        'connect': None, 'switch': None, 'disconnect': None}
+
+
+@pytest.mark.parametrize('args, method, exc', [
+    (['up', 'de4-wireguard'], 'connect', socket.timeout('timed out')),
+    (['down'], 'disconnect', daemon.DaemonError('mozvpnd closed the connection')),
+    (['switch', 'nl2-wireguard'], 'switch', ConnectionRefusedError('Connection refused')),
+])
+def test_cli_daemon_errors(monkeypatch, args, method, exc):
+    """Failing daemon calls are reported as errors, not as tracebacks."""
+    class Backend:
+        @staticmethod
+        def active_server():
+            return None if method == 'connect' else 'de4-wireguard'
+
+    def fail(*args, **kwargs):
+        raise exc
+    setattr(Backend, method, staticmethod(fail))
+    monkeypatch.setattr(daemon, 'backend', lambda: Backend)
+    result = CliRunner().invoke(cli.main, args)
+    assert result.exit_code == 1
+    assert result.output.startswith('Error: ') and str(exc) in result.output
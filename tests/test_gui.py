@@ -0,0 +1,107 @@
+"""Tests for the server list models and the background workers of the GUI."""
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('PyQt6.QtWidgets')
+
+from PyQt6.QtCore import QModelIndex, QThreadPool  # noqa: E402
+from PyQt6.QtWidgets import QApplication, QComboBox  # noqa: E402
+
+from mozvpn import mozvpn_gui, wireguard  # noqa: E402
+from mozvpn.catalog import ServerCatalog  # noqa: E402
+
+LOCATIONS = [
+    {'interface': f'{country.lower()}{number}-wireguard', 'ip': f'10.0.0.{pos}', 'country': country, 'region': region, 'city': city}
+    for pos, (country, region, city, number) in enumerate(
+        [('AT', 'Vienna', 'Vienna', n) for n in range(1, 61)]
+        + [('CH', 'Zurich', 'Zürich', 1), ('DE', 'Hesse', 'Frankfurt am Main', 1), ('DE', 'Berlin', 'Berlin', 2)]
+    )
+]
+
+
+@pytest.fixture
+def models():
+    source = mozvpn_gui.ServerListModel(ServerCatalog.from_records(LOCATIONS))
+    proxy = mozvpn_gui.ServerFilterProxyModel()
+    proxy.setSourceModel(source)
+    return source, proxy
+
+
+def test_lazy_rows(models):
+    source, proxy = models
+    assert source.rowCount() == 0 and source.canFetchMore(QModelIndex())
+    source.fetchMore()
+    assert proxy.rowCount() == mozvpn_gui.FETCH_BATCH_SIZE
+    # Looking up a server loads the rows up to it:
+    assert source.row('de1-wireguard') == 61
+    assert source.rowCount() == 62
+    assert source.data(source.index(61, 0)) == 'DE - Hesse - Frankfurt am Main (de1)'
+    assert source.data(source.index(61, 0), source.InterfaceRole) == 'de1-wireguard'
+    assert source.row('xx1-wireguard') == -1
+
+
+def test_search(models):
+    source, proxy = models
+
+    def shown():
+        return [proxy.data(proxy.index(row, 0), source.InterfaceRole) for row in range(proxy.rowCount())]
+
+    proxy.set_search_text('de')
+    assert shown() == ['de1-wireguard', 'de2-wireguard']
+    proxy.set_search_text('DE frankf')
+    assert shown() == ['de1-wireguard']
+    proxy.set_search_text('zurich')
+    assert shown() == ['ch1-wireguard']
+    proxy.set_search_text('at60')
+    assert shown() == ['at60-wireguard']
+    proxy.set_search_text('')
+    assert proxy.rowCount() == len(LOCATIONS)
+
+
+@pytest.fixture
+def app():
+    """Qt application, for widgets and for delivering signals emitted by threads of the pool."""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    return QApplication.instance() or QApplication([])
+
+
+def run_worker(app, fn, *args, **kwargs):
+    """Run fn in a Worker of a thread pool, return the signal emitted and its value."""
+    outcomes = []
+    worker = mozvpn_gui.Worker(fn, *args, **kwargs)
+    # The pool deletes the worker when done, but its signals must stay alive:
+    signals = worker.signals
+    signals.finished.connect(lambda result: outcomes.append(('finished', result)))
+    signals.failed.connect(lambda exc: outcomes.append(('failed', exc)))
+    pool = QThreadPool()
+    pool.start(worker)
+    assert pool.waitForDone(5000)
+    app.processEvents()
+    [outcome] = outcomes
+    return outcome
+
+
+def test_worker(app):
+    assert run_worker(app, wireguard.run_command, 'echo done', cancel=threading.Event()) == ('finished', 'done')
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    signal, exc = run_worker(app, wireguard.run_command, 'sleep 5', cancel=cancel)
+    assert signal == 'failed' and isinstance(exc, wireguard.CommandCancelled)
+
+
+def test_connect_without_server(app, models, monkeypatch):
+    """If the search hides all servers, Connect does not start a connection."""
+    _, proxy = models
+    combo = QComboBox()
+    combo.setModel(proxy)
+    proxy.set_search_text('nowhere')
+    assert combo.currentData() is None
+    messages = []
+    monkeypatch.setattr(mozvpn_gui.QMessageBox, 'information', lambda parent, title, text: messages.append(text))
+    window = SimpleNamespace(busy=False, wireguard_interface=None, combo=combo, cancel_event=threading.Event(),
+                             set_busy=lambda *args: pytest.fail('unexpected connect'))
+    mozvpn_gui.MainWindow.toggle_connect(window)
+    assert messages == ['No server selected, please change the search.']
@@ -0,0 +1,43 @@
+"""Tests for the shared HTTP client."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mozvpn import httpclient
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    """Answer every GET request with a small JSON document, keeping the connection alive."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'ip': self.path.strip('/')}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), JSONHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield 'http://%s:%d' % server.server_address
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_connection_reuse(http_server, monkeypatch):
+    """Consecutive requests to the same host share one connection."""
+    monkeypatch.setattr(httpclient, '_session', None)
+    for no in range(10):
+        assert httpclient.get(f'{http_server}/10.0.0.{no}').json() == {'ip': f'10.0.0.{no}'}
+    assert httpclient.connection_stats() == {'connections': 1, 'requests': 10}
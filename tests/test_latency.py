@@ -0,0 +1,79 @@
+"""Tests for latency probing of VPN server endpoints."""
+import time
+import socket
+import threading
+
+import pytest
+
+from mozvpn import latency
+
+
+@pytest.fixture
+def udp_responders():
+    """Local stand-in servers: two echoing UDP sockets and one silent socket."""
+    echo_socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(2)]
+    silent_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for sock in echo_socks + [silent_sock]:
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(0.1)
+    stop = threading.Event()
+
+    def echo(sock, delay):
+        while not stop.is_set():
+            try:
+                data, addr = sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            time.sleep(delay)
+            sock.sendto(data, addr)
+
+    threads = [threading.Thread(target=echo, args=(sock, delay)) for sock, delay in zip(echo_socks, [0.05, 0])]
+    for thread in threads:
+        thread.start()
+    yield [sock.getsockname() for sock in echo_socks + [silent_sock]]
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for sock in echo_socks + [silent_sock]:
+        sock.close()
+
+
+def test_probe_latencies(udp_responders):
+    """Responding endpoints are measured in parallel, silent ones get None."""
+    start = time.monotonic()
+    latencies = latency.probe_latencies(udp_responders, timeout=0.5)
+    assert time.monotonic() - start < 0.7
+    slow, fast, silent = (latencies[endpoint] for endpoint in udp_responders)
+    assert fast < 0.05 <= slow
+    assert silent is None
+
+
+def test_rank_servers(monkeypatch):
+    """Servers are pinged, or probed on a closed port if ICMP sockets are not permitted."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    monkeypatch.setattr(latency, 'CLOSED_PORT', sock.getsockname()[1])
+    sock.close()
+    servers = [{'interface': 'de1-wireguard', 'ip': '127.0.0.1', 'port': 51820}]
+    [server] = latency.rank_servers(servers, timeout=0.5)
+    assert server['interface'] == 'de1-wireguard'
+    assert 0 < server['latency'] < 0.5
+
+
+def test_probe_icmp_echo():
+    """A host answers ICMP echo requests, where unprivileged ICMP sockets are permitted."""
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+    except PermissionError:
+        pytest.skip('ICMP sockets not permitted, see sysctl net.ipv4.ping_group_range')
+    endpoint = ('127.0.0.1', None)
+    assert 0 < latency.probe_latencies([endpoint], timeout=0.5)[endpoint] < 0.5
+
+
+def test_probe_closed_port():
+    """An ICMP 'port unreachable' answer counts as response."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    endpoint = sock.getsockname()
+    sock.close()
+    assert latency.probe_latencies([endpoint], timeout=0.5)[endpoint] is not None
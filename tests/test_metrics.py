@@ -0,0 +1,96 @@
+"""Tests for the metrics of commands and HTTP requests."""
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from mozvpn import cli, httpclient, metrics, wireguard
+
+
+@pytest.fixture
+def registry():
+    metrics.REGISTRY.clear()
+    yield metrics.REGISTRY
+    metrics.REGISTRY.clear()
+
+
+def samples(registry, name):
+    return {tuple(sorted(sample['labels'].items())): sample for sample in registry.collect()[name]['samples']}
+
+
+def test_command_labels():
+    assert metrics.command_labels('sudo -n wg-quick up de4-wireguard') == {'command': 'wg-quick', 'subcommand': 'up'}
+    assert metrics.command_labels('sudo -n wg show de4-wireguard dump') == {'command': 'wg', 'subcommand': 'show'}
+    assert metrics.command_labels('/usr/bin/mozwire relay save -o /tmp/x') == {'command': 'mozwire', 'subcommand': 'relay'}
+    assert metrics.command_labels('sudo install -p -o root x y') == {'command': 'install'}
+
+
+def test_run_command_metrics(registry):
+    """Duration and exit status of each command are recorded."""
+    wireguard.run_command('true')
+    wireguard.run_command('true')
+    with pytest.raises(wireguard.CommandError):
+        wireguard.run_command('false')
+    with pytest.raises(wireguard.CommandError):
+        wireguard.run_command('mozvpn-no-such-command')
+
+    totals = samples(registry, metrics.COMMANDS_TOTAL)
+    assert totals[(('command', 'true'), ('status', '0'))]['value'] == 2
+    assert totals[(('command', 'false'), ('status', '1'))]['value'] == 1
+    assert totals[(('command', 'mozvpn-no-such-command'), ('status', 'error'))]['value'] == 1
+    duration = samples(registry, metrics.COMMAND_DURATION)[(('command', 'true'),)]
+    assert duration['count'] == duration['buckets']['+Inf'] == 2
+    assert duration['sum'] > 0
+
+
+def test_http_metrics(registry, monkeypatch):
+    class Response:
+        status_code = 429
+
+    class Session:
+        def request(self, method, url, **kwargs):
+            if 'fail' in url:
+                raise OSError('connection refused')
+            return Response()
+    monkeypatch.setattr(httpclient, 'session', Session)
+
+    httpclient.get('https://ipinfo.io/1.1.1.1')
+    with pytest.raises(OSError):
+        httpclient.post('https://ipinfo.io/batch?fail')
+    totals = samples(registry, metrics.HTTP_REQUESTS_TOTAL)
+    assert totals[(('host', 'ipinfo.io'), ('method', 'GET'), ('status', '429'))]['value'] == 1
+    assert totals[(('host', 'ipinfo.io'), ('method', 'POST'), ('status', 'error'))]['value'] == 1
+
+
+def test_export(tmp_path):
+    registry = metrics.Registry(buckets=(0.1, 1))
+    registry.observe(metrics.COMMAND_DURATION, {'command': 'wg-quick', 'subcommand': 'up'}, 0.5)
+    registry.observe(metrics.COMMAND_DURATION, {'command': 'wg-quick', 'subcommand': 'up'}, 1)
+    registry.inc(metrics.COMMANDS_TOTAL, {'command': 'wg-quick', 'subcommand': 'up', 'status': '0'}, 2)
+    assert registry.prometheus().splitlines() == [
+        f'# HELP mozvpn_command_duration_seconds {metrics.METRICS[metrics.COMMAND_DURATION][1]}',
+        '# TYPE mozvpn_command_duration_seconds histogram',
+        'mozvpn_command_duration_seconds_bucket{command="wg-quick",subcommand="up",le="0.1"} 0',
+        'mozvpn_command_duration_seconds_bucket{command="wg-quick",subcommand="up",le="1"} 2',
+        'mozvpn_command_duration_seconds_bucket{command="wg-quick",subcommand="up",le="+Inf"} 2',
+        'mozvpn_command_duration_seconds_sum{command="wg-quick",subcommand="up"} 1.500000',
+        'mozvpn_command_duration_seconds_count{command="wg-quick",subcommand="up"} 2',
+        f'# HELP mozvpn_commands_total {metrics.METRICS[metrics.COMMANDS_TOTAL][1]}',
+        '# TYPE mozvpn_commands_total counter',
+        'mozvpn_commands_total{command="wg-quick",status="0",subcommand="up"} 2',
+    ]
+    registry.inc(metrics.COMMANDS_TOTAL, {'command': 'wg-quick', 'subcommand': 'up', 'status': '0'}, 1234565)
+    assert 'mozvpn_commands_total{command="wg-quick",status="0",subcommand="up"} 1234567' in registry.prometheus()
+    registry.write(tmp_path / 'mozvpn.json')
+    exported = json.loads((tmp_path / 'mozvpn.json').read_text())['metrics']
+    assert exported[metrics.COMMANDS_TOTAL]['samples'][0]['value'] == 1234567
+    assert [path.name for path in tmp_path.iterdir()] == ['mozvpn.json']
+
+
+def test_cli_writes_metrics(tmp_path, registry):
+    """Metrics are written on exit, even if the command failed."""
+    metrics_file = tmp_path / 'mozvpn.prom'
+    metrics.record_command('sudo -n wg-quick up de4-wireguard', 0.8, '1')
+    result = CliRunner().invoke(cli.main, ['--metrics', str(metrics_file), 'up'])
+    assert result.exit_code == 2
+    assert 'mozvpn_commands_total{command="wg-quick",status="1",subcommand="up"} 1' in metrics_file.read_text()
@@ -0,0 +1,133 @@
+"""Tests for the connection health monitor."""
+import pytest
+
+from mozvpn import daemon, monitor, wghelper, wireguard
+
+LOCATIONS_CSV = '''interface,ip,country,region,city
+de1-wireguard,2.2.2.1,DE,Hesse,Frankfurt am Main
+nl1-wireguard,3.3.3.1,NL,North Holland,Amsterdam
+de2-wireguard,2.2.2.2,DE,Berlin,Berlin
+de3-wireguard,2.2.2.3,DE,Berlin,Berlin
+'''
+
+
+def fake_dumps(start, rx_stops_at=None, handshake_stops_at=None, step=5, public_key='de2key='):
+    """Generate 'wg show dump' outputs of a peer sending 1 kB per step.
+
+    Answers (rx) and handshakes stop after the given number of seconds.
+    """
+    now = start
+    rx = tx = 0
+    handshake = 0
+    while True:
+        tx += 1000
+        if rx_stops_at is None or now - start < rx_stops_at:
+            rx += 800
+        if handshake_stops_at is None or now - start < handshake_stops_at:
+            if now - handshake >= 120:
+                handshake = now
+        yield now, (
+            'cPrivateKey=\tcPublicKey=\t0\toff\n'
+            f'{public_key}\t(none)\t2.2.2.2:51820\t0.0.0.0/0,::/0\t{handshake}\t{rx}\t{tx}\toff\n'
+        )
+        now += step
+
+
+@pytest.fixture
+def fake_wg(tmp_path, monkeypatch):
+    """Connected to de2-wireguard, 'wg show dump' answered from a fake generator."""
+    locations_file = tmp_path / 'locations.csv'
+    locations_file.write_text(LOCATIONS_CSV)
+    monkeypatch.setattr(wireguard, 'WIREGUARD_LOCATIONS_FILE', str(locations_file))
+    state = {'server': 'de2-wireguard', 'dumps': None, 'now': None, 'dump': None, 'switched': []}
+
+    def run_command(cmd, **kwargs):
+        assert cmd == f'sudo -n {wghelper.HELPER_PATH} dump de2-wireguard'
+        return state['dump']
+
+    class Backend:
+        @staticmethod
+        def interface():
+            return 'de2-wireguard'
+
+        @staticmethod
+        def active_server():
+            return state['server']
+
+        @staticmethod
+        def switch(server):
+            state['switched'].append(server)
+            state['server'] = server
+
+    monkeypatch.setattr(wireguard, 'run_command', run_command)
+    state['monitor'] = monitor.Monitor(Backend, clock=lambda: state['now'], cooldown=60)
+    return state
+
+
+def run_checks(fake_wg, count):
+    """Check count times with the next outputs of the fake 'wg', return servers failed over to."""
+    for _ in range(count):
+        fake_wg['now'], fake_wg['dump'] = next(fake_wg['dumps'])
+        fake_wg['monitor'].check()
+    return fake_wg['switched']
+
+
+def test_parse_dump():
+    _, dump = next(fake_dumps(1700000000))
+    [peer] = monitor.parse_dump(dump)
+    assert (peer.public_key, peer.endpoint, peer.latest_handshake, peer.rx, peer.tx) == \
+        ('de2key=', '2.2.2.2:51820', 1700000000, 800, 1000)
+    with pytest.raises(ValueError):
+        monitor.parse_dump('header\nbroken line\n')
+
+
+def test_healthy_connection(fake_wg):
+    fake_wg['dumps'] = fake_dumps(1700000000)
+    assert run_checks(fake_wg, 100) == []
+
+
+def test_failover_on_rx_stall(fake_wg):
+    """Once nothing is received for 30s the next server of the same country is used."""
+    fake_wg['dumps'] = fake_dumps(1700000000, rx_stops_at=60)
+    assert run_checks(fake_wg, 18) == []
+    assert run_checks(fake_wg, 1) == ['de3-wireguard']
+    # The new server is not judged during the cooldown:
+    assert run_checks(fake_wg, 10) == ['de3-wireguard']
+
+
+def test_failover_on_stale_handshake(fake_wg):
+    """Without handshakes the connection fails after the handshake timeout."""
+    fake_wg['monitor'].tracker.rx_stall_timeout = 10000
+    fake_wg['dumps'] = fake_dumps(1700000000, handshake_stops_at=1)
+    assert run_checks(fake_wg, 37) == []
+    assert run_checks(fake_wg, 1) == ['de3-wireguard']
+
+
+def test_candidates(fake_wg):
+    mon = fake_wg['monitor']
+    fake_wg['now'] = 1700000000
+    assert mon.candidates('de2-wireguard') == ['de3-wireguard', 'de1-wireguard']
+    mon.failed['de3-wireguard'] = 1700000000
+    assert mon.candidates('de2-wireguard') == ['de1-wireguard']
+    fake_wg['now'] += monitor.FAILED_SERVER_TIMEOUT
+    assert mon.candidates('de2-wireguard') == ['de3-wireguard', 'de1-wireguard']
+
+
+def test_run_survives_daemon_errors(fake_wg, monkeypatch, caplog):
+    """If the daemon goes away during a failover, the error is logged and checking goes on."""
+    def switch(server):
+        raise daemon.DaemonError('mozvpnd closed the connection')
+    monkeypatch.setattr(fake_wg['monitor'].backend, 'switch', switch)
+    fake_wg['dumps'] = fake_dumps(1700000000, rx_stops_at=0)
+    sleeps = []
+
+    def sleep(seconds):
+        if len(sleeps) == 10:
+            raise KeyboardInterrupt
+        sleeps.append(seconds)
+        fake_wg['now'], fake_wg['dump'] = next(fake_wg['dumps'])
+    monkeypatch.setattr(monitor.time, 'sleep', sleep)
+    fake_wg['now'], fake_wg['dump'] = next(fake_wg['dumps'])
+    with pytest.raises(KeyboardInterrupt):
+        fake_wg['monitor'].run()
+    assert 'Checking connection failed: mozvpnd closed the connection' in caplog.text
@@ -2,11 +2,17 @@
 
 """Tests for `mozvpn` package."""
 
+import sys
+import threading
+import subprocess
+
 import pytest
 
 from click.testing import CliRunner
 
-# from mozvpn import mozvpn
+from mozvpn import mozvpn
+from mozvpn.geocache import GeoCache
+from mozvpn.ipdb import IPRangeDatabase
 from mozvpn import cli
 
 
@@ -34,3 +40,253 @@ def test_command_line_interface():
     # help_result = runner.invoke(cli.main, ['--help'])
     # assert help_result.exit_code == 0
     # assert '--help  Show this message and exit.' in help_result.output
+
+
+class FakeResponse:
+    """Minimal stand-in for requests.Response."""
+
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+def write_wg_configs(directory, servers):
+    """Write minimal wireguard config files for given {interface: ip} mapping."""
+    for iface, ip in servers.items():
+        (directory / f'{iface}.conf').write_text(
+            f'[Interface]\nAddress = 10.64.0.2/32\n\n[Peer]\nEndpoint = {ip}:51820\n'
+        )
+
+
+def test_cli_import_is_lightweight():
+    """Loading the CLI must not import Qt or requests, only the commands needing them do."""
+    code = 'import sys, mozvpn.cli; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                             universal_newlines=True, check=True).stdout.split()
+    assert not {'PyQt6', 'requests', 'urllib3', 'mozvpn.mozvpn_gui'} & set(modules)
+
+
+def test_find_vpn_server_locations_sorted(tmp_path, monkeypatch):
+    """Concurrent lookups keep the output sorted by interface name."""
+    servers = {'de2-wireguard': '1.1.1.2', 'at1-wireguard': '2.2.2.1', 'de1-wireguard': '1.1.1.1'}
+    write_wg_configs(tmp_path, servers)
+    monkeypatch.setattr(mozvpn.httpclient, 'get', lambda url: FakeResponse({'city': url.rsplit('/', 1)[1]}))
+
+    configs = mozvpn.find_vpn_server_locations([str(tmp_path)], jobs=3)
+    assert [c['interface'] for c in configs] == ['at1-wireguard', 'de1-wireguard', 'de2-wireguard']
+    assert all(c['city'] == c['ip'] for c in configs)
+
+
+def test_determine_ip_location_backoff(monkeypatch):
+    """Rate limited requests are retried after backing off."""
+    responses = [FakeResponse(None, 429), FakeResponse(None, 429), FakeResponse({'city': 'Berlin'})]
+    monkeypatch.setattr(mozvpn.httpclient, 'get', lambda url: responses.pop(0))
+    backoff = mozvpn.RateLimitBackoff(initial_delay=0.01)
+
+    assert mozvpn.determine_ip_location('1.1.1.1', backoff=backoff) == {'city': 'Berlin'}
+    assert not responses
+    assert backoff.delay == 0.01
+
+
+def test_geocache_avoids_lookups(tmp_path, monkeypatch):
+    """Cached locations are persisted and answered without network requests."""
+    cache_file = tmp_path / 'geolocation.json'
+    monkeypatch.setattr(mozvpn.httpclient, 'get', lambda url: FakeResponse({'city': 'Berlin'}))
+    cache = GeoCache(cache_file)
+    mozvpn.determine_ip_location('1.1.1.1', cache=cache)
+    cache.save()
+
+    monkeypatch.setattr(mozvpn.httpclient, 'get', lambda url: pytest.fail('unexpected request'))
+    assert mozvpn.determine_ip_location('1.1.1.1', cache=GeoCache(cache_file)) == {'city': 'Berlin'}
+
+
+def test_geocache_eviction(tmp_path):
+    """Expired and surplus entries are dropped on saving, oldest first."""
+    cache = GeoCache(tmp_path / 'geolocation.json', max_entries=2)
+    for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+        cache.put(ip, {'ip': ip})
+    cache._entries['3.3.3.3']['time'] -= 1
+    cache.save()
+    assert cache.get('3.3.3.3') is None
+    assert len(GeoCache(cache.path)) == 2
+    assert GeoCache(cache.path, ttl=-1).get('1.1.1.1') is None
+
+
+@pytest.mark.parametrize('content', ['[1, 2]', 'null', '{"1.1.1.1": "Berlin"}', '{broken'])
+def test_geocache_invalid_file(tmp_path, content):
+    """A cache file with unexpected content is treated as empty cache."""
+    cache_file = tmp_path / 'geolocation.json'
+    cache_file.write_text(content)
+    assert len(GeoCache(cache_file)) == 0
+
+
+def test_geolocate_offline(tmp_path, monkeypatch):
+    """Offline geolocation resolves endpoints from a local IP-range database."""
+    write_wg_configs(tmp_path, {'de1-wireguard': '1.1.1.1', 'us1-wireguard': '9.9.9.9'})
+    ip_db = tmp_path / 'ip-ranges.csv'
+    ip_db.write_text(
+        'start,end,country,region,city\n'
+        '9.0.0.0,9.255.255.255,US,California,San Jose\n'
+        '1.1.1.0,1.1.1.255,DE,Hesse,Frankfurt am Main\n'
+        '2a00::,2a00::ffff,IE,Leinster,Dublin\n'
+    )
+    monkeypatch.setattr(mozvpn.httpclient, 'get', lambda url: pytest.fail('unexpected request'))
+    db = IPRangeDatabase(ip_db)
+    assert db.locate('2a00::1')['city'] == 'Dublin'
+    assert db.locate('8.8.8.8') == {'ip': '8.8.8.8'}
+
+    result = CliRunner().invoke(cli.main, ['geolocate', '--offline', '--ip-db', str(ip_db), str(tmp_path)])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        'interface,ip,country,region,city,loc',
+        'de1-wireguard,1.1.1.1,DE,Hesse,Frankfurt am Main,',
+        'us1-wireguard,9.9.9.9,US,California,San Jose,',
+    ]
+
+
+def test_ip_range_database_errors(tmp_path):
+    """Databases without range columns or with overlapping ranges are rejected."""
+    ip_db = tmp_path / 'ip-ranges.csv'
+    ip_db.write_text('network,country\n1.1.1.0/24,DE\n')
+    with pytest.raises(RuntimeError, match='lacks column.*start, end'):
+        IPRangeDatabase(ip_db)
+    ip_db.write_text('start,end,country\n1.0.0.0,1.255.255.255,AU\n1.1.1.0,1.1.1.255,DE\n')
+    with pytest.raises(RuntimeError, match='line 3 overlaps range in line 2'):
+        IPRangeDatabase(ip_db)
+
+    result = CliRunner().invoke(cli.main, ['geolocate', '--offline', '--ip-db', str(ip_db), str(tmp_path)])
+    assert result.exit_code == 1
+    assert 'overlaps' in result.output
+
+
+def test_batched_locations_partial_results(monkeypatch):
+    """Addresses missing in a batch answer are looked up one by one."""
+    batches = []
+
+    def post(url, params, json):
+        batches.append(json)
+        # Answer omits one address and reports an error for another:
+        return FakeResponse({ip: {'city': ip} if ip != '1.1.1.2' else {'error': 'x'} for ip in json if ip != '1.1.1.4'})
+
+    monkeypatch.setattr(mozvpn.httpclient, 'post', post)
+    monkeypatch.setattr(mozvpn.httpclient, 'get', lambda url: FakeResponse({'city': 'single'}))
+    ips = [f'1.1.1.{no}' for no in range(1, 6)]
+
+    locations = mozvpn.determine_ip_locations_batched(ips + ips[:2], batch_size=2)
+    assert sorted(map(tuple, batches)) == [tuple(ips[0:2]), tuple(ips[2:4]), tuple(ips[4:])]
+    assert {ip: loc['city'] for ip, loc in locations.items()} == {
+        '1.1.1.1': '1.1.1.1', '1.1.1.2': 'single', '1.1.1.3': '1.1.1.3', '1.1.1.4': 'single', '1.1.1.5': '1.1.1.5'
+    }
+
+
+def test_iter_vpn_server_locations_streams(tmp_path):
+    """Servers are yielded in sorted order as soon as they are resolved."""
+    write_wg_configs(tmp_path, {'de1-wireguard': '1.1.1.1', 'de2-wireguard': '1.1.1.2'})
+    release = threading.Event()
+
+    def locate(ip):
+        if ip == '1.1.1.2':
+            release.wait(5)
+        return {'city': ip}
+
+    servers = mozvpn.iter_vpn_server_locations([str(tmp_path)], jobs=2, locate=locate)
+    assert next(servers)['interface'] == 'de1-wireguard'
+    release.set()
+    assert [s['interface'] for s in servers] == ['de2-wireguard']
+
+
+def test_iter_vpn_server_locations_dedup(tmp_path):
+    """Servers sharing an endpoint IP are looked up once, even with concurrent lookups."""
+    write_wg_configs(tmp_path, {'de1-wireguard': '1.1.1.1', 'de2-wireguard': '1.1.1.1', 'de3-wireguard': '1.1.1.3'})
+    located = []
+
+    def locate(ip):
+        located.append(ip)
+        return {'city': ip}
+
+    servers = list(mozvpn.iter_vpn_server_locations([str(tmp_path)], jobs=3, locate=locate))
+    assert sorted(located) == ['1.1.1.1', '1.1.1.3']
+    assert [s['city'] for s in servers] == ['1.1.1.1', '1.1.1.1', '1.1.1.3']
+
+
+def test_geolocate_update(tmp_path, monkeypatch):
+    """'geolocate --update' only looks up new and moved servers, and drops removed ones."""
+    config_dir = tmp_path / 'configs'
+    config_dir.mkdir()
+    # de2 moved to a new endpoint, nl1 is gone, ch1 is new and at1 took over nl1's endpoint:
+    write_wg_configs(config_dir, {'de1-wireguard': '2.2.2.1', 'de2-wireguard': '2.2.9.9',
+                                  'ch1-wireguard': '1.1.1.1', 'at1-wireguard': '3.3.3.1'})
+    locations_file = tmp_path / 'locations.csv'
+    locations_file.write_text(
+        'interface,ip,country,region,city,loc\n'
+        'de1-wireguard,2.2.2.1,DE,Hesse,Frankfurt am Main,"50.1155,8.6842"\n'
+        'de2-wireguard,2.2.2.2,DE,Berlin,Berlin,"52.5244,13.4105"\n'
+        'nl1-wireguard,3.3.3.1,NL,North Holland,Amsterdam,"52.3740,4.8897"\n'
+    )
+    located = []
+
+    def determine_ip_location(ip, **kwargs):
+        located.append(ip)
+        return {'country': 'XX', 'city': f'city of {ip}', 'loc': '1.0,2.0'}
+    monkeypatch.setattr(mozvpn, 'determine_ip_location', determine_ip_location)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+    args = ['geolocate', '--update', '-o', str(locations_file), str(config_dir)]
+    result = CliRunner().invoke(cli.main, args)
+    assert result.exit_code == 0
+    assert sorted(located) == ['1.1.1.1', '2.2.9.9']
+    expected = [
+        'interface,ip,country,region,city,loc',
+        'at1-wireguard,3.3.3.1,NL,North Holland,Amsterdam,"52.3740,4.8897"',
+        'ch1-wireguard,1.1.1.1,XX,,city of 1.1.1.1,"1.0,2.0"',
+        'de1-wireguard,2.2.2.1,DE,Hesse,Frankfurt am Main,"50.1155,8.6842"',
+        'de2-wireguard,2.2.9.9,XX,,city of 2.2.9.9,"1.0,2.0"',
+    ]
+    assert locations_file.read_text().splitlines() == expected
+    assert not list(tmp_path.glob('.*.tmp'))
+
+    # Nothing changed, so nothing is looked up (not even from the cache):
+    monkeypatch.setattr(mozvpn, 'determine_ip_location', lambda ip, **kwargs: pytest.fail('unexpected lookup'))
+    result = CliRunner().invoke(cli.main, args)
+    assert result.exit_code == 0
+    assert locations_file.read_text().splitlines() == expected
+
+    result = CliRunner().invoke(cli.main, ['geolocate', '--update', str(config_dir)])
+    assert result.exit_code == 1
+
+
+def test_geolocate_interrupted(tmp_path, monkeypatch):
+    """An interrupted run keeps the rows written so far, unless it updates an existing file."""
+    config_dir = tmp_path / 'configs'
+    config_dir.mkdir()
+    write_wg_configs(config_dir, {'de1-wireguard': '2.2.2.1', 'de2-wireguard': '2.2.2.2'})
+
+    def determine_ip_location(ip, **kwargs):
+        if ip == '2.2.2.2':
+            raise RuntimeError('interrupted')
+        return {'country': 'DE', 'city': 'Frankfurt am Main'}
+    monkeypatch.setattr(mozvpn, 'determine_ip_location', determine_ip_location)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    locations_file = tmp_path / 'locations.csv'
+
+    result = CliRunner().invoke(cli.main, ['geolocate', '-j', '1', '-o', str(locations_file), str(config_dir)])
+    assert isinstance(result.exception, RuntimeError)
+    assert locations_file.read_text().splitlines() == [
+        'interface,ip,country,region,city,loc',
+        'de1-wireguard,2.2.2.1,DE,,Frankfurt am Main,',
+    ]
+    assert not (tmp_path / 'locations.bin').exists()
+
+    locations_file.write_text('interface,ip,country,region,city,loc\n')
+    result = CliRunner().invoke(cli.main, ['geolocate', '-u', '-j', '1', '-o', str(locations_file), str(config_dir)])
+    assert isinstance(result.exception, RuntimeError)
+    assert locations_file.read_text() == 'interface,ip,country,region,city,loc\n'
+    assert not list(tmp_path.glob('.*.tmp'))
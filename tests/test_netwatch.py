@@ -0,0 +1,54 @@
+"""Tests for the detection of network interface changes."""
+import errno
+
+import pytest
+
+from mozvpn import netwatch
+
+RTM_NEWADDR = 20
+
+
+def message(msg_type, payload=b''):
+    """Return netlink message of given type, padded to 4 bytes like the kernel does."""
+    length = netwatch.NLMSGHDR.size + len(payload)
+    data = netwatch.NLMSGHDR.pack(length, msg_type, 0, 0, 0) + payload
+    return data + bytes(-len(data) % 4)
+
+
+def test_link_changed():
+    """Only link messages count, also after unaligned messages."""
+    assert netwatch.link_changed(message(netwatch.RTM_NEWLINK))
+    assert netwatch.link_changed(message(RTM_NEWADDR, b'\x01\x02\x03') + message(netwatch.RTM_DELLINK, b'x'))
+    assert not netwatch.link_changed(message(RTM_NEWADDR) + message(RTM_NEWADDR, b'abcde'))
+    assert not netwatch.link_changed(b'')
+    # Truncated or malformed messages are ignored:
+    assert not netwatch.link_changed(message(netwatch.RTM_NEWLINK)[:8])
+    assert not netwatch.link_changed(netwatch.NLMSGHDR.pack(0, RTM_NEWADDR, 0, 0, 0) + message(netwatch.RTM_NEWLINK))
+
+
+class FakeSocket:
+    """Socket returning the given datagrams, or raising the given exceptions."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def recv(self, size):
+        result = self.results.pop(0) if self.results else BlockingIOError()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+def link_monitor(*results):
+    monitor = netwatch.LinkMonitor.__new__(netwatch.LinkMonitor)
+    monitor.sock = FakeSocket(*results)
+    return monitor
+
+
+def test_changed():
+    """All pending notifications are read; dropped ones count as change, other errors are raised."""
+    assert link_monitor(message(RTM_NEWADDR), message(netwatch.RTM_NEWLINK)).changed()
+    assert not link_monitor(message(RTM_NEWADDR)).changed()
+    assert link_monitor(OSError(errno.ENOBUFS, 'No buffer space available')).changed()
+    with pytest.raises(OSError):
+        link_monitor(OSError(errno.EBADF, 'Bad file descriptor')).changed()
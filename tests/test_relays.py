@@ -0,0 +1,84 @@
+"""Tests for the incremental installation of relay configurations."""
+import csv
+
+import pytest
+
+from mozvpn import mozvpn, relays
+
+CONFIG = """\
+[Interface]
+PrivateKey = 8GboYh0YF3q/hJhoPFoL3HM/ObgOuC8YI6UXWsgWL2M=
+Address = 10.66.127.32/32
+
+[Peer]
+PublicKey = {public_key}
+AllowedIPs = 0.0.0.0/0
+Endpoint = {ip}:51820
+"""
+
+LOCATIONS_CSV = '''interface,ip,country,region,city,loc
+de1-wireguard,2.2.2.1,DE,Hesse,Frankfurt am Main,"50.1155,8.6842"
+de2-wireguard,2.2.2.2,DE,Berlin,Berlin,"52.5244,13.4105"
+nl1-wireguard,3.3.3.1,NL,North Holland,Amsterdam,"52.3740,4.8897"
+'''
+
+
+def write_configs(directory, configs):
+    directory.mkdir(exist_ok=True)
+    for name, (public_key, ip) in configs.items():
+        (directory / f'{name}.conf').write_text(CONFIG.format(public_key=public_key, ip=ip))
+
+
+def test_prepare_update(tmp_path, monkeypatch):
+    """Only new and changed relays are geolocated, and locations.csv is merged."""
+    etc_dir = tmp_path / 'etc'
+    write_configs(etc_dir, {'de1-wireguard': ('de1key=', '2.2.2.1'), 'de2-wireguard': ('de2key=', '2.2.2.2'),
+                            'nl1-wireguard': ('nl1key=', '3.3.3.1')})
+    relays.write_manifest(etc_dir)
+    (etc_dir / 'locations.csv').write_text(LOCATIONS_CSV)
+
+    download_dir = tmp_path / 'download'
+    # de1 unchanged, de2 moved to a new endpoint, nl1 gone, ch1 new:
+    write_configs(download_dir, {'de1-wireguard': ('de1key=', '2.2.2.1'), 'de2-wireguard': ('de2key=', '2.2.9.9'),
+                                 'ch1-wireguard': ('ch1key=', '1.1.1.1')})
+    located = []
+
+    def determine_ip_location(ip, **kwargs):
+        located.append(ip)
+        return {'country': 'XX', 'city': f'city of {ip}'}
+    monkeypatch.setattr(mozvpn, 'determine_ip_location', determine_ip_location)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+    files, removed = relays.prepare_update(download_dir, etc_dir=str(etc_dir))
+    assert sorted(located) == ['1.1.1.1', '2.2.9.9']
+    assert files == ['ch1-wireguard.conf', 'de2-wireguard.conf', 'locations.csv', 'locations.bin', relays.MANIFEST_NAME]
+    assert removed == ['nl1-wireguard.conf']
+    with open(download_dir / 'locations.csv', newline='') as fp:
+        rows = [(row['interface'], row['ip'], row['city']) for row in csv.DictReader(fp)]
+    assert rows == [('ch1-wireguard', '1.1.1.1', 'city of 1.1.1.1'),
+                    ('de1-wireguard', '2.2.2.1', 'Frankfurt am Main'),
+                    ('de2-wireguard', '2.2.9.9', 'city of 2.2.9.9')]
+    assert relays.read_manifest(download_dir) == relays.config_hashes(download_dir)
+
+    cmds = relays.install_commands(download_dir, files[:1], removed, etc_dir='/etc/wireguard')
+    assert cmds == [
+        f'install -p -o root -g root -m 440 {download_dir}/ch1-wireguard.conf /etc/wireguard/.ch1-wireguard.conf.tmp',
+        'mv -f /etc/wireguard/.ch1-wireguard.conf.tmp /etc/wireguard/ch1-wireguard.conf',
+        'rm -f /etc/wireguard/nl1-wireguard.conf',
+    ]
+
+    for name in ['x; rm -rf ~.conf', '{tmp_dir}-wireguard.conf', '../de1-wireguard.conf', 'passwd']:
+        with pytest.raises(RuntimeError, match='Invalid relay file name'):
+            relays.install_commands(download_dir, [name], [], etc_dir='/etc/wireguard')
+        with pytest.raises(RuntimeError, match='Invalid relay file name'):
+            relays.install_commands(download_dir, [], [name], etc_dir='/etc/wireguard')
+    assert relays.install_commands("/tmp/mozvpn's dir", ['de1-wireguard.conf'], [], etc_dir='/etc/wireguard')[0] == \
+        "install -p -o root -g root -m 440 '/tmp/mozvpn'\"'\"'s dir/de1-wireguard.conf' /etc/wireguard/.de1-wireguard.conf.tmp"
+
+    # Installing the update and repeating it changes nothing:
+    for name in files:
+        (etc_dir / name).write_bytes((download_dir / name).read_bytes())
+    (etc_dir / 'nl1-wireguard.conf').unlink()
+    located.clear()
+    assert relays.prepare_update(download_dir, etc_dir=str(etc_dir)) == ([], [])
+    assert located == []
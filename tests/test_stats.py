@@ -0,0 +1,88 @@
+"""Tests for the traffic statistics of the VPN tunnel."""
+import pytest
+from click.testing import CliRunner
+
+from mozvpn import cli, stats, wireguard
+
+
+@pytest.fixture
+def counters(tmp_path, monkeypatch):
+    """Byte counters of interface de4-wireguard in a fake sysfs, set via the returned function."""
+    monkeypatch.setattr(wireguard, 'SYS_CLASS_NET_DIR', str(tmp_path))
+    statistics_dir = tmp_path / 'de4-wireguard' / 'statistics'
+    statistics_dir.mkdir(parents=True)
+
+    def set_counters(rx, tx):
+        (statistics_dir / 'rx_bytes').write_text(f'{rx}\n')
+        (statistics_dir / 'tx_bytes').write_text(f'{tx}\n')
+    set_counters(0, 0)
+    return set_counters
+
+
+def test_ring_buffer():
+    buffer = stats.RingBuffer(3)
+    for second in range(5):
+        buffer.append(second, second * 10, second * 20)
+    assert len(buffer) == 3
+    assert list(buffer) == [(2, 20, 40), (3, 30, 60), (4, 40, 80)]
+    assert buffer[-1] == (4, 40, 80)
+    with pytest.raises(IndexError):
+        buffer[3]
+    buffer.clear()
+    assert list(buffer) == []
+
+
+def test_sampler(counters):
+    now = [0]
+    sampler = stats.Sampler(capacity=5, window=3, interface=lambda: 'de4-wireguard', clock=lambda: now[0])
+    assert sampler.sample() and sampler.rates() is None
+    # 1 kB/s received for 3s, then 4 kB/s:
+    for rx in [1000, 2000, 3000, 7000]:
+        now[0] += 1
+        counters(rx, rx // 10)
+        sampler.sample()
+    rates = sampler.rates()
+    assert (rates['rx_rate'], rates['rx_avg'], rates['tx_avg']) == (4000, 2000, 200)
+    assert rates['rx_bytes'] == 7000
+    # Memory is fixed, old samples are dropped:
+    for _ in range(20):
+        now[0] += 1
+        sampler.sample()
+    assert len(sampler.buffer) == 5
+    assert sampler.rates()['rx_avg'] == 0
+
+    # The interface was recreated:
+    counters(10, 1)
+    now[0] += 1
+    sampler.sample()
+    assert len(sampler.buffer) == 1 and sampler.rates() is None
+
+    sampler.interface = lambda: None
+    assert not sampler.sample()
+
+
+def test_format():
+    assert stats.format_rate(999) == '999 B/s'
+    assert stats.format_rate(1250000) == '1.2 MB/s'
+    assert stats.format_bytes(3.5e12) == '3.5 TB'
+
+
+def test_cli_stats(counters, monkeypatch):
+    monkeypatch.setattr(wireguard, 'interface', lambda: 'de4-wireguard')
+    monkeypatch.setattr(cli.time, 'sleep', lambda seconds: counters(2000000, 1000))
+    result = CliRunner().invoke(cli.main, ['stats', '-n', '2'])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith('de4-wireguard  rx ')
+    assert lines[1].endswith('total rx 2.0 MB, tx 1.0 kB')
+
+    monkeypatch.setattr(wireguard, 'interface', lambda: None)
+    assert CliRunner().invoke(cli.main, ['stats']).exit_code == 1
+
+
+@pytest.mark.parametrize('option', ['--interval', '--window'])
+def test_cli_stats_rejects_non_positive(option):
+    result = CliRunner().invoke(cli.main, ['stats', option, '0'])
+    assert result.exit_code == 2
+    assert '0.0 is not greater than 0' in result.output
@@ -0,0 +1,56 @@
+"""Tests for the wireguard config parser."""
+import pytest
+
+from mozvpn import wgconfig
+
+CONFIG = '''[Interface]
+# Device: Happy Dog
+PrivateKey = 8GboYh0YF3q/hJhoPFoL3HM/ObgOuC8YI6UXWsgWL2M=
+Address = 10.66.127.32/32,fc00:bbbb:bbbb:bb01::3:7f1f/128
+DNS = 10.64.0.1
+MTU = 1420
+
+[Peer]
+PublicKey = 7ncQXMKpxdDMa7VZpEFWivpYpsFNcYd5JSpNkWnLhGQ=
+AllowedIPs = 0.0.0.0/0
+AllowedIPs = ::0/0
+Endpoint = {endpoint}
+'''
+
+
+@pytest.mark.parametrize('endpoint, host, port, ip', [
+    ('185.213.155.73:51820', '185.213.155.73', 51820, '185.213.155.73'),
+    ('[2a03:1b20:1:f011::a01f]:4500', '2a03:1b20:1:f011::a01f', 4500, '2a03:1b20:1:f011::a01f'),
+    ('de4.relays.example.com:51820', 'de4.relays.example.com', 51820, None),
+    ('de4.relays.example.com', 'de4.relays.example.com', 51820, None),
+])
+def test_parse_config(endpoint, host, port, ip):
+    conf = wgconfig.parse_config(CONFIG.format(endpoint=endpoint), 'de4-wireguard')
+    assert conf.interface == 'de4-wireguard'
+    assert conf.address == ('10.66.127.32/32', 'fc00:bbbb:bbbb:bb01::3:7f1f/128')
+    assert conf.dns == ('10.64.0.1',)
+    assert conf.mtu == 1420
+    assert conf.public_key == '7ncQXMKpxdDMa7VZpEFWivpYpsFNcYd5JSpNkWnLhGQ='
+    assert conf.allowed_ips == ('0.0.0.0/0', '::0/0')
+    assert (conf.endpoint_host, conf.endpoint_port, conf.endpoint_ip) == (host, port, ip)
+
+
+def test_parse_config_errors():
+    with pytest.raises(wgconfig.ConfigError):
+        wgconfig.parse_config('[Interface]\nPrivateKey\n', 'de4-wireguard')
+    with pytest.raises(wgconfig.ConfigError):
+        wgconfig.parse_config('[Peer]\nEndpoint = 1.2.3.4:port\n', 'de4-wireguard')
+
+
+def test_read_configs(tmp_path):
+    for iface in ['de2-wireguard', 'at1-wireguard']:
+        (tmp_path / f'{iface}.conf').write_text(CONFIG.format(endpoint='1.2.3.4:51820'))
+    (tmp_path / 'locations.csv').write_text('')
+    assert [conf.interface for conf in wgconfig.read_configs([str(tmp_path)])] == ['at1-wireguard', 'de2-wireguard']
+
+
+def test_read_configs_skips_malformed(tmp_path, caplog):
+    (tmp_path / 'de2-wireguard.conf').write_text(CONFIG.format(endpoint='1.2.3.4:51820'))
+    (tmp_path / 'at1-wireguard.conf').write_text('[Peer]\nEndpoint = 1.2.3.4:port\n')
+    assert [conf.interface for conf in wgconfig.read_configs([str(tmp_path)])] == ['de2-wireguard']
+    assert 'at1-wireguard.conf' in caplog.text
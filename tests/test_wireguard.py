@@ -0,0 +1,219 @@
+"""Tests for the wireguard command wrappers."""
+import time
+import threading
+
+import pytest
+
+from mozvpn import monitor, wghelper, wireguard
+
+
+def test_sysfs_interfaces(tmp_path, monkeypatch):
+    """Kernel and userspace wireguard interfaces are found via sysfs."""
+    sys_class_net = tmp_path / 'net'
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir()
+    for link, devtype in [('lo', None), ('eth0', None), ('de4-wireguard', 'wireguard'), ('utun7', None)]:
+        (sys_class_net / link).mkdir(parents=True)
+        uevent = f'INTERFACE={link}\nIFINDEX=3\n' + (f'DEVTYPE={devtype}\n' if devtype else '')
+        (sys_class_net / link / 'uevent').write_text(uevent)
+    (run_dir / 'utun7.sock').touch()
+    (run_dir / 'stale.sock').touch()
+    monkeypatch.setattr(wireguard, 'SYS_CLASS_NET_DIR', str(sys_class_net))
+    monkeypatch.setattr(wireguard, 'WIREGUARD_RUN_DIR', str(run_dir))
+    monkeypatch.setattr(wireguard, 'run_command', lambda cmd: pytest.fail('unexpected command'))
+
+    assert wireguard.sysfs_interfaces() == ['de4-wireguard', 'utun7']
+    (run_dir / 'utun7.sock').unlink()
+    assert wireguard.interface() == 'de4-wireguard'
+
+
+def test_interface_fallback(tmp_path, monkeypatch):
+    """Without sysfs the 'wg' command is used."""
+    monkeypatch.setattr(wireguard, 'SYS_CLASS_NET_DIR', str(tmp_path / 'missing'))
+    monkeypatch.setattr(wireguard, 'run_command', lambda cmd: '' if cmd == wireguard.WIREGUARD_SHOW_INTERFACES_CMD else None)
+    assert wireguard.interface() is None
+
+
+PEER_CONFIG = """\
+[Interface]
+PrivateKey = 8GboYh0YF3q/hJhoPFoL3HM/ObgOuC8YI6UXWsgWL2M=
+Address = {address}
+DNS = 10.64.0.1
+
+[Peer]
+PublicKey = {public_key}
+AllowedIPs = 0.0.0.0/0,::0/0
+Endpoint = {endpoint}
+"""
+
+
+@pytest.fixture
+def switch_env(tmp_path, monkeypatch):
+    """Connected to de4-wireguard, with commands recorded instead of executed."""
+    etc_dir = tmp_path / 'etc'
+    etc_dir.mkdir()
+    servers = {
+        'de4-wireguard': ('10.66.127.32/32', 'de4key=', '185.213.155.73:51820'),
+        'nl2-wireguard': ('10.66.127.32/32', 'nl2key=', '[2a03:1b20:1:f011::a01f]:51820'),
+        'us1-wireguard': ('10.99.0.7/32', 'us1key=', '198.54.128.1:51820'),
+    }
+    for name, (address, public_key, endpoint) in servers.items():
+        (etc_dir / f'{name}.conf').write_text(PEER_CONFIG.format(address=address, public_key=public_key, endpoint=endpoint))
+    (tmp_path / 'net' / 'de4-wireguard').mkdir(parents=True)
+    (tmp_path / 'net' / 'de4-wireguard' / 'ifindex').write_text('7\n')
+    monkeypatch.setattr(wireguard, 'WIREGUARD_ETC_DIR', str(etc_dir))
+    monkeypatch.setattr(wireguard, 'SYS_CLASS_NET_DIR', str(tmp_path / 'net'))
+    monkeypatch.setattr(wghelper, 'SYS_CLASS_NET_DIR', str(tmp_path / 'net'))
+    monkeypatch.setattr(wghelper, 'STATE_DIR', str(tmp_path / 'state'))
+    monkeypatch.setattr(wireguard, 'interface', lambda: 'de4-wireguard')
+    commands = []
+
+    def run_command(cmd, **kwargs):
+        commands.append(cmd)
+        if cmd.startswith(f'sudo -n {wghelper.HELPER_PATH} switch '):
+            # The helper records the switch:
+            wghelper.write_state(*cmd.split()[-2:])
+    monkeypatch.setattr(wireguard, 'run_command', run_command)
+    return commands
+
+
+def test_switch_replaces_peer(switch_env):
+    """Servers sharing the interface settings are switched by replacing the peer only."""
+    assert wireguard.switch('nl2-wireguard') == 'peer'
+    assert switch_env == [f'sudo -n {wghelper.HELPER_PATH} switch de4-wireguard nl2-wireguard']
+    assert wireguard.active_server() == 'nl2-wireguard'
+    assert wireguard.status() == 'Connected to: nl2-wireguard'
+
+    # The switched interface is shut down by the server's name, too:
+    wireguard.disconnect('nl2-wireguard')
+    assert switch_env[-1] == 'sudo -n wg-quick down de4-wireguard'
+
+
+def test_switch_reconnects(switch_env, monkeypatch):
+    """Servers with different interface settings require a full reconnect."""
+    assert wireguard.switch('us1-wireguard') == 'reconnect'
+    assert switch_env == ['sudo -n wg-quick down de4-wireguard', 'sudo -n wg-quick up us1-wireguard']
+
+    # Failing to replace the peer falls back to reconnecting as well:
+    def run_command(cmd, **kwargs):
+        switch_env.append(cmd)
+        if ' switch ' in cmd:
+            raise wireguard.CommandError('sudo: a password is required', cmd)
+    monkeypatch.setattr(wireguard, 'run_command', run_command)
+    switch_env.clear()
+    assert wireguard.switch('nl2-wireguard') == 'reconnect'
+    assert switch_env[1:] == ['sudo -n wg-quick down de4-wireguard', 'sudo -n wg-quick up nl2-wireguard']
+    assert wireguard.active_server() == 'de4-wireguard'
+
+
+def test_stale_switch_state(switch_env, tmp_path):
+    """A recorded switch is ignored once the interface was recreated."""
+    wireguard.switch('nl2-wireguard')
+    (tmp_path / 'net' / 'de4-wireguard' / 'ifindex').write_text('8\n')
+    assert wireguard.active_server() == 'de4-wireguard'
+
+
+def test_hedged_ip_lookup():
+    """The first valid answer wins, failing and slow providers are ignored."""
+    released = threading.Event()
+
+    def slow():
+        released.wait(5)
+        return {'ip': '1.1.1.1'}
+
+    def failing():
+        raise OSError('connection refused')
+
+    def fast():
+        return {'ip': '2.2.2.2'}
+
+    try:
+        assert wireguard.hedged_ip_lookup([slow, failing, lambda: {'error': 'rate limit'}, fast]) == {'ip': '2.2.2.2'}
+        with pytest.raises(OSError, match='connection refused'):
+            wireguard.hedged_ip_lookup([failing])
+        with pytest.raises(OSError, match='timed out'):
+            wireguard.hedged_ip_lookup([slow], timeout=0.01)
+    finally:
+        released.set()
+
+
+def test_external_ip_cache(tmp_path, monkeypatch):
+    """The external IP address is cached until the connection changes."""
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    monkeypatch.setattr(wghelper, 'STATE_DIR', str(tmp_path / 'state'))
+    monkeypatch.setattr(wireguard, 'interface', lambda: 'de4-wireguard')
+    monkeypatch.setattr(wireguard, '_ifindex', lambda iface: 7)
+    monkeypatch.setattr(wghelper, 'ifindex', lambda iface: 7)
+    lookups = []
+
+    def ipinfo():
+        lookups.append(1)
+        return {'ip': f'10.0.0.{len(lookups)}'}
+    monkeypatch.setattr(wireguard, 'IP_PROVIDERS', ('ipinfo',))
+    monkeypatch.setattr(wireguard, 'ipinfo', ipinfo)
+
+    assert wireguard.status(ip=True) == 'Connected to: de4-wireguard, ip: 10.0.0.1'
+    assert wireguard.external_ip()['ip'] == '10.0.0.1'
+    assert len(lookups) == 1
+    # The peer was replaced, so the exit address changed:
+    wghelper.write_state('de4-wireguard', 'nl2-wireguard')
+    assert wireguard.external_ip()['ip'] == '10.0.0.2'
+    assert wireguard.external_ip(refresh=True)['ip'] == '10.0.0.3'
+    monkeypatch.setattr(wireguard, 'IP_CACHE_TTL', 0)
+    assert wireguard.external_ip()['ip'] == '10.0.0.4'
+
+
+def test_helper_switch(switch_env, tmp_path, monkeypatch):
+    """The helper takes the new peer from the server's config, and only accepts server names."""
+    calls = []
+
+    def wg(*args):
+        calls.append(args)
+        return 'de4key=\n' if args[:1] == ('show',) else ''
+    monkeypatch.setattr(wghelper, 'wg', wg)
+    wghelper.switch('de4-wireguard', 'nl2-wireguard', etc_dir=str(tmp_path / 'etc'))
+    assert calls[-1] == ('set', 'de4-wireguard', 'peer', 'de4key=', 'remove', 'peer', 'nl2key=',
+                         'endpoint', '[2a03:1b20:1:f011::a01f]:51820', 'allowed-ips', '0.0.0.0/0,::0/0')
+
+    calls.clear()
+    assert wghelper.main(['switch', 'de4-wireguard', '../nl2-wireguard']) == 1
+    assert wghelper.main(['switch', 'de4-wireguard', 'nl2-wireguard', '/tmp']) == 2
+    assert wghelper.main(['set', 'de4-wireguard', 'private-key', '/tmp/key']) == 2
+    assert calls == []
+
+
+def test_helper_dump(monkeypatch, capsys):
+    """The helper prints peer statistics without private and preshared keys."""
+    dump = ('privkey=\tpubkey=\t51820\toff\n'
+            'de4key=\tpsk=\t185.213.155.73:51820\t0.0.0.0/0\t1700000000\t2000\t1000\toff\n')
+    monkeypatch.setattr(wghelper, 'wg', lambda *args: dump if args == ('show', 'de4-wireguard', 'dump') else None)
+    assert wghelper.main(['dump', 'de4-wireguard']) == 0
+    output = capsys.readouterr().out
+    assert 'privkey=' not in output and 'psk=' not in output
+    [peer] = monitor.parse_dump(output)
+    assert (peer.public_key, peer.rx, peer.tx) == ('de4key=', 2000, 1000)
+
+
+def test_runtime_dir(tmp_path, monkeypatch):
+    """The runtime directory is created private, and refused if others may access it."""
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    path = wireguard.runtime_dir()
+    assert path.parent == tmp_path and path.stat().st_mode & 0o777 == 0o700
+    path.chmod(0o755)
+    with pytest.raises(PermissionError):
+        wireguard.runtime_dir()
+    path.rmdir()
+    path.symlink_to(tmp_path)
+    with pytest.raises(PermissionError):
+        wireguard.runtime_dir()
+
+
+def test_run_command_cancelled():
+    """Setting the cancel event terminates the running command."""
+    assert wireguard.run_command('echo done', cancel=threading.Event()) == 'done'
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    start = time.monotonic()
+    with pytest.raises(wireguard.CommandCancelled):
+        wireguard.run_command('sleep 5', cancel=cancel)
+    assert time.monotonic() - start < 2